@@ -0,0 +1,54 @@
+from django.db.models import F, FloatField, OuterRef, Subquery, Count, Sum, IntegerField, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from Recipes.models import Recipe, Rating, Comment
+
+
+def _average(rating_sum, rating_count):
+    # NULLIF keeps recipes without ratings at NULL instead of dividing by zero
+    return Cast(rating_sum, FloatField()) / NullIf(rating_count, 0)
+
+
+def rating_added(recipe_id, score):
+    Recipe.objects.filter(pk=recipe_id).update(
+        rating_sum=F('rating_sum') + score,
+        rating_count=F('rating_count') + 1,
+        rating_average=_average(F('rating_sum') + score, F('rating_count') + 1),
+    )
+
+
+def rating_removed(recipe_id, score):
+    Recipe.objects.filter(pk=recipe_id).update(
+        rating_sum=F('rating_sum') - score,
+        rating_count=F('rating_count') - 1,
+        rating_average=_average(F('rating_sum') - score, F('rating_count') - 1),
+    )
+
+
+def comment_added(recipe_id):
+    Recipe.objects.filter(pk=recipe_id).update(comment_count=F('comment_count') + 1)
+
+
+def comment_removed(recipe_id):
+    Recipe.objects.filter(pk=recipe_id).update(comment_count=F('comment_count') - 1)
+
+
+def reconcile(recipe_ids=None):
+    """Recomputes aggregates from Rating and Comment rows, of all recipes if no ids are given."""
+    recipes = Recipe.objects.all()
+    if recipe_ids is not None:
+        recipes = recipes.filter(pk__in=recipe_ids)
+
+    def aggregate(model, expression):
+        rows = model.objects.filter(recipe=OuterRef('pk')).order_by().values('recipe')
+        return Coalesce(Subquery(rows.annotate(value=expression).values('value'), output_field=IntegerField()),
+                        Value(0))
+
+    rating_sum = aggregate(Rating, Sum('score'))
+    rating_count = aggregate(Rating, Count('id'))
+    return recipes.update(
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        rating_average=_average(rating_sum, rating_count),
+        comment_count=aggregate(Comment, Count('id')),
+    )
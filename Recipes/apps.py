@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class RecipesConfig(AppConfig):
     name = 'Recipes'
+
+    def ready(self):
+        import Recipes.signals  # noqa: F401
@@ -0,0 +1,155 @@
+"""
+Type-ahead over ingredient and category names, answered from memory by every worker.
+
+Names are matched by prefix of the whole name first, then by prefix of any later word ("pep" finds
+"black pepper"), both by bisecting sorted keys. When that leaves room, names within a typo or two of
+the query are added: candidates share enough trigrams with the query, the few that do are checked
+with an edit distance. The index is rebuilt when names change (see Recipes.signals).
+"""
+import bisect
+import threading
+
+import numpy as np
+
+from Recipes import versions
+from Recipes.models import Ingredient, Category
+
+VERSION_NAME = 'autocomplete'
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# fuzzy matching starts at this query length, one more typo is allowed every TYPO_EVERY characters
+FUZZY_MIN_LENGTH = 4
+TYPO_EVERY = 8
+# longest query compared fuzzily, keys have trigrams of as many characters and room for typos
+FUZZY_MAX_LENGTH = 20
+FUZZY_CANDIDATES = 30
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def trigrams(key, length):
+    padded = '  ' + key[:length]
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+def prefix_distance(query, text, limit):
+    """
+    Edit distance (with transpositions) of the query to the closest prefix of text, limit + 1 if
+    over limit. Only cells within `limit` of the diagonal can stay under it and are computed.
+    """
+    text = text[:len(query) + limit]
+    over = limit + 1
+    before, previous = None, [j if j <= limit else over for j in range(len(text) + 1)]
+    for i in range(1, len(query) + 1):
+        row = [over] * (len(text) + 1)
+        if i <= limit:
+            row[0] = i
+        for j in range(max(1, i - limit), min(len(text), i + limit) + 1):
+            cost = query[i - 1] != text[j - 1]
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost, over)
+            if cost and i > 1 and j > 1 and query[i - 1] == text[j - 2] and query[i - 2] == text[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > limit:
+            return over
+        before, previous = previous, row
+    return min(previous)
+
+
+class NameIndex:
+    """Names of one model (Ingredient or Category) sorted for prefix lookups, with trigram postings."""
+
+    def __init__(self, model):
+        self.model = model
+        self.version = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        names = dict(self.model.objects.values_list('id', 'name'))
+        # (key, id): whole names and, separately, the rest of the name from every later word
+        starts, words = [], []
+        for tag_id, name in names.items():
+            key = normalize(name)
+            starts.append((key, tag_id))
+            position = key.find(' ')
+            while position != -1:
+                words.append((key[position + 1:], tag_id))
+                position = key.find(' ', position + 1)
+        starts.sort()
+        words.sort()
+
+        entries = starts + words
+        postings = {}
+        for entry, (key, _) in enumerate(entries):
+            for trigram in trigrams(key, FUZZY_MAX_LENGTH + 4):
+                postings.setdefault(trigram, []).append(entry)
+        postings = {trigram: np.array(ids, dtype=np.int32) for trigram, ids in postings.items()}
+
+        self.names = names
+        self.starts, self.start_keys = starts, [key for key, _ in starts]
+        self.words, self.word_keys = words, [key for key, _ in words]
+        self.entries = entries
+        self.postings = postings
+
+    def ensure_fresh(self):
+        with self._lock:
+            version = versions.current(VERSION_NAME)
+            if self.version != version:
+                self.build()
+                self.version = version
+
+    def complete(self, query, limit=DEFAULT_LIMIT, fuzzy=True):
+        """Up to `limit` (id, name) pairs: whole name prefixes, word prefixes, then near misses."""
+        self.ensure_fresh()
+        query = normalize(query)
+        found = []
+        if not query:
+            return found
+        seen = set()
+        for entries, keys in ((self.starts, self.start_keys), (self.words, self.word_keys)):
+            position = bisect.bisect_left(keys, query)
+            while position < len(keys) and keys[position].startswith(query) and len(found) < limit:
+                tag_id = entries[position][1]
+                if tag_id not in seen:
+                    seen.add(tag_id)
+                    found.append(tag_id)
+                position += 1
+        if fuzzy and len(found) < limit and FUZZY_MIN_LENGTH <= len(query) <= FUZZY_MAX_LENGTH:
+            found += self.near_misses(query, limit - len(found), seen)
+        return [(tag_id, self.names[tag_id]) for tag_id in found]
+
+    def near_misses(self, query, limit, seen):
+        typos = 1 + len(query) // TYPO_EVERY
+        query_trigrams = trigrams(query, len(query))
+        # a typo changes at most 3 trigrams of the query, keys with fewer in common are too far
+        required = max(len(query_trigrams) - 3 * typos, 1)
+        matched = [self.postings[trigram] for trigram in query_trigrams if trigram in self.postings]
+        if not matched:
+            return []
+        shared = np.bincount(np.concatenate(matched))
+        candidates = np.flatnonzero(shared >= required)
+        if len(candidates) > FUZZY_CANDIDATES:
+            candidates = candidates[np.argpartition(-shared[candidates], FUZZY_CANDIDATES)[:FUZZY_CANDIDATES]]
+
+        ranked = {}
+        for entry in candidates.tolist():
+            key, tag_id = self.entries[entry]
+            if tag_id in seen:
+                continue
+            distance = prefix_distance(query, key, typos)
+            if distance <= typos and distance < ranked.get(tag_id, (typos + 1,))[0]:
+                ranked[tag_id] = (distance, len(self.names[tag_id]), self.names[tag_id])
+        return sorted(ranked, key=ranked.get)[:limit]
+
+
+_indexes = {Ingredient: NameIndex(Ingredient), Category: NameIndex(Category)}
+
+
+def get_name_index(model):
+    return _indexes[model]
+
+
+def reset_name_indexes():
+    for index in _indexes.values():
+        index.version = None
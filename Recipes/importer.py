@@ -0,0 +1,226 @@
+import codecs
+import json
+import re
+from itertools import chain, islice
+
+from django.db import DatabaseError, connection, transaction
+from rest_framework.exceptions import ValidationError
+
+from Recipes import autocomplete, response_cache, versions
+from Recipes.models import Recipe, Ingredient, Category
+from Recipes.serializer import RecipeImportSerializer
+
+BATCH_SIZE = 500  # records per transaction
+CHUNK_SIZE = 400  # names per IN (...) lookup and relation rows per INSERT, below SQLite's 999 variables
+READ_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+# reading
+
+def read_records(stream, read_size=READ_SIZE):
+    """
+    Records of an NDJSON or JSON array byte stream, read `read_size` bytes at a time.
+
+    Yields (number, record) pairs numbered from 1. A record that cannot be decoded is yielded as
+    the ValueError instead, a broken JSON array ends the stream.
+    """
+    chunks = _text_chunks(stream, read_size)
+    start = ''
+    for chunk in chunks:
+        start += chunk
+        if start.strip():
+            break
+    start = start.lstrip()
+    if start.startswith('['):
+        return _array_records(chain([start[1:]], chunks))
+    return _line_records(chain([start], chunks))
+
+
+def _text_chunks(stream, read_size):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+
+def _line_records(chunks):
+    number, buffer = 0, ''
+    for chunk in chain(chunks, ['\n']):
+        *lines, buffer = (buffer + chunk).split('\n')
+        for line in lines:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                yield number, json.loads(line)
+            except ValueError as error:
+                yield number, error
+
+
+def _array_records(chunks):
+    number, buffer, position = 0, '', 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if buffer[position:position + 1] == ']':
+            return
+        try:
+            record, end = _decoder.raw_decode(buffer, position)
+            # a number may continue in the next chunk
+            complete = end < len(buffer)
+        except ValueError as error:
+            # a malformed element is skipped up to the next one, an incomplete one continues in the next chunk
+            record, end = error, _element_end(buffer, position)
+            complete = end is not None
+        if not complete:
+            chunk = next(chunks, None)
+            if chunk is not None:
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            if end is None:
+                yield number + 1, record
+                return
+        number += 1
+        yield number, record
+        position = end
+
+
+_STRUCTURE = re.compile(r'[]["{},]')
+_STRING_END = re.compile(r'["\\]')
+
+
+def _element_end(buffer, position):
+    """Position of the ',' or ']' after the array element starting at `position`, None if not buffered yet."""
+    depth = 0
+    while True:
+        match = _STRUCTURE.search(buffer, position)
+        if match is None:
+            return None
+        char, position = match.group(), match.end()
+        if char == '"':
+            while True:
+                match = _STRING_END.search(buffer, position)
+                if match is None:
+                    return None
+                # an escaped character is skipped with its backslash
+                position = match.end() + (match.group() == '\\')
+                if match.group() == '"':
+                    break
+        elif char in '[{':
+            depth += 1
+        elif depth == 0:
+            return match.start()
+        elif char != ',':
+            depth -= 1
+
+
+# importing
+
+def import_recipes(records, user=None, batch_size=BATCH_SIZE):
+    """
+    Creates recipes from (number, record) pairs of `read_records`, every batch in one transaction.
+
+    A batch costs a fixed number of queries: tag names are resolved and created in bulk and rows of
+    recipes and their relations are inserted in chunks. Invalid records are skipped and reported,
+    if a batch fails in the database all of its records are reported.
+    """
+    created, errors = 0, []
+    records = iter(records)
+    # one serializer for all records, fields are copied for every new instance
+    serializer = RecipeImportSerializer()
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        valid = []
+        for number, record in batch:
+            if isinstance(record, Exception):
+                errors.append({'record': number, 'errors': str(record)})
+                continue
+            try:
+                valid.append((number, serializer.run_validation(record)))
+            except ValidationError as error:
+                errors.append({'record': number, 'errors': error.detail})
+        if not valid:
+            continue
+        try:
+            created += _import_batch([data for _, data in valid], user)
+        except DatabaseError as error:
+            errors.extend({'record': number, 'errors': str(error)} for number, _ in valid)
+
+    if created:
+        response_cache.invalidate_catalog()
+    return {'created': created, 'failed': len(errors), 'errors': errors}
+
+
+def _import_batch(recipes, user):
+    with transaction.atomic():
+        ingredient_ids = resolve_names(Ingredient, {name for recipe in recipes for name in recipe['ingredients']})
+        category_ids = resolve_names(Category, {name for recipe in recipes for name in recipe['categories']})
+        recipe_ids = insert_rows(Recipe, [
+            Recipe(title=recipe['title'], description=recipe['description'], difficulty=recipe['difficulty'],
+                   time=recipe['time'], user=user)
+            for recipe in recipes])
+
+        for through, field, key, tag_ids in (
+                (Recipe.ingredients.through, 'ingredient_id', 'ingredients', ingredient_ids),
+                (Recipe.categories.through, 'category_id', 'categories', category_ids)):
+            through.objects.bulk_create([
+                through(recipe_id=recipe_id, **{field: tag_ids[name]})
+                for recipe_id, recipe in zip(recipe_ids, recipes) for name in set(recipe[key])
+            ], batch_size=CHUNK_SIZE)
+        # rows inserted in bulk send no signals
+        versions.record_catalog_on_commit('recipe', recipe_ids)
+    return len(recipe_ids)
+
+
+def insert_rows(model, rows):
+    """Inserts rows in chunks, returns their ids in order."""
+    if not rows:
+        return []
+    with transaction.atomic():
+        model.objects.bulk_create(rows, batch_size=CHUNK_SIZE)
+        if connection.features.can_return_ids_from_bulk_insert:
+            return [row.pk for row in rows]
+        # SQLite does not return ids, but the transaction holds the write lock since the first insert,
+        # so the rows got the last consecutive ids
+        last_id = model.objects.order_by('-pk').values_list('pk', flat=True).first()
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def resolve_names(model, names):
+    """
+    Name -> id of ingredients or categories, the missing ones are created and recorded in the
+    catalog journal on commit.
+    """
+    names = list(names)
+    ids = _lookup(model, names)
+    missing = [name for name in names if name not in ids]
+    if missing:
+        # another import may create the same names meanwhile, conflicts are looked up again
+        model.objects.bulk_create([model(name=name) for name in missing], batch_size=CHUNK_SIZE,
+                                  ignore_conflicts=True)
+        created = _lookup(model, missing)
+        ids.update(created)
+        versions.record_catalog_on_commit(model.__name__.lower(), created.values())
+        versions.bump_on_commit(autocomplete.VERSION_NAME)
+    return ids
+
+
+def _lookup(model, names):
+    ids = {}
+    for start in range(0, len(names), CHUNK_SIZE):
+        ids.update(model.objects.filter(name__in=names[start:start + CHUNK_SIZE]).values_list('name', 'id'))
+    return ids
+
+
+def catalog_changed():
+    """Rows inserted in bulk without recording them, every process rebuilds structures derived from the catalog."""
+    versions.record_rebuild_on_commit()
+    versions.bump_on_commit(autocomplete.VERSION_NAME)
+    response_cache.invalidate_catalog()
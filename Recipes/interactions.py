@@ -0,0 +1,65 @@
+"""
+Ratings and favourites written in batches, one statement each, safe to repeat.
+
+Rows are written without model signals, so counters, cached responses and stored
+recommendations are brought up to date here.
+"""
+from django.db import connection, transaction
+
+from Recipes import aggregates, response_cache
+from Recipes.models import Rating, Recipe, User
+from Recipes.recommender import precomputed
+
+# SQLite allows 999 parameters in a statement
+ROWS_PER_STATEMENT = 999 // 3
+
+
+def existing_recipes(recipe_ids):
+    return set(Recipe.objects.filter(pk__in=list(recipe_ids)).values_list('id', flat=True))
+
+
+def upsert_ratings(user_id, scores):
+    """
+    Sets user's score of every recipe in `scores` (recipe id -> score), existing ratings are updated.
+
+    INSERT ... ON CONFLICT on the unique (user, recipe) constraint, concurrent requests cannot
+    produce two ratings of a recipe. Returns ids of recipes that were rated.
+    """
+    rows = [(user_id, recipe_id, score) for recipe_id, score in sorted(scores.items())]
+    table = connection.ops.quote_name(Rating._meta.db_table)
+    user, recipe, score = (connection.ops.quote_name(Rating._meta.get_field(name).column)
+                           for name in ('user', 'recipe', 'score'))
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(rows), ROWS_PER_STATEMENT):
+            chunk = rows[start:start + ROWS_PER_STATEMENT]
+            cursor.execute(
+                'INSERT INTO {table} ({user}, {recipe}, {score}) VALUES {values} '
+                'ON CONFLICT ({user}, {recipe}) DO UPDATE SET {score} = EXCLUDED.{score}'.format(
+                    table=table, user=user, recipe=recipe, score=score,
+                    values=', '.join(['(%s, %s, %s)'] * len(chunk))),
+                [value for row in chunk for value in row])
+        recipe_ids = [recipe_id for _, recipe_id, _ in rows]
+        if recipe_ids:
+            aggregates.reconcile(recipe_ids)
+            response_cache.invalidate(response_cache.RECIPES, *map(response_cache.recipe_tag, recipe_ids))
+    return recipe_ids
+
+
+def update_favourites(user_id, add=(), remove=()):
+    """
+    Adds and removes favourite recipes of the user, adding a favourite twice is not an error.
+    Returns ids of the recipes that were favourites and are not any more.
+    """
+    through = User.favourite_recipes.through
+    removed = []
+    with transaction.atomic():
+        if add:
+            through.objects.bulk_create([through(user_id=user_id, recipe_id=recipe_id) for recipe_id in add],
+                                        ignore_conflicts=True)
+        if remove:
+            links = through.objects.filter(user_id=user_id, recipe_id__in=list(remove))
+            removed = list(links.select_for_update().values_list('recipe_id', flat=True))
+            links.filter(recipe_id__in=removed).delete()
+        if add or remove:
+            precomputed.invalidate([user_id])
+    return removed
@@ -0,0 +1,216 @@
+import threading
+from functools import reduce
+
+import numpy as np
+
+from Recipes import versions
+from Recipes.models import Recipe, Ingredient, Category
+
+EMPTY = np.array([], dtype=np.int64)
+# a longer backlog of changes is cheaper to read from scratch than recipe by recipe
+MAX_CHANGES = 500
+
+
+class TagIndex:
+    """
+    Ingredient and category id -> sorted array of recipe ids, kept in memory by every worker.
+
+    Answers "recipes containing all of X", "at least k of X" and "missing at most m ingredients"
+    with sorted array intersections and counts, without touching the database. Every process
+    follows the catalog journal (see Recipes.versions) and reloads just the recipes and tags named
+    in it, a recorded rebuild or a long backlog rebuilds the whole index.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.position = None
+
+    def build(self, position=None):
+        with self._lock:
+            if position is None:
+                # taken before the rows are read, changes committed meanwhile are applied again later
+                position, _ = versions.changes(versions.CATALOG, None)
+            self.ingredient_names = dict(Ingredient.objects.values_list('name', 'id'))
+            self.category_names = dict(Category.objects.values_list('name', 'id'))
+            self.recipe_ingredients = {recipe_id: set() for recipe_id in Recipe.objects.values_list('id', flat=True)}
+            self.recipe_categories = {recipe_id: set() for recipe_id in self.recipe_ingredients}
+            self.ingredients = self._postings(Recipe.ingredients.through, 'ingredient_id', self.recipe_ingredients)
+            self.categories = self._postings(Recipe.categories.through, 'category_id', self.recipe_categories)
+            self.sizes = np.zeros(max(self.recipe_ingredients, default=0) + 1, dtype=np.int64)
+            self._update_sizes(list(self.recipe_ingredients))
+            self.position = position
+
+    @staticmethod
+    def _postings(through, field, recipe_tags):
+        links = np.array(list(through.objects.values_list(field, 'recipe_id')), dtype=np.int64).reshape(-1, 2)
+        for tag_id, recipe_id in links.tolist():
+            recipe_tags.setdefault(recipe_id, set()).add(tag_id)
+        links = links[np.lexsort((links[:, 1], links[:, 0]))]
+        tags, starts = np.unique(links[:, 0], return_index=True)
+        return {int(tag_id): recipe_ids for tag_id, recipe_ids in zip(tags, np.split(links[:, 1], starts[1:]))}
+
+    def ensure_fresh(self):
+        with self._lock:
+            position, entries = versions.changes(versions.CATALOG, self.position)
+            if entries is None or len(entries) > MAX_CHANGES:
+                return self.build(position)
+            changed = versions.catalog_changes(entries)
+            if changed['rebuild']:
+                return self.build(position)
+            self._reload_recipes(changed['recipe'])
+            self._reload_tags(Ingredient, changed['ingredient'])
+            self._reload_tags(Category, changed['category'])
+            self.position = position
+
+    # changes
+
+    def _relations(self, model):
+        if model is Ingredient:
+            return Recipe.ingredients.through, 'ingredient_id', self.ingredient_names, self.ingredients, \
+                self.recipe_ingredients
+        return Recipe.categories.through, 'category_id', self.category_names, self.categories, self.recipe_categories
+
+    def _reload_recipes(self, recipe_ids):
+        if not recipe_ids:
+            return
+        recipe_ids = list(recipe_ids)
+        live = set(Recipe.objects.filter(pk__in=recipe_ids).values_list('id', flat=True))
+        for model in (Ingredient, Category):
+            through, field, _, postings, recipe_tags = self._relations(model)
+            removed = {}
+            for recipe_id in recipe_ids:
+                for tag_id in recipe_tags.pop(recipe_id, ()):
+                    removed.setdefault(tag_id, []).append(recipe_id)
+            for tag_id, ids in removed.items():
+                postings[tag_id] = np.setdiff1d(postings[tag_id], ids, assume_unique=True)
+
+            added = {}
+            for recipe_id in live:
+                recipe_tags[recipe_id] = set()
+            for recipe_id, tag_id in through.objects.filter(recipe_id__in=live).values_list('recipe_id', field):
+                recipe_tags[recipe_id].add(tag_id)
+                added.setdefault(tag_id, []).append(recipe_id)
+            for tag_id, ids in added.items():
+                postings[tag_id] = np.union1d(postings.get(tag_id, EMPTY), np.array(ids, dtype=np.int64))
+        self._update_sizes(recipe_ids)
+
+    def _reload_tags(self, model, tag_ids):
+        """Names and recipes of the tags, deleted tags are dropped."""
+        if not tag_ids:
+            return
+        through, field, names, postings, recipe_tags = self._relations(model)
+        for name in [name for name, tag_id in names.items() if tag_id in tag_ids]:
+            del names[name]
+        names.update(model.objects.filter(pk__in=list(tag_ids)).values_list('name', 'id'))
+
+        affected = set()
+        for tag_id in tag_ids:
+            for recipe_id in postings.pop(tag_id, EMPTY).tolist():
+                recipe_tags.get(recipe_id, set()).discard(tag_id)
+                affected.add(recipe_id)
+        links = np.array(list(through.objects.filter(**{field + '__in': list(tag_ids)}).values_list(
+            field, 'recipe_id')), dtype=np.int64).reshape(-1, 2)
+        for tag_id, recipe_id in links.tolist():
+            recipe_tags.setdefault(recipe_id, set()).add(tag_id)
+            affected.add(recipe_id)
+        for tag_id in np.unique(links[:, 0]).tolist():
+            postings[tag_id] = np.unique(links[links[:, 0] == tag_id, 1])
+        if model is Ingredient:
+            self._update_sizes(affected)
+
+    def _update_sizes(self, recipe_ids):
+        recipe_ids = list(recipe_ids)
+        if not recipe_ids:
+            return
+        if max(recipe_ids) >= len(self.sizes):
+            self.sizes = np.concatenate([self.sizes, np.zeros(max(recipe_ids) + 1 - len(self.sizes), dtype=np.int64)])
+        self.sizes[recipe_ids] = [len(self.recipe_ingredients.get(recipe_id, ())) for recipe_id in recipe_ids]
+
+    # queries
+
+    def ingredient_ids(self, names):
+        return [self.ingredient_names[name] for name in names if name in self.ingredient_names]
+
+    def category_ids(self, names):
+        return [self.category_names[name] for name in names if name in self.category_names]
+
+    def with_any_category(self, category_ids):
+        self.ensure_fresh()
+        return reduce(np.union1d, [self.categories.get(tag_id, EMPTY) for tag_id in category_ids], EMPTY)
+
+    def match(self, groups, min_matches=1, max_missing=None):
+        """
+        Recipes matching at least `min_matches` of the ingredient groups and needing at most
+        `max_missing` other ingredients, best covered first.
+
+        A group is a dict of interchangeable ingredient id -> weight (see Recipes.replacements), it
+        is matched by the best weighted ingredient of it the recipe has. Returns arrays of recipe ids,
+        weighted matches, missing ingredient counts and coverage (weighted matches / recipe size).
+        """
+        self.ensure_fresh()
+        groups = [group for group in groups if group]
+        if not groups:
+            return EMPTY, EMPTY, EMPTY, EMPTY
+
+        group_ids, group_weights = [], []
+        for group in groups:
+            ids = np.concatenate([self.ingredients.get(tag_id, EMPTY) for tag_id in group])
+            weights = np.concatenate([np.full(len(self.ingredients.get(tag_id, EMPTY)), weight)
+                                      for tag_id, weight in group.items()])
+            order = np.lexsort((-weights, ids))
+            ids, weights = ids[order], weights[order]
+            best = np.ones(len(ids), dtype=bool)
+            best[1:] = ids[1:] != ids[:-1]
+            group_ids.append(ids[best])
+            group_weights.append(weights[best])
+
+        if min_matches > len(groups):
+            return EMPTY, EMPTY, EMPTY, EMPTY
+        if min_matches == len(groups):
+            # intersecting from the rarest group keeps intermediate arrays short
+            recipe_ids = reduce(lambda left, right: np.intersect1d(left, right, assume_unique=True),
+                                sorted(group_ids, key=len))
+            score = np.zeros(len(recipe_ids))
+            for ids, weights in zip(group_ids, group_weights):
+                score += weights[np.searchsorted(ids, recipe_ids)]
+        else:
+            recipe_ids, inverse, matched = np.unique(np.concatenate(group_ids), return_inverse=True,
+                                                     return_counts=True)
+            score = np.bincount(inverse, weights=np.concatenate(group_weights), minlength=len(recipe_ids))
+            keep = matched >= min_matches
+            recipe_ids, score = recipe_ids[keep], score[keep]
+
+        # ingredients of the recipe outside of every group are missing
+        members = set().union(*groups)
+        covered_ids, covered = np.unique(
+            np.concatenate([self.ingredients.get(tag_id, EMPTY) for tag_id in members]), return_counts=True)
+        covered = covered[np.searchsorted(covered_ids, recipe_ids)]
+        sizes = self.sizes[recipe_ids]
+        missing = sizes - covered
+        if max_missing is not None:
+            keep = missing <= max_missing
+            recipe_ids, score, missing, sizes = recipe_ids[keep], score[keep], missing[keep], sizes[keep]
+        coverage = score / np.maximum(sizes, 1)
+        order = np.lexsort((-recipe_ids, -score, -coverage))
+        return recipe_ids[order], score[order], missing[order], coverage[order]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_tag_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = TagIndex()
+                index.build()
+                _index = index
+    _index.ensure_fresh()
+    return _index
+
+
+def reset_tag_index():
+    global _index
+    _index = None
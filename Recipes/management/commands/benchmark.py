@@ -0,0 +1,213 @@
+import json
+import random
+import subprocess
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from rest_framework.authtoken.models import Token
+
+from Recipes.inverted_index import reset_tag_index
+from Recipes.models import User, Recipe, Ingredient, Category
+from Recipes.recommender.collaborative import reset_collaborative_model
+from Recipes.recommender.features import reset_store
+from Recipes.recommender.index import reset_index
+from Recipes.replacements import reset_replacement_graph
+from Recipes.response_cache import reset_response_cache
+
+PERCENTILES = (50, 95, 99)
+# routes of CachedResponseMixin views, also measured with the response cache kept (`<name>_warm`)
+CACHED_SCENARIOS = ('recipes', 'recipes_fields', 'recipe', 'ingredients', 'categories')
+
+
+def scenarios(rng):
+    """Name -> function returning the next URL to request. Ids and names are drawn from the dataset."""
+    recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+    user_ids = list(User.objects.values_list('id', flat=True))
+    ingredients = list(Ingredient.objects.values_list('name', flat=True))
+    categories = list(Category.objects.values_list('name', flat=True))
+    titles = list(Recipe.objects.values_list('title', flat=True)[:100])
+
+    def names(values, count):
+        return '[{}]'.format(','.join(rng.sample(values, min(count, len(values)))))
+
+    def word():
+        return rng.choice(rng.choice(titles).split())
+
+    def url(path, **params):
+        return path + ('?' + urlencode(params) if params else '')
+
+    search_filters = {
+        'q': lambda: {'q': word()},
+        'title': lambda: {'title': word()},
+        'difficulty': lambda: {'difficulty': rng.randint(1, 5)},
+        'time': lambda: {'time': rng.randint(20, 150)},
+        'categories': lambda: {'categories': names(categories, 2)},
+        'ingredients': lambda: {'ingredients': names(ingredients, 3)},
+        'replacements': lambda: {'replacements': 'true', 'ingredients': names(ingredients, 3)},
+        'match_all': lambda: {'match': 'all', 'ingredients': names(ingredients, 2)},
+        'min_matches': lambda: {'min_matches': 2, 'ingredients': names(ingredients, 6)},
+        'max_missing': lambda: {'max_missing': 3, 'ingredients': names(ingredients, 8)},
+    }
+    combinations = [(name,) for name in search_filters] + [
+        ('difficulty', 'time'),
+        ('categories', 'ingredients'),
+        ('q', 'difficulty', 'time'),
+        ('categories', 'min_matches', 'time'),
+        ('title', 'difficulty', 'time', 'categories', 'ingredients'),
+    ]
+
+    urls = {
+        'recipes': lambda: url('/recipes'),
+        'recipes_fields': lambda: url('/recipes', fields='id,title,time'),
+        'recipe': lambda: url('/recipes/{}'.format(rng.choice(recipe_ids))),
+        'user': lambda: url('/users/{}'.format(rng.choice(user_ids))),
+        'user_expanded': lambda: url('/users/{}'.format(rng.choice(user_ids)),
+                                     expand='top_rated_recipes,recommended_recipes,my_recipes'),
+        'user_hybrid': lambda: url('/users/{}'.format(rng.choice(user_ids)), expand='recommended_recipes',
+                                   engine='hybrid'),
+        'user_recommendations': lambda: url('/users/{}/recommendations'.format(rng.choice(user_ids)), k=20,
+                                            engine='hybrid'),
+        'users': lambda: url('/users', expand='top_rated_recipes,my_recipes'),
+        'ratings': lambda: url('/ratings', user_id=rng.choice(user_ids)),
+        'comments': lambda: url('/comments'),
+        'ingredients': lambda: url('/ingredients'),
+        'categories': lambda: url('/categories'),
+    }
+    for combination in combinations:
+        urls['search_' + '+'.join(combination)] = lambda combination=combination: url(
+            '/search', **{key: value for name in combination for key, value in search_filters[name]().items()})
+    return urls
+
+
+def measure(client, next_url, n_requests, warmup, cold=True):
+    """
+    Requests `n_requests` URLs one by one, returns latency percentiles, queries and throughput.
+
+    Cold requests start with an empty response cache, so cached routes are measured and not the cache.
+    """
+    queries = []
+
+    def count_query(execute, sql, params, many, context):
+        queries[-1] += 1
+        return execute(sql, params, many, context)
+
+    for _ in range(warmup):
+        client.get(next_url())
+    latencies, statuses = [], {}
+    with connection.execute_wrapper(count_query):
+        for _ in range(n_requests):
+            url = next_url()
+            if cold:
+                reset_response_cache()
+            queries.append(0)
+            request_started = time.perf_counter()
+            response = client.get(url)
+            latencies.append(time.perf_counter() - request_started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    latencies = np.array(latencies) * 1000
+    result = {'p{}_ms'.format(percentile): round(float(value), 3)
+              for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))}
+    result.update({
+        'mean_ms': round(float(latencies.mean()), 3),
+        'queries': {'mean': round(float(np.mean(queries)), 2), 'max': int(max(queries))},
+        'throughput_rps': round(n_requests / max(sum(latencies) / 1000, 1e-9), 1),
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+    })
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks API routes through the test client on a generated dataset in the test database, '
+            'prints latency percentiles, queries per request and throughput as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=20, help='Dataset size, see generate_test_data.')
+        parser.add_argument('--requests', type=int, default=100, help='Measured requests per scenario.')
+        parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per scenario.')
+        parser.add_argument('--only', nargs='*', help='Scenarios whose names start with any of these.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the test database and its dataset for the next run.')
+        parser.add_argument('--output', help='Write results to this file instead of standard output.')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare p50 and p95 with.')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            # search structures of the benchmark must not replace the ones of the running site
+            with tempfile.TemporaryDirectory() as directory, \
+                    override_settings(RECOMMENDER_DIR=directory + '/recommender',
+                                      CATALOG_VERSIONS_DIR=directory + '/versions',
+                                      RESPONSE_CACHE_BACKEND=None,
+                                      ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+                for reset in (reset_store, reset_index, reset_tag_index, reset_replacement_graph,
+                              reset_collaborative_model, reset_response_cache):
+                    reset()
+                results = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                self.compare(json.load(baseline_file), results)
+
+    def run(self, options):
+        if not options['keepdb'] or not Recipe.objects.exists():
+            call_command('generate_test_data', scale=options['scale'], seed=options['seed'], stdout=self.stderr)
+        # as deployed, models are built offline and not within the measured requests
+        call_command('build_recommender', stdout=self.stderr)
+        user = User.objects.order_by('id').first()
+        token, _ = Token.objects.get_or_create(user=user.basic_info)
+        client = Client(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        rng = random.Random(options['seed'])
+        results = {
+            'commit': current_commit(),
+            'database': connection.vendor,
+            'dataset': {model.__name__.lower(): model.objects.count() for model in (User, Recipe, Ingredient, Category)},
+            'requests': options['requests'],
+            'scenarios': {},
+        }
+        for name, next_url in scenarios(rng).items():
+            if options['only'] and not any(name.startswith(prefix) for prefix in options['only']):
+                continue
+            results['scenarios'][name] = measure(client, next_url, options['requests'], options['warmup'])
+            if name in CACHED_SCENARIOS:
+                results['scenarios'][name + '_warm'] = measure(
+                    client, next_url, options['requests'], options['warmup'], cold=False)
+            for measured in (name, name + '_warm'):
+                if measured in results['scenarios']:
+                    self.stderr.write('{}: p50 {p50_ms} ms, p95 {p95_ms} ms'.format(
+                        measured, **results['scenarios'][measured]))
+        return results
+
+    def compare(self, baseline, results):
+        for name, result in results['scenarios'].items():
+            before = baseline.get('scenarios', {}).get(name)
+            if before is None:
+                continue
+            changes = ', '.join('{} {:+.0%}'.format(key, result[key] / before[key] - 1)
+                                for key in ('p50_ms', 'p95_ms') if before[key])
+            self.stderr.write('{}: {}'.format(name, changes))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from Recipes.recommender.collaborative import fit_model
+from Recipes.recommender.features import get_store
+from Recipes.recommender.index import build_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds recommender feature matrix and nearest neighbours index and refits the collaborative model '
+            'from database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=('features', 'collaborative'), help='Build only one of the models.')
+
+    def handle(self, *args, **options):
+        if options['only'] != 'collaborative':
+            store = get_store()
+            store.build()
+            self.stdout.write('Built features of {} recipes.'.format(len(store.recipe_rows)))
+            index, _ = build_index()
+            self.stdout.write('Built {} index.'.format(index.name))
+        if options['only'] != 'features':
+            model = fit_model()
+            self.stdout.write('Fitted {} factors of {} recipes.'.format(*model.recipe_factors.shape[::-1]))
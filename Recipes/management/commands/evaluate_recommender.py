@@ -0,0 +1,196 @@
+import json
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from Recipes.management.commands.benchmark import current_commit, PERCENTILES
+from Recipes.models import User, Recipe, Rating
+from Recipes.recommender import ENGINES, blend_scores, default_blend, recommend_ids
+from Recipes.recommender.collaborative import CollaborativeModel, interaction_matrix, interaction_weight
+from Recipes.recommender.features import get_store, reset_store
+from Recipes.recommender.index import get_index, reset_index
+
+MEMORY_SAMPLE = 100  # users whose queries are replayed again under tracemalloc
+
+
+def split_by_user(rows, test_share):
+    """
+    Rows of every user ordered by id, the latest `test_share` of them (at least one, but never all)
+    held out. Neither table has a timestamp, ids grow with time.
+    """
+    order = np.lexsort((np.arange(len(rows)), rows[:, 0]))
+    rows = rows[order]
+    _, starts, counts = np.unique(rows[:, 0], return_index=True, return_counts=True)
+    rank = np.arange(len(rows)) - np.repeat(starts, counts)
+    count = np.repeat(counts, counts)
+    held_out = rank >= count - np.minimum(count - 1, np.ceil(count * test_share))
+    return rows[~held_out], rows[held_out]
+
+
+def split_history(test_share):
+    """Ratings (user, recipe, score) and favourites (user, recipe) before and after the split."""
+    ratings = np.array(list(Rating.objects.order_by('id').values_list('user_id', 'recipe_id', 'score')),
+                       dtype=np.int64).reshape(-1, 3)
+    favourites = np.array(list(User.favourite_recipes.through.objects.order_by('id').values_list(
+        'user_id', 'recipe_id')), dtype=np.int64).reshape(-1, 2)
+    (train_ratings, test_ratings), (train_favourites, test_favourites) = (
+        split_by_user(ratings, test_share), split_by_user(favourites, test_share))
+    return (train_ratings, train_favourites), (test_ratings, test_favourites)
+
+
+def user_histories(ratings, favourites):
+    """User -> recipe id -> interaction weight, and user -> favourite recipe ids in order."""
+    interactions, user_favourites = {}, {}
+    for user_id, recipe_id, score in ratings.tolist():
+        interactions.setdefault(user_id, {})[recipe_id] = interaction_weight(score)
+    for user_id, recipe_id in favourites.tolist():
+        interactions.setdefault(user_id, {})[recipe_id] = interaction_weight(favourite=True)
+        user_favourites.setdefault(user_id, []).append(recipe_id)
+    return interactions, user_favourites
+
+
+def relevant_recipes(ratings, favourites, min_score):
+    """User -> recipes the user liked after the split: favourites and ratings of at least `min_score`."""
+    relevant = {}
+    for user_id, recipe_id, score in ratings.tolist():
+        if score >= min_score:
+            relevant.setdefault(user_id, set()).add(recipe_id)
+    for user_id, recipe_id in favourites.tolist():
+        relevant.setdefault(user_id, set()).add(recipe_id)
+    return relevant
+
+
+def evaluate(recommend, users, relevant, k, n_recipes):
+    """Precision and recall at k, catalog coverage, latency percentiles and peak memory of one engine."""
+    precision, recall, latencies, recommended = [], [], [], set()
+    for user_id in users:
+        started = time.perf_counter()
+        recipe_ids = recommend(user_id)[:k]
+        latencies.append(time.perf_counter() - started)
+        hits = len(relevant[user_id].intersection(recipe_ids))
+        precision.append(hits / k)
+        recall.append(hits / len(relevant[user_id]))
+        recommended.update(recipe_ids)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for user_id in users[:MEMORY_SAMPLE]:
+        recommend(user_id)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    latencies = np.array(latencies or [0.0]) * 1000
+    return {
+        'precision_at_k': round(float(np.mean(precision or [0.0])), 4),
+        'recall_at_k': round(float(np.mean(recall or [0.0])), 4),
+        'coverage': round(len(recommended) / max(n_recipes, 1), 4),
+        **{'p{}_ms'.format(percentile): round(float(value), 3)
+           for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))},
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Replays the later part of the rating and favourite history against the recommender engines '
+            'trained on the earlier part. Prints precision and recall at k, coverage, latency and memory as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--k', type=int, default=10)
+        parser.add_argument('--test-share', type=float, default=0.2,
+                            help='Share of the latest ratings and favourites of every user held out for evaluation.')
+        parser.add_argument('--min-score', type=int, default=4, help='Held out ratings at least this good are hits.')
+        parser.add_argument('--engines', nargs='*', choices=ENGINES, default=list(ENGINES))
+        parser.add_argument('--blend', type=float, help='Share of the collaborative score in hybrid.')
+        parser.add_argument('--scales', nargs='*', type=float,
+                            help='Evaluate on datasets of these sizes generated in the test database '
+                                 '(see generate_test_data) instead of the current database.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write results to this file instead of standard output.')
+
+    def handle(self, *args, **options):
+        results = {
+            'commit': current_commit(),
+            'database': connection.vendor,
+            'k': options['k'],
+            'test_share': options['test_share'],
+            'runs': [],
+        }
+        # models of the evaluation must not replace the ones of the running site
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(RECOMMENDER_DIR=directory + '/recommender',
+                                  CATALOG_VERSIONS_DIR=directory + '/versions'):
+            if options['scales']:
+                old_name = connection.settings_dict['NAME']
+                connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    for scale in options['scales']:
+                        call_command('generate_test_data', scale=scale, seed=options['seed'], stdout=self.stderr)
+                        results['runs'].append(dict(self.run(options), scale=scale))
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+            else:
+                results['runs'].append(self.run(options))
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run(self, options):
+        k = options['k']
+        blend = default_blend() if options['blend'] is None else options['blend']
+        train, test = split_history(options['test_share'])
+        interactions, favourites = user_histories(*train)
+        relevant = relevant_recipes(*test, min_score=options['min_score'])
+        for user_id, recipe_ids in list(relevant.items()):
+            # liking a recipe again is no discovery
+            relevant[user_id] = recipe_ids - set(interactions.get(user_id, ()))
+        users = sorted(user_id for user_id in relevant if relevant[user_id] and user_id in interactions)
+        n_recipes = Recipe.objects.count()
+
+        for reset in (reset_store, reset_index):
+            reset()
+        started = time.perf_counter()
+        get_store().build()
+        index, snapshot = get_index()
+        content_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        model = CollaborativeModel.fit(*interaction_matrix(*train))
+        collaborative_seconds = time.perf_counter() - started
+
+        def unseen(user_id, recipe_ids):
+            return [recipe_id for recipe_id in recipe_ids if recipe_id not in interactions[user_id]]
+
+        engines = {
+            'content': lambda user_id: unseen(user_id, recommend_ids(favourites.get(user_id, []), index, snapshot)),
+            'collaborative': lambda user_id: model.recommend(interactions[user_id], k),
+            'hybrid': lambda user_id: blend_scores(interactions[user_id], model, k, blend),
+        }
+        run = {
+            'dataset': {
+                'users': User.objects.count(),
+                'recipes': n_recipes,
+                'train': {'ratings': len(train[0]), 'favourites': len(train[1])},
+                'test': {'ratings': len(test[0]), 'favourites': len(test[1])},
+                'evaluated_users': len(users),
+            },
+            'fit_seconds': {'content': round(content_seconds, 3), 'collaborative': round(collaborative_seconds, 3)},
+            'model_bytes': {
+                'content': int(sum(array.nbytes for array in (snapshot[0].data, snapshot[0].indices, snapshot[0].indptr))),
+                'collaborative': int(model.recipe_factors.nbytes),
+            },
+            'engines': {},
+        }
+        for name in options['engines']:
+            run['engines'][name] = evaluate(engines[name], users, relevant, k, n_recipes)
+            self.stderr.write('{}: precision@{k} {precision_at_k}, recall@{k} {recall_at_k}, coverage {coverage}, '
+                              'p95 {p95_ms} ms'.format(name, k=k, **run['engines'][name]))
+        return run
@@ -1,12 +1,18 @@
 import json
 import os
-from copy import copy
-from datetime import datetime
+import random
+import time
+from datetime import date, datetime
 
 from django.contrib.auth import get_user_model
-from Recipes.models import User, Recipe, Category, Ingredient, Rating, Comment
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
-import random
+from django.db import connection, models
+from django.utils import timezone
+
+from Recipes import aggregates, replacements as replacement_graph, versions
+from Recipes.importer import catalog_changed, insert_rows, resolve_names
+from Recipes.models import User, Recipe, Category, Ingredient, Rating, Comment, UserRecommendation
 
 MODULE_PATH = os.path.dirname(__file__)
 RECIPES_PATH = os.path.join(MODULE_PATH, 'recipes.json')
@@ -19,6 +25,10 @@ DEVELOPER_PASSWORD = 'apsi-developer'
 DEVELOPER_ACTIVE = True
 SEED = 1
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+BIO = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, '
+       'sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. '
+       'Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi '
+       'ut aliquip ex ea commodo consequat.')
 RECIPES_FREQUENCIES = {
     0: 9,
     1: 4,
@@ -34,170 +44,252 @@ RECIPES_DIFFICULTY = {
     for ningrs, diff in {(0, 6): 1, (7, 9): 2, (10, 11): 3, (12, 13): 4, (14, 36): 5}.items()
     for ningr in range(ningrs[0], ningrs[1] + 1)
 }
+CHUNK = 10000  # rows generated and inserted at once
+
+
+def delete_rows(queryset):
+    """Deletes rows of the queryset in one statement, without cascades and signals. Returns their number."""
+    model = queryset.model
+    select, params = queryset.values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+            connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(model._meta.pk.column),
+            select), params)
+        return cursor.rowcount
 
 
 class Command(BaseCommand):
-    help = 'Populates database with test data.'
+    help = 'Populates database with test data, --scale multiplies the sample users and recipes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1,
+                            help='Multiplier of the number of sample users and recipes.')
+        parser.add_argument('--users', type=int, help='Number of users, overrides --scale.')
+        parser.add_argument('--recipes', type=int, help='Number of recipes, overrides --scale.')
+        parser.add_argument('--seed', type=int, default=SEED)
 
     def handle(self, *args, **options):
-        random.seed(SEED)
+        self.random = random.Random(options['seed'])
         with open(RECIPES_PATH) as recipes_file:
             recipes = json.load(recipes_file)
-            random.shuffle(recipes)
+            self.random.shuffle(recipes)
         with open(USERS_PATH) as users_file:
             users = json.load(users_file)
-            random.shuffle(users)
+            self.random.shuffle(users)
         with open(ACTIVITIES_PATH) as activities_file:
             activities = json.load(activities_file)
-            random.shuffle(activities)
+            self.random.shuffle(activities)
         with open(REPLACEMENTS_PATH) as replacements_file:
             replacements = json.load(replacements_file)
-            # random.shuffle(replacements)
-
-        # users
-        User.objects.exclude(nickname='developer').delete()
-        get_user_model().objects.filter(is_superuser=False).exclude(username='developer').delete()
-        django_users = []
-        for user in users:
-            new_user = User.objects.create(
-                nickname=user['username'],
-                bio='Lorem ipsum dolor sit amet, consectetur adipiscing elit, '
-                    'sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. '
-                    'Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi '
-                    'ut aliquip ex ea commodo consequat.',
-                basic_info=get_user_model().objects.create_user(
-                    username=user['username'],
-                    date_joined=datetime.strptime(user['date_joined'], DATETIME_FORMAT),
-                    email=user['email'],
+
+        n_users = options['users'] or max(int(len(users) * options['scale']), 1)
+        n_recipes = options['recipes'] or max(int(len(recipes) * options['scale']), 1)
+        started = time.monotonic()
+
+        with self.step('Removed old data') as done:
+            done(self.clear())
+        with self.step('Created users') as done:
+            user_ids = self.create_users(users, n_users)
+            done(len(user_ids))
+        with self.step('Created ingredients and categories') as done:
+            # sorted, so the same seed gives the same ids
+            ingredient_ids = resolve_names(Ingredient, sorted(
+                {name for recipe in recipes for name in recipe['ingredients']} |
+                {name for group in replacements['full'] for name in group} |
+                {name for ingredient, names in replacements['directed'].items() for name in [ingredient] + names}))
+            category_ids = resolve_names(Category, sorted({name for recipe in recipes for name in recipe['categories']}))
+            done(len(ingredient_ids) + len(category_ids))
+        with self.step('Created recipes') as done:
+            recipe_ids, authors = self.create_recipes(recipes, n_recipes, user_ids, ingredient_ids, category_ids)
+            done(len(recipe_ids))
+        with self.step('Created favourites, ratings and comments') as done:
+            done(self.create_activities(activities, user_ids, recipe_ids, authors))
+        with self.step('Created replacements') as done:
+            done(self.create_replacements(replacements, ingredient_ids))
+        with self.step('Updated recipe statistics and search structures') as done:
+            # rows were inserted in bulk, no signal kept these up to date
+            aggregates.reconcile()
+            catalog_changed()
+            versions.bump(replacement_graph.VERSION_NAME)
+            done(n_recipes)
+
+        self.stdout.write('Generated {} users and {} recipes in {:.1f}s.'.format(
+            n_users, n_recipes, time.monotonic() - started))
+
+    def step(self, name):
+        command = self
+
+        class Step:
+            def __enter__(self):
+                self.started = time.monotonic()
+                return self.done
+
+            def done(self, count):
+                self.count = count
+
+            def __exit__(self, *exc_info):
+                if exc_info[0] is None:
+                    command.stdout.write('{}: {} rows in {:.1f}s'.format(
+                        name, self.count, time.monotonic() - self.started))
+
+        return Step()
+
+    def progress(self, name, done, total):
+        if total > CHUNK:
+            self.stdout.write('  {} {}/{}'.format(name, done, total))
+
+    @staticmethod
+    def clear():
+        # plain DELETEs: deleting through the ORM would load every row and send signals for it
+        removed = 0
+        for model in (Rating, Comment, UserRecommendation, User.favourite_recipes.through,
+                      Recipe.categories.through, Recipe.ingredients.through, Ingredient.replacements.through,
+                      Recipe, Ingredient, Category):
+            removed += delete_rows(model.objects.all())
+        removed += delete_rows(User.objects.exclude(nickname=DEVELOPER_NICKNAME))
+        base_users = get_user_model().objects.filter(is_superuser=False).exclude(username=DEVELOPER_NICKNAME)
+        # tokens, admin log entries, groups and permissions of the users go first
+        for relation in get_user_model()._meta.related_objects:
+            if relation.on_delete is models.CASCADE:
+                delete_rows(relation.related_model.objects.filter(**{relation.field.name + '__in': base_users}))
+        removed += delete_rows(base_users)
+        return removed
+
+    def create_users(self, users, n_users):
+        # hashing is deliberately slow, every user gets the same hash
+        password = make_password(DEVELOPER_PASSWORD)
+        joined = [timezone.make_aware(datetime.strptime(user['date_joined'], DATETIME_FORMAT)) for user in users]
+        user_ids = []
+        for start in range(0, n_users, CHUNK):
+            basic_users, nicknames = [], []
+            for i in range(start, min(start + CHUNK, n_users)):
+                copy, sample = divmod(i, len(users))
+                user = users[sample]
+                username = user['username'] if copy == 0 else '{}-{}'.format(user['username'], copy)
+                local, _, domain = user['email'].partition('@')
+                basic_users.append(get_user_model()(
+                    username=username,
+                    password=password,
+                    date_joined=joined[sample],
+                    email=user['email'] if copy == 0 else '{}+{}@{}'.format(local, copy, domain),
                     first_name=user['name'],
                     last_name=user['surname'],
-                )
-            )
-            django_users.append(new_user)
-            new_user.basic_info.set_password(DEVELOPER_PASSWORD)
-            new_user.basic_info.save()
+                ))
+                nicknames.append(username)
+            basic_ids = insert_rows(get_user_model(), basic_users)
+            user_ids.extend(insert_rows(User, [User(nickname=nickname, bio=BIO, basic_info_id=basic_id)
+                                               for nickname, basic_id in zip(nicknames, basic_ids)]))
+            self.progress('users', len(user_ids), n_users)
 
         if DEVELOPER_ACTIVE:
-            if not User.objects.filter(nickname='developer'):
-                new_user = User.objects.create(
+            if not User.objects.filter(nickname=DEVELOPER_NICKNAME):
+                User.objects.create(
                     nickname=DEVELOPER_NICKNAME,
                     bio='',
-                    basic_info=get_user_model().objects.create_user(
+                    basic_info=get_user_model().objects.create(
                         username=DEVELOPER_NICKNAME,
+                        password=password,
                         email='developer@mail.com',
                         first_name='Apsi',
                         last_name='Developer',
                     )
                 )
-                new_user.basic_info.set_password(DEVELOPER_PASSWORD)
-                new_user.basic_info.save()
         else:
-            User.objects.filter(nickname='developer').delete()
-            get_user_model().objects.filter(username='developer').delete()
-
-        # recipes, ingredients, categories
-        Ingredient.objects.all().delete()
-        Recipe.objects.all().delete()
-        Category.objects.all().delete()
-        ingredients_mapping = {}
-        categories_mapping = {}
-        django_recipes = []
-        for recipe in recipes:
-            django_igredients = []
-            for ingredient_name in recipe['ingredients']:
-                if ingredient_name in ingredients_mapping:
-                    django_igredients.append(ingredients_mapping[ingredient_name])
-                else:
-                    new_ingredient = Ingredient.objects.create(name=ingredient_name)
-                    django_igredients.append(new_ingredient)
-                    ingredients_mapping[ingredient_name] = new_ingredient
-
-            django_categories = []
-            for category_name in recipe['categories']:
-                if category_name in categories_mapping:
-                    django_categories.append(categories_mapping[category_name])
-                else:
-                    new_category = Category.objects.create(name=category_name)
-                    django_categories.append(new_category)
-                    categories_mapping[category_name] = new_category
-
-            new_recipe = Recipe.objects.create(
-                title=recipe['title'],
-                description=recipe['instructions'],
-                difficulty=RECIPES_DIFFICULTY.get(len(recipe['ingredients']), 3),
-                time=random.randint(20, 150)
-            )
-            new_recipe.ingredients.set(django_igredients)
-            new_recipe.categories.set(django_categories)
-            django_recipes.append(new_recipe)
-
-        # assign recipes to users
-        current_user_pointer = 0
-        current_recipe_pointer = 0
+            User.objects.filter(nickname=DEVELOPER_NICKNAME).delete()
+            get_user_model().objects.filter(username=DEVELOPER_NICKNAME).delete()
+        return user_ids
+
+    def create_recipes(self, recipes, n_recipes, user_ids, ingredient_ids, category_ids):
+        # every copy of the sample users writes a copy of the sample recipes: a few users write most of them
+        sample_authors, sample_users = [], 0
         for recipes_per_user, users_per_frequency in RECIPES_FREQUENCIES.items():
             for _ in range(users_per_frequency):
-                for _ in range(recipes_per_user):
-                    recipe = django_recipes[current_recipe_pointer]
-                    user = django_users[current_user_pointer]
-                    recipe.user = user
-                    recipe.save()
-                    current_recipe_pointer += 1
-                current_user_pointer += 1
-
-        for user in django_users:
-            other_users_recipes = list(filter(lambda r: r.user != user, django_recipes))
-            random.shuffle(other_users_recipes)
-            favs = other_users_recipes[:random.randint(*FAVOURITE_PER_USER)]
-            user.favourite_recipes.set(favs)
-
-            other_users_recipes = set(other_users_recipes) - set(favs)
-            recipes_with_activity = list(other_users_recipes)[:random.randint(*ACTIVITY_PER_USER)]
-            for recipe in recipes_with_activity:
-                activity = random.choice(activities)
-                random_score = random.randint(*activity['rating'])
-                Rating.objects.create(user=user, recipe=recipe, score=random_score)
-                if activity['comment'] is not None:
-                    Comment.objects.create(user=user, recipe=recipe, text=activity['comment'])
+                sample_authors.extend([sample_users] * recipes_per_user)
+                sample_users += 1
 
-            user.save()
+        recipe_ids, authors = [], []
+        for start in range(0, n_recipes, CHUNK):
+            rows, tags = [], []
+            for i in range(start, min(start + CHUNK, n_recipes)):
+                copy, recipe = divmod(i, len(recipes))
+                sample = recipes[recipe]
+                author = None
+                if recipe < len(sample_authors):
+                    author = (sample_authors[recipe] + copy * sample_users) % len(user_ids)
+                rows.append(Recipe(
+                    title=sample['title'] if copy == 0 else '{} ({})'.format(sample['title'], copy + 1),
+                    description=sample['instructions'],
+                    difficulty=RECIPES_DIFFICULTY.get(len(sample['ingredients']), 3),
+                    time=self.random.randint(20, 150),
+                    user_id=user_ids[author] if author is not None else None,
+                ))
+                authors.append(author)
+                tags.append(sample)
+            ids = insert_rows(Recipe, rows)
+            insert_values(Recipe.ingredients.through, ('recipe', 'ingredient'), [
+                (recipe_id, ingredient_ids[name]) for recipe_id, sample in zip(ids, tags)
+                for name in set(sample['ingredients'])])
+            insert_values(Recipe.categories.through, ('recipe', 'category'), [
+                (recipe_id, category_ids[name]) for recipe_id, sample in zip(ids, tags)
+                for name in set(sample['categories'])])
+            recipe_ids.extend(ids)
+            self.progress('recipes', len(recipe_ids), n_recipes)
+        return recipe_ids, authors
 
-        # import networkx as nx
-        # import matplotlib.pyplot as plt
-        # g = nx.DiGraph()
+    def create_activities(self, activities, user_ids, recipe_ids, authors):
+        own_recipes = max(RECIPES_FREQUENCIES)
+        favourites, ratings, comments = [], [], []
+        count = 0
+        today = date.today()
+        for user, user_id in enumerate(user_ids):
+            n_favourites = self.random.randint(*FAVOURITE_PER_USER)
+            n_activities = self.random.randint(*ACTIVITY_PER_USER)
+            # a sample larger by the most recipes a user writes always has enough recipes of others
+            picked = self.random.sample(range(len(recipe_ids)),
+                                        min(len(recipe_ids), n_favourites + n_activities + own_recipes))
+            picked = [recipe for recipe in picked if authors[recipe] != user]
+            for recipe in picked[:n_favourites]:
+                favourites.append((user_id, recipe_ids[recipe]))
+            for recipe in picked[n_favourites:n_favourites + n_activities]:
+                activity = self.random.choice(activities)
+                ratings.append((user_id, recipe_ids[recipe], self.random.randint(*activity['rating'])))
+                if activity['comment'] is not None:
+                    comments.append((user_id, recipe_ids[recipe], activity['comment'], today))
 
+            if (user + 1) % CHUNK == 0 or user == len(user_ids) - 1:
+                count += insert_values(User.favourite_recipes.through, ('user', 'recipe'), favourites)
+                count += insert_values(Rating, ('user', 'recipe', 'score'), ratings)
+                count += insert_values(Comment, ('user', 'recipe', 'text', 'creation_date'), comments)
+                favourites, ratings, comments = [], [], []
+                self.progress('users with activities', user + 1, len(user_ids))
+        return count
+
+    def create_replacements(self, replacements, ingredient_ids):
+        # replacements are symmetrical, both directions of a pair have their own row
+        pairs = set()
         for group in replacements['full']:
             for ingredient_name in group:
-                if ingredient_name not in ingredients_mapping:
-                    ingredients_mapping[ingredient_name] = Ingredient.objects.create(
-                        name=ingredient_name
-                    )
-                # g.add_node(ingredient_name)
-            django_ingredient_group = [
-                ingredients_mapping[ingredient_name]
-                for ingredient_name in group
-            ]
-            for django_ingredient in django_ingredient_group:  # type: Ingredient
-                for django_ingredient2 in django_ingredient_group:
-                    if django_ingredient != django_ingredient2 and random.random() > 0.45:
-                        django_ingredient.replacements.add(django_ingredient2)
-                        # g.add_edge(django_ingredient.name, django_ingredient2.name)
-                django_ingredient.save()
-
+                for replacement_name in group:
+                    if ingredient_name != replacement_name and self.random.random() > 0.45:
+                        pairs.add((ingredient_ids[ingredient_name], ingredient_ids[replacement_name]))
         for ingredient_name, ingredient_replacements in replacements['directed'].items():
-            if ingredient_name not in ingredients_mapping:
-                ingredients_mapping[ingredient_name] = Ingredient.objects.create(
-                    name=ingredient_name
-                )
             for replacement_name in ingredient_replacements:
-                if replacement_name not in ingredients_mapping:
-                    ingredients_mapping[replacement_name] = Ingredient.objects.create(
-                        name=replacement_name
-                    )
-                ingr = ingredients_mapping[ingredient_name]
-                repl = ingredients_mapping[replacement_name]
-                ingr.replacements.add(repl)
-                ingr.save()
+                pairs.add((ingredient_ids[ingredient_name], ingredient_ids[replacement_name]))
+        pairs |= {(target, source) for source, target in pairs}
+
+        return insert_values(Ingredient.replacements.through, ('from_ingredient', 'to_ingredient'), sorted(pairs))
 
 
-        # nx.draw(g, with_labels=True, pos=nx.spring_layout(g, k=0.15, iterations=20))
-        # plt.show()
+def insert_values(model, fields, rows):
+    """Multi-row INSERTs of plain tuples, without building a model instance for every row."""
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(field).column) for field in fields)
+    placeholder = '({})'.format(', '.join(['%s'] * len(fields)))
+    per_statement = 999 // len(fields)  # SQLite's limit of query parameters
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), per_statement):
+            chunk = rows[start:start + per_statement]
+            cursor.execute('INSERT INTO {} ({}) VALUES {}'.format(
+                quote(model._meta.db_table), columns, ', '.join([placeholder] * len(chunk))),
+                [value for row in chunk for value in row])
+    return len(rows)
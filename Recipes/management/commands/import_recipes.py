@@ -0,0 +1,32 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Recipes.importer import BATCH_SIZE, import_recipes, read_records
+from Recipes.models import User
+
+
+class Command(BaseCommand):
+    help = 'Imports recipes from an NDJSON or JSON array file, "-" reads standard input.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Records per transaction.')
+        parser.add_argument('--user', help='Nickname of the author of imported recipes.')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(nickname=options['user']).first()
+            if user is None:
+                raise CommandError('No user {}.'.format(options['user']))
+
+        stream = sys.stdin.buffer if options['path'] == '-' else open(options['path'], 'rb')
+        try:
+            report = import_recipes(read_records(stream), user=user, batch_size=options['batch_size'])
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+        for error in report['errors']:
+            self.stderr.write('Record {record}: {errors}'.format(**error))
+        self.stdout.write('Imported {created} recipes, {failed} rejected.'.format(**report))
@@ -0,0 +1,29 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from Recipes.recommender.precomputed import precompute
+
+
+class Command(BaseCommand):
+    help = 'Computes recommendations of users whose stored ones are missing or older than the catalog.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--all', action='store_true', help='Recompute recommendations of every user.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running as a worker, checking for stale users every INTERVAL seconds.')
+
+    def handle(self, *args, **options):
+        only_stale = not options['all']
+        while True:
+            start = time.time()
+            written = precompute(options['batch_size'], options['processes'], only_stale,
+                                 stdout=self.stdout if options['verbosity'] > 1 else None)
+            self.stdout.write('Stored recommendations of {} users in {:.1f}s.'.format(written, time.time() - start))
+            if not options['interval']:
+                break
+            only_stale = True
+            time.sleep(options['interval'])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from Recipes import response_cache
+from Recipes.aggregates import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recomputes rating and comment counters of recipes from Rating and Comment tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('recipe_ids', nargs='*', type=int, help='Only these recipes, all by default.')
+
+    def handle(self, *args, **options):
+        updated = reconcile(options['recipe_ids'] or None)
+        if options['recipe_ids']:
+            response_cache.invalidate(response_cache.RECIPES, *map(response_cache.recipe_tag, options['recipe_ids']))
+        else:
+            response_cache.invalidate_catalog()
+        self.stdout.write('Reconciled {} recipes.'.format(updated))
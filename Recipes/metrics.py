@@ -0,0 +1,59 @@
+"""
+Prometheus metrics of the API and the recommender, exported by /metrics.
+
+Under gunicorn every worker writes its samples to files in `prometheus_multiproc_dir` (set by
+gunicorn.conf.py) and /metrics merges the files of all workers. Without the variable, metrics
+of the current process are exported.
+"""
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+MULTIPROCESS_DIR_ENV = 'prometheus_multiproc_dir'
+
+REQUEST_DURATION = Histogram(
+    'recipes_request_duration_seconds', 'Duration of requests.', ['route', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, float('inf')))
+REQUEST_QUERIES = Histogram(
+    'recipes_request_queries', 'SQL queries run by a request.', ['route'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, float('inf')))
+REQUEST_DB_DURATION = Histogram(
+    'recipes_request_db_seconds', 'Time requests spent waiting for the database.', ['route'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, float('inf')))
+REQUESTS_IN_PROGRESS = Gauge(
+    'recipes_requests_in_progress', 'Requests being processed.', multiprocess_mode='livesum')
+
+FEATURE_BUILD_DURATION = Histogram(
+    'recipes_feature_matrix_build_seconds', 'Full builds of the recommender feature matrix.',
+    buckets=(.1, .5, 1, 5, 10, 30, 60, 300, float('inf')))
+KNN_QUERY_DURATION = Histogram(
+    'recipes_knn_query_seconds', 'Nearest neighbour queries of one recommendation.', ['backend'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, float('inf')))
+# hit ratio: rate(..{result="hit"}) / rate(..) summed over results
+RECOMMENDATION_CACHE = Counter(
+    'recipes_recommendation_cache_total', 'Lookups of precomputed recommendations.', ['result'])
+RESPONSE_CACHE = Counter(
+    'recipes_response_cache_total', 'Lookups of cached responses, see Recipes.response_cache.', ['route', 'result'])
+
+WORKERS = Gauge('recipes_gunicorn_workers', 'Live gunicorn workers.', multiprocess_mode='livesum')
+WORKERS_STARTED = Counter('recipes_gunicorn_workers_started_total', 'Gunicorn workers started.')
+WORKER_EXITS = Counter('recipes_gunicorn_worker_exits_total', 'Gunicorn workers exited.')
+WORKER_TIMEOUTS = Counter('recipes_gunicorn_worker_timeouts_total', 'Gunicorn workers killed on timeout.')
+
+
+def observe_request(route, method, duration, queries, db_duration):
+    route = route or 'unmatched'
+    REQUEST_DURATION.labels(route, method).observe(duration)
+    REQUEST_QUERIES.labels(route).observe(queries)
+    REQUEST_DB_DURATION.labels(route).observe(db_duration)
+
+
+def export():
+    """Metrics in Prometheus text format, of all workers in multiprocess mode."""
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
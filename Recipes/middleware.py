@@ -0,0 +1,186 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.renderers import JSONRenderer
+
+from Recipes import metrics
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_local = threading.local()
+
+
+class RequestTimings:
+    """Queries and timings of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.render = 0.0
+        self.view = None
+        self.view_started = None
+        self.shapes = Counter()  # SQL with placeholders -> executions
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.queries += 1
+            self.shapes[sql] += 1
+
+    def repeated_queries(self, threshold):
+        return [(sql, count) for sql, count in self.shapes.most_common(3) if count > threshold]
+
+
+class RollingHistogram:
+    """
+    Request durations of the last `window` seconds in fixed buckets (BUCKETS_MS).
+
+    The window is split in `slots`, a slot older than the window is cleared when it is reused, so
+    recording is a bisect and an increment.
+    """
+
+    def __init__(self, window=600, slots=10):
+        self.slot_length = window / slots
+        self.counts = [[0] * len(BUCKETS_MS) for _ in range(slots)]
+        self.sums = [0.0] * slots
+        self.slot_ids = [None] * slots
+        self._lock = threading.Lock()
+
+    def record(self, duration_ms, now=None):
+        slot_id = int((now if now is not None else time.monotonic()) // self.slot_length)
+        slot = slot_id % len(self.counts)
+        with self._lock:
+            if self.slot_ids[slot] != slot_id:
+                self.slot_ids[slot] = slot_id
+                self.counts[slot] = [0] * len(BUCKETS_MS)
+                self.sums[slot] = 0.0
+            self.counts[slot][bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+            self.sums[slot] += duration_ms
+
+    def snapshot(self, now=None):
+        """Counts per bucket and sum of durations within the window."""
+        oldest = int((now if now is not None else time.monotonic()) // self.slot_length) - len(self.counts) + 1
+        counts, total = [0] * len(BUCKETS_MS), 0.0
+        with self._lock:
+            for slot, slot_id in enumerate(self.slot_ids):
+                if slot_id is not None and slot_id >= oldest:
+                    counts = [count + slot_count for count, slot_count in zip(counts, self.counts[slot])]
+                    total += self.sums[slot]
+        return counts, total
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def route_histograms():
+    """Route -> RollingHistogram of this process."""
+    with _histograms_lock:
+        return dict(_histograms)
+
+
+def _histogram(route):
+    histogram = _histograms.get(route)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(route, RollingHistogram())
+    return histogram
+
+
+class TimingMiddleware:
+    """
+    Measures every request: queries, time in the database, in the view and in rendering the response,
+    and the total.
+
+    Timings are sent in a Server-Timing header, logged as one JSON line to `Recipes.middleware`
+    and kept in a rolling histogram per route (`route_histograms`) and in Recipes.metrics. A request running the same
+    SQL more than TIMING_N_PLUS_ONE_THRESHOLD times is logged as a warning, it is most likely
+    loading a relation row by row. Should be the first middleware, so the total covers the others.
+
+    View time includes the serializers turning rows into response data. Rendering that data is timed
+    by TimedJSONRenderer, views caching their responses render within the view.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = _local.timings = RequestTimings()
+        metrics.REQUESTS_IN_PROGRESS.inc()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.execute))
+                response = self.get_response(request)
+        finally:
+            _local.timings = None
+            metrics.REQUESTS_IN_PROGRESS.dec()
+        total = (time.perf_counter() - timings.started) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else None
+        if route is not None:
+            _histogram(route).record(total)
+        metrics.observe_request(route, request.method, total / 1000, timings.queries, timings.db)
+
+        entries = [('db', timings.db * 1000, '{} queries'.format(timings.queries))]
+        if timings.view is not None:
+            entries.append(('view', timings.view * 1000, None))
+        entries.append(('render', timings.render * 1000, None))
+        entries.append(('total', total, None))
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.1f}'.format(name, duration) + (';desc="{}"'.format(desc) if desc else '')
+            for name, duration, desc in entries)
+
+        repeated = timings.repeated_queries(getattr(settings, 'TIMING_N_PLUS_ONE_THRESHOLD', 10))
+        for sql, count in repeated:
+            logger.warning('N+1 queries on %s: %d times %s', route or request.path, count, sql)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'route': route,
+                'status': response.status_code,
+                'queries': timings.queries,
+                'repeated_queries': max((count for _, count in repeated), default=0),
+                **{name + '_ms': round(duration, 2) for name, duration, _ in entries},
+            }))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings.view_started = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after this, view time ends when the view returns its data
+        timings = getattr(_local, 'timings', None)
+        if timings is not None and timings.view_started is not None:
+            timings.view = time.perf_counter() - timings.view_started
+        return response
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSONRenderer adding the time it takes to TimingMiddleware's render timing of the request."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        started = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type, renderer_context)
+        finally:
+            timings = getattr(_local, 'timings', None)
+            if timings is not None:
+                timings.render += time.perf_counter() - started
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.7 on 2026-10-18 10:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Recipes', '0009_Adding_replacements'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRecommendation',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='Recipes.User')),
+                ('recipe_ids', models.TextField(blank=True)),
+                ('catalog_version', models.BigIntegerField()),
+                ('computed', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 2.2.7 on 2026-10-18 10:52
+
+from django.db import migrations, models
+from django.db.models import Count, FloatField, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+
+def fill_aggregates(apps, schema_editor):
+    Recipe, Rating, Comment = (apps.get_model('Recipes', name) for name in ('Recipe', 'Rating', 'Comment'))
+
+    def aggregate(model, expression):
+        rows = model.objects.filter(recipe=OuterRef('pk')).order_by().values('recipe')
+        return Coalesce(Subquery(rows.annotate(value=expression).values('value'), output_field=IntegerField()),
+                        Value(0))
+
+    # one UPDATE of all recipes, same expressions as Recipes.aggregates.reconcile
+    rating_sum, rating_count = aggregate(Rating, Sum('score')), aggregate(Rating, Count('id'))
+    Recipe.objects.update(
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        rating_average=Cast(rating_sum, FloatField()) / NullIf(rating_count, 0),
+        comment_count=aggregate(Comment, Count('id')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Recipes', '0010_user_recommendation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_average',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_aggregates, migrations.RunPython.noop),
+    ]
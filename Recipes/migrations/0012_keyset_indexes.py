@@ -0,0 +1,21 @@
+# Generated by Django 2.2.7 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Recipes', '0011_recipe_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['creation_date', 'id'], name='Recipes_com_creatio_f64126_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['creation_date', 'id'], name='Recipes_rec_creatio_2d11e4_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.2.7 on 2026-10-18 10:54
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+TRIGGER_SQL = """
+CREATE FUNCTION recipes_recipe_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER recipes_recipe_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON "Recipes_recipe"
+    FOR EACH ROW EXECUTE PROCEDURE recipes_recipe_search_vector_update();
+
+UPDATE "Recipes_recipe" SET title = title;
+
+CREATE INDEX recipes_recipe_search_vector_gin ON "Recipes_recipe" USING gin (search_vector);
+"""
+
+DROP_TRIGGER_SQL = """
+DROP INDEX IF EXISTS recipes_recipe_search_vector_gin;
+DROP TRIGGER IF EXISTS recipes_recipe_search_vector_trigger ON "Recipes_recipe";
+DROP FUNCTION IF EXISTS recipes_recipe_search_vector_update();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    # other databases search without the vector, see Recipes.search
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(TRIGGER_SQL)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_TRIGGER_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Recipes', '0012_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def remove_duplicate_ratings(apps, schema_editor):
+    # the latest rating of a user for a recipe wins, counters of the recipes are recomputed
+    Rating = apps.get_model('Recipes', 'Rating')
+    Recipe = apps.get_model('Recipes', 'Recipe')
+    duplicates = (Rating.objects.order_by().values('user', 'recipe')
+                  .annotate(ratings=Count('id'), latest=Max('id')).filter(ratings__gt=1))
+    recipe_ids = set()
+    for duplicate in duplicates:
+        Rating.objects.filter(user=duplicate['user'], recipe=duplicate['recipe']).exclude(
+            id=duplicate['latest']).delete()
+        recipe_ids.add(duplicate['recipe'])
+    ratings = Recipe.objects.filter(pk__in=recipe_ids).annotate(ratings_sum=Sum('rating__score'),
+                                                                ratings_count=Count('rating'))
+    for recipe in ratings:
+        Recipe.objects.filter(pk=recipe.pk).update(
+            rating_sum=recipe.ratings_sum, rating_count=recipe.ratings_count,
+            rating_average=recipe.ratings_sum / recipe.ratings_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Recipes', '0013_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_ratings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='rating_user_recipe_unique'),
+        ),
+    ]
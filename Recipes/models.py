@@ -1,7 +1,7 @@
 from django.contrib.auth.models import User as BasicUser
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models import Avg
 
 
 class User(models.Model):
@@ -40,10 +40,29 @@ class Recipe(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
     categories = models.ManyToManyField(Category, blank=True)
     ingredients = models.ManyToManyField(Ingredient)
+    # kept up to date by Recipes.aggregates, never set directly
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_average = models.FloatField(null=True, blank=True, db_index=True)
+    comment_count = models.IntegerField(default=0)
+    # filled by a database trigger on PostgreSQL, see Recipes.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    AGGREGATE_FIELDS = ('rating_sum', 'rating_count', 'rating_average', 'comment_count')
+
+    class Meta:
+        indexes = [models.Index(fields=['creation_date', 'id'])]
+
+    def save(self, *args, **kwargs):
+        # aggregates are updated in place, writing back the loaded values would undo concurrent updates
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.AGGREGATE_FIELDS]
+        super().save(*args, **kwargs)
 
     @property
     def rating(self):
-        return self.rating_set.all().aggregate(Avg('score'))['score__avg'] or 'Recipe haven`t been rated yet.'
+        return self.rating_average or 'Recipe haven`t been rated yet.'
 
     @property
     def comments(self):
@@ -51,11 +70,11 @@ class Recipe(models.Model):
 
     @property
     def number_of_comments(self):
-        return Comment.objects.filter(recipe=self).count()
+        return self.comment_count
 
     @property
     def number_of_ratings(self):
-        return Rating.objects.filter(recipe=self).count()
+        return self.rating_count
 
     def __str__(self):
         return self.title
@@ -67,8 +86,27 @@ class Comment(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [models.Index(fields=['creation_date', 'id'])]
+
 
 class Rating(models.Model):
     score = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(5)])
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
+
+    class Meta:
+        # one rating per user and recipe, saved by an upsert (see Recipes.interactions)
+        constraints = [models.UniqueConstraint(fields=['user', 'recipe'], name='rating_user_recipe_unique')]
+
+
+class UserRecommendation(models.Model):
+    """Precomputed recommendations, removed when user's favourites change."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    recipe_ids = models.TextField(blank=True)  # comma separated, in order of recommendation
+    catalog_version = models.BigIntegerField()
+    computed = models.DateTimeField(auto_now=True)
+
+    @property
+    def recipes(self):
+        return [int(recipe_id) for recipe_id in self.recipe_ids.split(',') if recipe_id]
@@ -0,0 +1,157 @@
+import base64
+import bisect
+import json
+from functools import reduce
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class RankedResults:
+    """
+    Results ranked outside of the database: recipe ids in order and their ascending sort keys.
+
+    Rows are loaded from `queryset` one page at a time.
+    """
+
+    def __init__(self, queryset, ids, keys):
+        self.queryset = queryset
+        self.ids = ids
+        self.keys = keys
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pagination on the values of the last row instead of an offset, so every page costs the same.
+
+    The view's `keyset_ordering` (or `ordering` of this class) must end with a unique field. The
+    opaque `cursor` parameter encodes the ordering values of the last row of the previous page.
+    Response body stays a plain list, the next page is announced in a `Link` header. `amount` is an
+    alias of `page_size` kept for older clients. Larger pages than settings.RECIPES_MAX_PAGE_SIZE
+    are cut to it. `RankedResults` are paginated on their sort keys.
+    """
+    ordering = ('-creation_date', '-id')
+    page_size = 50
+    cursor_query_param = 'cursor'
+    page_size_query_params = ('page_size', 'amount')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = getattr(view, 'keyset_ordering', self.ordering)
+        self.page_size = self.get_page_size(request)
+        if isinstance(queryset, RankedResults):
+            return self.paginate_ranked(queryset)
+        self.model = queryset.model
+        self.annotations = queryset.query.annotations
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(cursor))
+
+        page = list(queryset[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        page = page[:self.page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if self.has_next else None
+        return page
+
+    def paginate_ranked(self, results):
+        cursor = self.load_cursor(self.request)
+        try:
+            start = bisect.bisect_right(results.keys, tuple(cursor)) if cursor is not None else 0
+        except TypeError:
+            raise NotFound('Invalid cursor.')
+        end = start + self.page_size
+        ids = [int(recipe_id) for recipe_id in results.ids[start:end]]
+        rows = results.queryset.in_bulk(ids)
+        self.has_next = end < len(results.ids)
+        self.next_cursor = self.dump_cursor(results.keys[end - 1]) if self.has_next else None
+        return [rows[recipe_id] for recipe_id in ids if recipe_id in rows]
+
+    @property
+    def max_page_size(self):
+        return getattr(settings, 'RECIPES_MAX_PAGE_SIZE', 500)
+
+    def get_page_size(self, request):
+        for param in self.page_size_query_params:
+            value = request.query_params.get(param)
+            if value and value.isnumeric() and int(value) > 0:
+                return min(int(value), self.max_page_size)
+        return self.page_size
+
+    def get_paginated_response(self, data):
+        headers = {}
+        next_link = self.get_next_link()
+        if next_link:
+            headers['Link'] = '<{}>; rel="next"'.format(next_link)
+        return Response(data, headers=headers)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, 'amount')
+        url = replace_query_param(url, 'page_size', self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    # cursors
+
+    def field_names(self):
+        return [name.lstrip('-') for name in self.ordering]
+
+    def output_field(self, name):
+        if name in self.annotations:
+            return self.annotations[name].output_field
+        return self.model._meta.get_field(name)
+
+    @staticmethod
+    def dump_cursor(values):
+        # decimals are written as strings, to_python of their field reads them back exactly
+        return base64.urlsafe_b64encode(json.dumps(list(values), default=str).encode()).decode()
+
+    def load_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+        except ValueError:
+            raise NotFound('Invalid cursor.')
+        if not isinstance(values, list):
+            raise NotFound('Invalid cursor.')
+        return values
+
+    def encode_cursor(self, row):
+        return self.dump_cursor([self.output_field(name).value_to_string(row) if name not in self.annotations
+                                 else getattr(row, name) for name in self.field_names()])
+
+    def decode_cursor(self, request):
+        values = self.load_cursor(request)
+        if values is None:
+            return None
+        try:
+            names = self.field_names()
+            if len(values) != len(names):
+                raise ValueError
+            return [self.output_field(name).to_python(value) for name, value in zip(names, values)]
+        except (ValueError, TypeError, ValidationError):
+            raise NotFound('Invalid cursor.')
+
+    def after(self, cursor):
+        """
+        Rows following the cursor: (a, b) > (x, y) as (a > x) or (a = x and b > y). The redundant
+        a >= x in front is what lets the database scan the (a, b) index as a range.
+        """
+        conditions = []
+        for position, name in enumerate(self.ordering):
+            lookup = '{}__{}'.format(name.lstrip('-'), 'lt' if name.startswith('-') else 'gt')
+            equal = {field: value for field, value in zip(self.field_names()[:position], cursor)}
+            conditions.append(Q(**equal) & Q(**{lookup: cursor[position]}))
+        first = self.ordering[0]
+        bound = Q(**{'{}__{}'.format(first.lstrip('-'), 'lte' if first.startswith('-') else 'gte'): cursor[0]})
+        return bound & reduce(lambda left, right: left | right, conditions)
@@ -0,0 +1,218 @@
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+from Recipes import metrics
+from Recipes.models import Recipe
+from Recipes.recommender.collaborative import get_collaborative_model, user_interactions
+from Recipes.recommender.index import get_index
+
+NEIGHBOURS_PER_RECIPE = 2
+ENGINES = ('content', 'collaborative', 'hybrid')
+RECOMMENDATIONS = 10
+MAX_RECOMMENDATIONS = 100
+# candidates scored by the engine for every recommendation asked for, diversification picks among them
+CANDIDATES_PER_RESULT = 5
+
+
+def propose_recipes(favourite_ids, fields=None):
+    """
+    Returns recipes similar to the favourite ones, in order of the favourites.
+
+    All neighbours are fetched with one query, `fields` limits the columns that are loaded.
+    """
+    return fetch_recipes(recommend_ids(favourite_ids), fields)
+
+
+def recommend_ids(favourite_ids, index=None, snapshot=None):
+    """Ids of recommended recipes, does not touch the database once the index is loaded."""
+    favourite_ids = list(favourite_ids)
+    if not favourite_ids:
+        return []
+
+    if index is None:
+        index, snapshot = get_index()
+    dataset, recipes_ids, recipes_rows = snapshot
+
+    rows = find_user_recipes(recipes_rows, favourite_ids)
+    if not rows:
+        return []
+
+    # all favourites are queried at once, dataset is already scaled
+    with metrics.KNN_QUERY_DURATION.labels(index.name).time():
+        dist, indices = index.query(dataset[rows], NEIGHBOURS_PER_RECIPE + 1)
+
+    recommended_ids = []
+    for neighbours, row in zip(indices, rows):
+        # the recipe itself is its own closest neighbour
+        neighbours = [neighbour for neighbour in neighbours if neighbour != row][:NEIGHBOURS_PER_RECIPE]
+        recommended_ids.extend(int(recipes_ids[neighbour]) for neighbour in neighbours)
+    return list(dict.fromkeys(recommended_ids))
+
+
+def default_engine():
+    return getattr(settings, 'RECOMMENDER_ENGINE', 'content')
+
+
+def default_blend():
+    return getattr(settings, 'RECOMMENDER_BLEND', 0.5)
+
+
+def default_diversity():
+    return getattr(settings, 'RECOMMENDER_DIVERSITY', 0.3)
+
+
+def recommend_for_user(user_id, engine, k=RECOMMENDATIONS, blend=None):
+    """
+    Ids of `k` recipes for the user by the collaborative model, or by a `blend` of it with the
+    content model ('hybrid'). Reads only the user's own ratings and favourites.
+    """
+    interactions = user_interactions(user_id)
+    model = get_collaborative_model()
+    if not model.fitted:
+        # content scores only until the model is fitted
+        return blend_scores(interactions, model, k, 0.0)
+    if engine == 'collaborative':
+        return model.recommend(interactions, k)
+    return blend_scores(interactions, model, k, default_blend() if blend is None else blend)
+
+
+def content_scores(interactions, k):
+    """
+    Ids of recipes near the interacted ones (sorted) and their similarity to the closest of them,
+    scaled by the interaction's weight.
+    """
+    index, (dataset, recipe_ids, recipe_rows) = get_index()
+    seeds = [(recipe_rows[recipe_id], weight) for recipe_id, weight in interactions.items() if recipe_id in recipe_rows]
+    if not seeds:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    rows, weights = np.array(seeds, dtype=np.float64).T
+    with metrics.KNN_QUERY_DURATION.labels(index.name).time():
+        distances, indices = index.query(dataset[rows.astype(np.int64)], k + 1)
+    neighbours, inverse = np.unique(indices, return_inverse=True)
+    scores = np.zeros(len(neighbours))
+    np.maximum.at(scores, inverse.ravel(), (weights[:, None] / (1.0 + distances)).ravel())
+    return recipe_ids[neighbours].astype(np.int64), scores
+
+
+def sorted_positions(sorted_ids, ids):
+    """Positions of `ids` in the sorted array `sorted_ids`, -1 for those missing from it."""
+    positions = np.searchsorted(sorted_ids, ids).clip(max=max(len(sorted_ids) - 1, 0))
+    found = sorted_ids[positions] == ids if len(sorted_ids) else np.zeros(len(ids), dtype=bool)
+    return np.where(found, positions, -1)
+
+
+def blend_scores(interactions, model, k, blend):
+    """Ids of the best `k` recipes by `blended_candidates`."""
+    recipe_ids, score = blended_candidates(interactions, model, k, blend)
+    order = np.lexsort((recipe_ids, -score))[:k]
+    return recipe_ids[order].tolist()
+
+
+def blended_candidates(interactions, model, k, blend):
+    """
+    Ids and scores of the best `k` recipes of either model the user has not interacted with, scored
+    by blend * collaborative + (1 - blend) * content score, each scaled to [0, 1] by its best candidate.
+    """
+    collaborative, _ = model.scores(interactions)
+    content_ids, content = content_scores(interactions, k)
+    candidates = np.flatnonzero(collaborative > 0)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-collaborative[candidates], k - 1)[:k]]
+    recipe_ids = np.union1d(model.recipe_ids[candidates].astype(np.int64), content_ids)
+    recipe_ids = recipe_ids[~np.isin(recipe_ids, list(interactions))]
+    if not len(recipe_ids):
+        return recipe_ids, np.zeros(0)
+
+    # recipes missing from a model get the score 0 appended to it
+    collaborative = np.append(collaborative, 0.0)[sorted_positions(model.recipe_ids, recipe_ids)].clip(min=0)
+    content = np.append(content, 0.0)[sorted_positions(content_ids, recipe_ids)]
+    score = (blend * collaborative / max(collaborative.max(), 1e-12)
+             + (1 - blend) * content / max(content.max(), 1e-12))
+    return recipe_ids, score
+
+
+def scored_candidates(interactions, engine, n, blend=None):
+    """Ids and scores of candidate recipes of the engine, the best `n` of them are always among them."""
+    if engine == 'content':
+        return content_scores(interactions, n)
+    model = get_collaborative_model()
+    if not model.fitted:
+        # content scores only until the model is fitted
+        return blended_candidates(interactions, model, n, 0.0)
+    if engine == 'collaborative':
+        return model.recipe_ids, model.scores(interactions)[0]
+    return blended_candidates(interactions, model, n, default_blend() if blend is None else blend)
+
+
+def top_recommendations(user_id, k=RECOMMENDATIONS, engine=None, blend=None, diversity=None):
+    """
+    Ids and scores of `k` recipes for the user, best first, by any engine. Recipes the user
+    favourited, rated or wrote are never recommended.
+
+    With `diversity` above 0 the `k` are picked from the best k * CANDIDATES_PER_RESULT candidates
+    by maximal marginal relevance, recipes similar to ones already picked fall behind.
+    """
+    engine = engine or default_engine()
+    diversity = default_diversity() if diversity is None else diversity
+    interactions = user_interactions(user_id)
+    excluded = list(interactions) + list(Recipe.objects.filter(user_id=user_id).values_list('id', flat=True))
+    n_candidates = k * CANDIDATES_PER_RESULT if diversity else k
+
+    # excluded recipes may be among the best of the engine
+    recipe_ids, score = scored_candidates(interactions, engine, n_candidates + len(excluded), blend)
+    keep = (score > 0) & ~np.isin(recipe_ids, excluded)
+    recipe_ids, score = recipe_ids[keep], score[keep]
+    if len(recipe_ids) > n_candidates:
+        best = np.argpartition(-score, n_candidates - 1)[:n_candidates]
+        recipe_ids, score = recipe_ids[best], score[best]
+    # recipes deleted since the models were built are dropped with their features
+    _, (dataset, _, recipe_rows) = get_index()
+    rows = np.array([recipe_rows.get(recipe_id, -1) for recipe_id in recipe_ids.tolist()], dtype=np.int64)
+    order = np.lexsort((recipe_ids, -score))
+    order = order[rows[order] >= 0]
+    recipe_ids, score, rows = recipe_ids[order], score[order], rows[order]
+
+    if diversity and len(recipe_ids) > 1:
+        picked = maximal_marginal_relevance(dataset[rows], score, k, diversity)
+    else:
+        picked = np.arange(min(k, len(recipe_ids)))
+    return recipe_ids[picked].tolist(), score[picked].tolist()
+
+
+def maximal_marginal_relevance(vectors, relevance, k, diversity):
+    """
+    Positions of up to `k` items in the order they are picked: each time the one with the best
+    (1 - diversity) * relevance - diversity * cosine similarity to the closest item already picked.
+    Relevance is scaled to [0, 1] by the best item, which is always picked first.
+    """
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    vectors = sparse.diags(1 / np.maximum(norms, 1e-12)) @ vectors
+    similarity = (vectors @ vectors.T).toarray()
+    relevance = np.asarray(relevance, dtype=np.float64) / max(np.max(relevance), 1e-12)
+
+    picked = [int(np.argmax(relevance))]
+    closest = similarity[picked[0]].copy()
+    available = np.ones(len(relevance), dtype=bool)
+    available[picked[0]] = False
+    while len(picked) < min(k, len(relevance)):
+        marginal = np.where(available, (1 - diversity) * relevance - diversity * closest, -np.inf)
+        best = int(np.argmax(marginal))
+        picked.append(best)
+        available[best] = False
+        np.maximum(closest, similarity[best], out=closest)
+    return np.array(picked, dtype=np.int64)
+
+
+def fetch_recipes(recipe_ids, fields=None):
+    if not recipe_ids:
+        return []
+    recipes = Recipe.objects.all()
+    if fields:
+        recipes = recipes.only(*fields)
+    recipes = recipes.in_bulk(recipe_ids)
+    return [recipes[recipe_id] for recipe_id in recipe_ids if recipe_id in recipes]
+
+
+def find_user_recipes(recipes_rows, favourite_ids):
+    return [recipes_rows[recipe_id] for recipe_id in favourite_ids if recipe_id in recipes_rows]
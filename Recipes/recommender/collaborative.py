@@ -0,0 +1,188 @@
+"""
+Collaborative filtering over ratings and favourites.
+
+Users x recipes interactions are factorized offline by truncated SVD (`build_recommender`). Only
+the recipe factors V are kept: a user is folded in from their own interactions r as r V, and the
+scores of all recipes are V (r V)^T, one matrix-vector product. New ratings and favourites count
+immediately, recipes added after the fit are only reached by the content model.
+"""
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+from Recipes import metrics
+from Recipes.models import Rating, User
+
+MODEL_FILENAME = 'collaborative.npz'
+FAVOURITE_WEIGHT = 1.0
+MAX_SCORE = 5
+
+
+def factors():
+    return getattr(settings, 'RECOMMENDER_CF_FACTORS', 64)
+
+
+def interaction_weight(score=None, favourite=False):
+    """Strength of an interaction: a rating scaled to (0, 1], a favourite is the strongest."""
+    weight = score / MAX_SCORE if score is not None else 0.0
+    return max(weight, FAVOURITE_WEIGHT) if favourite else weight
+
+
+def user_interactions(user_id):
+    """Recipe id -> weight of the user's ratings and favourites, two queries."""
+    weights = {recipe_id: interaction_weight(score)
+               for recipe_id, score in Rating.objects.filter(user_id=user_id).values_list('recipe_id', 'score')}
+    for recipe_id in User.favourite_recipes.through.objects.filter(user_id=user_id).values_list('recipe_id',
+                                                                                                flat=True):
+        weights[recipe_id] = interaction_weight(favourite=True)
+    return weights
+
+
+def interaction_matrix(ratings=None, favourites=None):
+    """
+    Sparse float32 users x recipes matrix of interactions with the recipe id of every column.
+
+    `ratings` are (user, recipe, score) rows and `favourites` (user, recipe) rows, all of the
+    database by default.
+    """
+    if ratings is None:
+        ratings = list(Rating.objects.values_list('user_id', 'recipe_id', 'score'))
+    if favourites is None:
+        favourites = list(User.favourite_recipes.through.objects.values_list('user_id', 'recipe_id'))
+    ratings = np.array(ratings, dtype=np.float64).reshape(-1, 3)
+    favourites = np.array(favourites, dtype=np.int64).reshape(-1, 2)
+    users = np.concatenate([ratings[:, 0].astype(np.int64), favourites[:, 0]])
+    recipes = np.concatenate([ratings[:, 1].astype(np.int64), favourites[:, 1]])
+    weights = np.concatenate([ratings[:, 2] / MAX_SCORE, np.full(len(favourites), FAVOURITE_WEIGHT)])
+
+    user_ids, rows = np.unique(users, return_inverse=True)
+    recipe_ids, columns = np.unique(recipes, return_inverse=True)
+    # a rated favourite keeps the stronger of its weights, duplicates are not summed
+    order = np.lexsort((-weights, columns, rows))
+    rows, columns, weights = rows[order], columns[order], weights[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+    matrix = sparse.csr_matrix((weights[first].astype(np.float32), (rows[first], columns[first])),
+                               shape=(len(user_ids), len(recipe_ids)))
+    return matrix, recipe_ids
+
+
+class CollaborativeModel:
+    """Recipe factors of a truncated SVD and the recipe id of every row."""
+    name = 'collaborative'
+
+    def __init__(self, recipe_factors, recipe_ids):
+        self.recipe_factors = recipe_factors  # (recipes, factors) float32
+        self.recipe_ids = recipe_ids
+        self.recipe_rows = {int(recipe_id): row for row, recipe_id in enumerate(recipe_ids.tolist())}
+        self.version = None
+
+    @classmethod
+    def empty(cls):
+        """Model knowing no recipes, served until one is fitted."""
+        return cls(np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64))
+
+    @property
+    def fitted(self):
+        return len(self.recipe_ids) > 0
+
+    @classmethod
+    def fit(cls, matrix, recipe_ids, n_factors=None, seed=0):
+        n_factors = min(n_factors or factors(), min(matrix.shape) - 1)
+        if n_factors < 1 or not matrix.nnz:
+            return cls(np.zeros((len(recipe_ids), 0), dtype=np.float32), recipe_ids)
+        start = np.random.RandomState(seed).uniform(size=min(matrix.shape)).astype(np.float32)
+        _, singular_values, vt = svds(matrix.astype(np.float32), k=n_factors, v0=start)
+        # factors beyond the rank of the matrix are arbitrary directions
+        keep = singular_values > singular_values.max() * 1e-5
+        return cls(np.ascontiguousarray(vt[keep].T, dtype=np.float32), recipe_ids)
+
+    def scores(self, interactions):
+        """
+        Scores of all recipes of the model for a user given as recipe id -> weight, with the rows
+        of the recipes the user interacted with. Recipes unknown to the model are ignored.
+        """
+        known = [(self.recipe_rows[recipe_id], weight) for recipe_id, weight in interactions.items()
+                 if recipe_id in self.recipe_rows]
+        rows = np.array([row for row, _ in known], dtype=np.int64)
+        if not known or not self.recipe_factors.shape[1]:
+            return np.zeros(len(self.recipe_ids), dtype=np.float32), rows
+        weights = np.array([weight for _, weight in known], dtype=np.float32)
+        with metrics.KNN_QUERY_DURATION.labels(self.name).time():
+            user = weights @ self.recipe_factors[rows]
+            return self.recipe_factors @ user, rows
+
+    def recommend(self, interactions, k):
+        """Ids of the `k` best scored recipes the user has not interacted with yet, best first."""
+        scores, rows = self.scores(interactions)
+        scores[rows] = -np.inf
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.lexsort((self.recipe_ids[candidates], -scores[candidates]))]
+        return self.recipe_ids[candidates].tolist()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as tmp_file:
+            np.savez(tmp_file, recipe_factors=self.recipe_factors, recipe_ids=self.recipe_ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            return cls(stored['recipe_factors'], stored['recipe_ids'])
+
+
+def model_path():
+    directory = getattr(settings, 'RECOMMENDER_DIR', None)
+    return os.path.join(directory, MODEL_FILENAME) if directory else None
+
+
+_model = None
+_model_lock = threading.RLock()
+
+
+def fit_model():
+    """Factorizes current interactions and persists the model for all workers."""
+    global _model
+    model = CollaborativeModel.fit(*interaction_matrix())
+    path = model_path()
+    if path:
+        model.save(path)
+        model.version = os.stat(path).st_mtime_ns
+    with _model_lock:
+        _model = model
+    return model
+
+
+def get_collaborative_model():
+    """
+    The persisted model, reloaded when another process fits a new one. Fitting takes too long for a
+    request, until `fit_model` (build_recommender) ran the model is empty and engines fall back to content.
+    """
+    global _model
+    path = model_path()
+    with _model_lock:
+        try:
+            mtime = os.stat(path).st_mtime_ns if path else None
+        except FileNotFoundError:
+            mtime = None
+        if _model is not None and (mtime is None or _model.version == mtime):
+            return _model
+        if mtime is None:
+            _model = CollaborativeModel.empty()
+            return _model
+        _model = CollaborativeModel.load(path)
+        _model.version = mtime
+        return _model
+
+
+def reset_collaborative_model():
+    global _model
+    _model = None
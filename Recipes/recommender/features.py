@@ -0,0 +1,361 @@
+import os
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+from Recipes import metrics, versions
+from Recipes.models import Recipe, Category, Ingredient
+
+NUMERIC_FIELDS = ('difficulty', 'time')
+BLOCKS = ('numeric', 'categories', 'ingredients')
+DEFAULT_WEIGHTS = {'numeric': 1.0, 'categories': 1.0, 'ingredients': 1.0}
+STORE_FILENAME = 'features.npz'
+# layout of the persisted store, files of other versions are rebuilt
+FORMAT_VERSION = 3
+# a longer backlog of catalog changes is cheaper to read from scratch than recipe by recipe
+MAX_CHANGES = 500
+# the persisted store is rewritten after this many applied changes or seconds, whichever comes first
+SAVE_EVERY = 200
+SAVE_INTERVAL = 60
+
+
+class FeaturePipeline:
+    """
+    Scaling of feature columns, fitted on the whole catalog when the store is built.
+
+    Every column is max-abs scaled: divided by its largest absolute value in the catalog, so it lies
+    in [0, 1] without shifting values and the matrix stays sparse. It is then multiplied by the weight
+    of its block (BLOCKS). Columns added after the fit are binary tags and keep scale 1. Transforming rows
+    is one sparse product with the column factors, nothing is refitted per query.
+    """
+
+    def __init__(self, weights=None):
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.block_weights = np.array([float(weights[block]) for block in BLOCKS])
+        self.blocks = np.zeros(0, dtype=np.int8)  # column -> index of its block
+        self.max_abs = np.zeros(0)
+        self._factors = None
+
+    def add_columns(self, block, count):
+        self.blocks = np.concatenate([self.blocks, np.full(count, BLOCKS.index(block), dtype=np.int8)])
+        self.max_abs = np.concatenate([self.max_abs, np.ones(count)])
+        self._factors = None
+
+    def fit(self, matrix):
+        max_abs = abs(matrix).max(axis=0).toarray().ravel() if matrix.shape[0] else np.ones(matrix.shape[1])
+        max_abs[max_abs == 0] = 1
+        self.max_abs = max_abs.astype(np.float64)
+        self._factors = None
+        return self
+
+    def factors(self):
+        if self._factors is None:
+            self._factors = self.block_weights[self.blocks] / self.max_abs
+        return self._factors
+
+    def transform(self, matrix):
+        return (sparse.csr_matrix(matrix) @ sparse.diags(self.factors())).tocsr()
+
+
+class FeatureStore:
+    """
+    Recipe feature matrix kept between requests.
+
+    Every recipe owns one row: numeric fields first, then one binary column per category and
+    ingredient. Columns are assigned the first time a tag is seen, so new tags never shift existing
+    ones. Removed recipes leave an empty row behind until the next full build; `snapshot` only
+    returns live rows. The pipeline scaling the columns is refitted by every full build and
+    persisted with the matrix.
+
+    Every process follows the catalog journal (see Recipes.versions) and reloads the rows named in
+    it. The file is rewritten only every SAVE_EVERY changes or SAVE_INTERVAL seconds, under a lock
+    shared by the processes; a process starting later loads it and applies the journal since.
+    """
+
+    def __init__(self, path=None, weights=None):
+        self.path = path
+        self.weights = weights
+        self._lock = threading.RLock()
+        self.position = None  # catalog journal position the rows reflect
+        self.build_id = 0  # time of the last full build, rebuild entries recorded before it are done
+        self.version = 0  # identifies the journal position, equal in processes which applied the same changes
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self._reset()
+
+    def _reset(self):
+        self.matrix = sparse.lil_matrix((0, len(NUMERIC_FIELDS)))
+        self.recipe_rows = {}  # recipe id -> row
+        self.row_recipes = []  # row -> recipe id, None for removed recipes
+        self.category_columns = {}  # category id -> column
+        self.ingredient_columns = {}  # ingredient id -> column
+        self.pipeline = FeaturePipeline(self.weights)
+        self.pipeline.add_columns('numeric', len(NUMERIC_FIELDS))
+        self._snapshot = None
+
+    def _set_position(self, position):
+        self.position = position
+        self.version = journal_version(position)
+        self._snapshot = None
+
+    # building and persistence
+
+    def build(self):
+        """Reads the whole catalog and persists it."""
+        with self._lock, self._file_lock():
+            self._build()
+            self._write()
+
+    def _build(self):
+        with metrics.FEATURE_BUILD_DURATION.time():
+            # taken before the rows are read, changes committed meanwhile are applied again later
+            self.build_id = time.time_ns()
+            position, _ = versions.changes(versions.CATALOG, None)
+            self._reset()
+            self._add_columns(self.category_columns, 'categories', Category.objects.values_list('id', flat=True))
+            self._add_columns(self.ingredient_columns, 'ingredients',
+                              Ingredient.objects.values_list('id', flat=True))
+
+            numeric = np.array(list(Recipe.objects.order_by('id').values_list('id', *NUMERIC_FIELDS)),
+                               dtype=np.float64).reshape(-1, len(NUMERIC_FIELDS) + 1)
+            numeric = np.nan_to_num(numeric)  # recipes without time
+            recipe_ids = numeric[:, 0].astype(np.int64)
+            self.row_recipes = recipe_ids.tolist()
+            self.recipe_rows = {recipe_id: row for row, recipe_id in enumerate(self.row_recipes)}
+
+            rows = [np.repeat(np.arange(len(recipe_ids)), len(NUMERIC_FIELDS))]
+            columns = [np.tile(np.arange(len(NUMERIC_FIELDS)), len(recipe_ids))]
+            data = [numeric[:, 1:].ravel()]
+            for through, field, tag_columns in (
+                    (Recipe.categories.through, 'category_id', self.category_columns),
+                    (Recipe.ingredients.through, 'ingredient_id', self.ingredient_columns)):
+                links = np.array(list(through.objects.values_list('recipe_id', field)),
+                                 dtype=np.int64).reshape(-1, 2)
+                # links committed after the rows were read belong to recipes applied from the journal
+                links = links[np.isin(links[:, 0], recipe_ids) & np.isin(links[:, 1], list(tag_columns))]
+                rows.append(np.searchsorted(recipe_ids, links[:, 0]))
+                columns.append(np.array([tag_columns[tag_id] for tag_id in links[:, 1].tolist()], dtype=np.int64))
+                data.append(np.ones(len(links)))
+
+            matrix = sparse.coo_matrix(
+                (np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                shape=(len(recipe_ids), self.matrix.shape[1])).tocsr()
+            matrix.eliminate_zeros()
+            self.pipeline.fit(matrix)
+            self.matrix = matrix.tolil()
+            self._set_position(position)
+
+    def ensure_fresh(self):
+        """Applies committed catalog changes, reloads or rebuilds the store when they are too many."""
+        with self._lock:
+            position, entries = versions.changes(versions.CATALOG, self.position)
+            if self._needs_reload(entries):
+                self._reload()
+            else:
+                self._apply(entries, position)
+            if self._unsaved and (self._unsaved >= SAVE_EVERY
+                                  or time.monotonic() - self._saved_at >= SAVE_INTERVAL):
+                self.save()
+
+    def _needs_reload(self, entries):
+        if entries is None or len(entries) > MAX_CHANGES:
+            return True
+        rebuilds = versions.catalog_changes(entries)['rebuild']
+        return bool(rebuilds) and max(rebuilds) > self.build_id
+
+    def _reload(self):
+        """Loads the persisted store if the journal since it can be applied, rebuilds it otherwise."""
+        with self._file_lock():
+            if self._load():
+                position, entries = versions.changes(versions.CATALOG, self.position)
+                if not self._needs_reload(entries):
+                    return self._apply(entries, position)
+            self._build()
+            self._write()
+
+    def save(self):
+        """Persists the store unless another process already persisted the same or a later position."""
+        with self._lock, self._file_lock():
+            stored = self._stored_position()
+            if stored is None or stored[0] != self.position[0] or stored[1] < self.position[1]:
+                self._write()
+            self._unsaved = 0
+            self._saved_at = time.monotonic()
+
+    def _file_lock(self):
+        return versions.file_lock(self.path + '.lock' if self.path else None)
+
+    def _stored_position(self):
+        try:
+            with np.load(self.path) as stored:
+                if 'version' not in stored or int(stored['version']) != FORMAT_VERSION:
+                    return None
+                return str(stored['journal']), int(stored['offset'])
+        except FileNotFoundError:
+            return None
+
+    def _write(self):
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        matrix = self.matrix.tocsr()
+        row_recipes = np.array([-1 if recipe_id is None else recipe_id for recipe_id in self.row_recipes],
+                               dtype=np.int64)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as tmp_file:
+            np.savez(tmp_file, version=FORMAT_VERSION, journal=self.position[0], offset=self.position[1],
+                     build_id=self.build_id, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                     shape=np.array(matrix.shape), row_recipes=row_recipes,
+                     blocks=self.pipeline.blocks, max_abs=self.pipeline.max_abs,
+                     categories=np.array(list(self.category_columns.items()), dtype=np.int64).reshape(-1, 2),
+                     ingredients=np.array(list(self.ingredient_columns.items()), dtype=np.int64).reshape(-1, 2))
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        """Loads the persisted store, False if there is none usable with the current journal."""
+        stored_position = self._stored_position() if self.path else None
+        position, _ = versions.changes(versions.CATALOG, None)
+        if stored_position is None or stored_position[0] != position[0]:
+            return False
+        self._reset()
+        with np.load(self.path) as stored:
+            matrix = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                       shape=tuple(stored['shape']))
+            self.matrix = matrix.tolil()
+            self.row_recipes = [None if recipe_id < 0 else int(recipe_id) for recipe_id in stored['row_recipes']]
+            self.category_columns = {int(pk): int(column) for pk, column in stored['categories']}
+            self.ingredient_columns = {int(pk): int(column) for pk, column in stored['ingredients']}
+            self.pipeline.blocks, self.pipeline.max_abs = stored['blocks'], stored['max_abs']
+            self.build_id = int(stored['build_id'])
+        self.recipe_rows = {recipe_id: row for row, recipe_id in enumerate(self.row_recipes) if recipe_id is not None}
+        self._set_position(stored_position)
+        self._unsaved = 0
+        return True
+
+    # changes
+
+    def _apply(self, entries, position):
+        if not entries:
+            return
+        changed = versions.catalog_changes(entries)
+        recipe_ids = set(changed['recipe'])
+        for model, through, field, columns, block in (
+                (Category, Recipe.categories.through, 'category_id', self.category_columns, 'categories'),
+                (Ingredient, Recipe.ingredients.through, 'ingredient_id', self.ingredient_columns, 'ingredients')):
+            recipe_ids.update(self._apply_tags(model, through, field, columns, block, changed[model.__name__.lower()]))
+        recipe_ids = sorted(recipe_ids)
+        for start in range(0, len(recipe_ids), MAX_CHANGES):
+            self._apply_recipes(recipe_ids[start:start + MAX_CHANGES])
+        self._set_position(position)
+        self._unsaved += len(entries)
+
+    def _apply_tags(self, model, through, field, columns, block, tag_ids):
+        """Adds columns of new tags, drops those of deleted ones. Returns recipes whose tags changed."""
+        if not tag_ids:
+            return set()
+        live = set(model.objects.filter(pk__in=list(tag_ids)).values_list('id', flat=True))
+        stored_columns = [columns[tag_id] for tag_id in tag_ids if tag_id in columns]
+        stored = self.matrix.tocsc()[:, stored_columns].nonzero()[0] if stored_columns else []
+        linked = through.objects.filter(**{field + '__in': list(live)}).values_list('recipe_id', flat=True)
+
+        for tag_id in tag_ids - live:
+            # the column stays allocated, rows are filled again without it
+            columns.pop(tag_id, None)
+        self._add_columns(columns, block, [tag_id for tag_id in live if tag_id not in columns])
+        # deleted tags lose all of their recipes, a cleared tag may keep none
+        return {self.row_recipes[row] for row in stored} - {None} | set(linked)
+
+    def _apply_recipes(self, recipe_ids):
+        numeric = {row[0]: row[1:] for row in Recipe.objects.filter(pk__in=recipe_ids).values_list(
+            'id', *NUMERIC_FIELDS)}
+        tags = {recipe_id: [] for recipe_id in numeric}
+        for through, field, columns, block in (
+                (Recipe.categories.through, 'category_id', self.category_columns, 'categories'),
+                (Recipe.ingredients.through, 'ingredient_id', self.ingredient_columns, 'ingredients')):
+            links = list(through.objects.filter(recipe_id__in=list(numeric)).values_list('recipe_id', field))
+            # tags created meanwhile are applied with a later entry, their column is needed now
+            self._add_columns(columns, block, sorted({tag_id for _, tag_id in links} - set(columns)))
+            for recipe_id, tag_id in links:
+                tags[recipe_id].append(columns[tag_id])
+
+        for recipe_id in recipe_ids:
+            row = self.recipe_rows.get(recipe_id)
+            if recipe_id not in numeric:
+                if row is not None:
+                    del self.recipe_rows[recipe_id]
+                    self.row_recipes[row] = None
+                    self.matrix.rows[row], self.matrix.data[row] = [], []
+                continue
+            if row is None:
+                row = len(self.row_recipes)
+                self.row_recipes.append(recipe_id)
+                self.recipe_rows[recipe_id] = row
+                self.matrix.resize((row + 1, self.matrix.shape[1]))
+            self._fill_row(row, numeric[recipe_id], tags[recipe_id])
+
+    def _add_columns(self, columns, block, tag_ids):
+        tag_ids = list(tag_ids)
+        first = self.matrix.shape[1]
+        columns.update(zip(tag_ids, range(first, first + len(tag_ids))))
+        self.matrix.resize((self.matrix.shape[0], first + len(tag_ids)))
+        self.pipeline.add_columns(block, len(tag_ids))
+
+    def _fill_row(self, row, numeric, tag_columns):
+        values = {column: value or 0 for column, value in enumerate(numeric)}
+        values.update((column, 1) for column in tag_columns)
+        columns = sorted(column for column, value in values.items() if value)
+        self.matrix.rows[row] = columns
+        self.matrix.data[row] = [float(values[column]) for column in columns]
+
+    # reading
+
+    def snapshot(self):
+        """
+        Returns (CSR matrix of live recipes transformed by the pipeline, their ids, recipe id -> row
+        of that matrix). Query rows are taken from the same matrix.
+        """
+        with self._lock:
+            self.ensure_fresh()
+            if self._snapshot is None:
+                live_rows = [row for row, recipe_id in enumerate(self.row_recipes) if recipe_id is not None]
+                recipe_ids = np.array([self.row_recipes[row] for row in live_rows], dtype=np.int64)
+                rows = {int(recipe_id): row for row, recipe_id in enumerate(recipe_ids)}
+                matrix = self.matrix.tocsr()[live_rows]
+                self._snapshot = (self.pipeline.transform(matrix), recipe_ids, rows)
+            return self._snapshot
+
+
+def journal_version(position):
+    """Version of a store which applied the catalog journal up to `position`."""
+    # the identity of the journal tells apart offsets of journals started over
+    return int(position[0][:15], 16) + position[1]
+
+
+def current_version():
+    """Version of a store which applied every committed catalog change, without loading the store."""
+    return journal_version(versions.changes(versions.CATALOG, None)[0])
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        from django.conf import settings
+        with _store_lock:
+            if _store is None:
+                directory = getattr(settings, 'RECOMMENDER_DIR', None)
+                _store = FeatureStore(os.path.join(directory, STORE_FILENAME) if directory else None,
+                                      getattr(settings, 'RECOMMENDER_FEATURE_WEIGHTS', None))
+    return _store
+
+
+def reset_store():
+    global _store
+    _store = None
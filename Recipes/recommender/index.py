@@ -0,0 +1,216 @@
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+from sklearn import neighbors as sn
+from sklearn.metrics import pairwise_distances
+
+from Recipes.recommender.features import get_store
+
+
+class BruteForceIndex:
+    """Exact nearest neighbours, reference for other backends. Nothing worth persisting."""
+    name = 'brute'
+    persistent = False
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self._nbrs = sn.NearestNeighbors(algorithm='brute').fit(matrix)
+
+    @classmethod
+    def build(cls, matrix):
+        return cls(matrix)
+
+    def query(self, vectors, k):
+        k = min(k, self.matrix.shape[0])
+        return self._nbrs.kneighbors(vectors, n_neighbors=k)
+
+
+class LSHIndex:
+    """
+    Random-projection LSH over centered features.
+
+    Every table hashes a recipe to the signs of `bits` random projections. Candidates are recipes
+    sharing a bucket with the query in any table, they are reranked by exact distance. Hash codes
+    are kept sorted per table, so a bucket lookup is a binary search. All arrays are stored as .npy
+    files and memory-mapped on load, every worker shares the same pages.
+    """
+    name = 'lsh'
+    persistent = True
+    ARRAYS = ('planes', 'offsets', 'codes', 'order')
+
+    def __init__(self, matrix, planes, offsets, codes, order):
+        self.matrix = matrix
+        self.planes = planes  # (features, tables * bits)
+        self.offsets = offsets  # projection of the mean recipe
+        self.codes = codes  # (tables, recipes) sorted bucket codes
+        self.order = order  # (tables, recipes) rows in order of codes
+
+    @classmethod
+    def build(cls, matrix, tables=16, bits=8, seed=0):
+        random = np.random.RandomState(seed)
+        planes = random.normal(size=(matrix.shape[1], tables * bits)).astype(np.float32)
+        offsets = np.asarray(matrix.mean(axis=0)).ravel().astype(np.float32) @ planes
+        codes = cls._hash(matrix, planes, offsets, tables)
+        order = np.argsort(codes, axis=1, kind='stable').astype(np.int32)
+        codes = np.take_along_axis(codes, order, axis=1)
+        return cls(matrix, planes, offsets, codes, order)
+
+    @staticmethod
+    def _hash(vectors, planes, offsets, tables):
+        signs = (vectors @ planes - offsets) > 0
+        signs = signs.reshape(signs.shape[0], tables, -1)
+        weights = np.left_shift(np.uint64(1), np.arange(signs.shape[2], dtype=np.uint64))
+        return (signs * weights).sum(axis=2, dtype=np.uint64).T
+
+    def candidates(self, vector_codes):
+        rows = []
+        for table, code in enumerate(vector_codes):
+            start, end = np.searchsorted(self.codes[table], [code, code + np.uint64(1)])
+            rows.append(self.order[table, start:end])
+        return np.unique(np.concatenate(rows))
+
+    def query(self, vectors, k):
+        k = min(k, self.matrix.shape[0])
+        codes = self._hash(vectors, self.planes, self.offsets, self.codes.shape[0])
+        distances = np.empty((vectors.shape[0], k))
+        indices = np.empty((vectors.shape[0], k), dtype=np.int64)
+        for i in range(vectors.shape[0]):
+            rows = self.candidates(codes[:, i])
+            if len(rows) < k:
+                # too few neighbours share a bucket, rerank everything instead
+                rows = np.arange(self.matrix.shape[0])
+            row_distances = pairwise_distances(vectors[i], self.matrix[rows]).ravel()
+            best = np.argsort(row_distances, kind='stable')[:k]
+            distances[i], indices[i] = row_distances[best], rows[best]
+        return distances, indices
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, matrix):
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in cls.ARRAYS]
+        return cls(matrix, *arrays)
+
+
+BACKENDS = {
+    BruteForceIndex.name: BruteForceIndex,
+    LSHIndex.name: LSHIndex,
+}
+
+# persisted indexes kept besides the newest one, workers may still be loading them
+KEEP_INDEXES = 3
+SNAPSHOT_FILENAME = 'snapshot.npz'
+
+_index = None  # (backend name, store version, build time, index, snapshot)
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the configured index over a feature snapshot, together with the snapshot.
+
+    Exact indexes are cheap and follow every store version. Approximate ones are persisted next to
+    the feature store together with their snapshot and serve until they are older than
+    settings.RECOMMENDER_INDEX_MAX_AGE: a worker loads the newest one written by build_recommender
+    or another worker, only when even that one is too old it builds one within the request.
+    """
+    global _index
+    from django.conf import settings
+
+    store = get_store()
+    backend = BACKENDS[getattr(settings, 'RECOMMENDER_INDEX', BruteForceIndex.name)]
+    max_age = getattr(settings, 'RECOMMENDER_INDEX_MAX_AGE', 300) if backend.persistent else 0
+    with _index_lock:
+        store.ensure_fresh()
+        if _index is not None and _index[0] == backend.name and (
+                _index[1] == store.version or time.time() - _index[2] < max_age):
+            return _index[3], _index[4]
+
+        directory = _directory(store, backend)
+        loaded = _load_latest(backend, directory, store.version, max_age) if directory else None
+        _index = loaded or _build(store, backend, directory)
+        return _index[3], _index[4]
+
+
+def build_index():
+    """Builds the configured index over the current feature snapshot and persists it."""
+    global _index
+    from django.conf import settings
+
+    store = get_store()
+    backend = BACKENDS[getattr(settings, 'RECOMMENDER_INDEX', BruteForceIndex.name)]
+    with _index_lock:
+        store.ensure_fresh()
+        _index = _build(store, backend, _directory(store, backend))
+        return _index[3], _index[4]
+
+
+def _directory(store, backend):
+    return os.path.dirname(store.path) if store.path and backend.persistent else None
+
+
+def _build(store, backend, directory):
+    snapshot = store.snapshot()
+    index = backend.build(snapshot[0])
+    if directory:
+        _save_index(index, snapshot, os.path.join(directory, 'index-{}-{}'.format(backend.name, store.version)))
+    return backend.name, store.version, time.time(), index, snapshot
+
+
+def _saved_indexes(backend, directory):
+    """Directories of persisted indexes of the backend, newest first."""
+    prefix = 'index-{}-'.format(backend.name)
+    paths = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        if name.startswith(prefix) and not name.endswith('.tmp'):
+            try:
+                paths.append((os.stat(os.path.join(directory, name)).st_mtime, os.path.join(directory, name)))
+            except FileNotFoundError:
+                pass
+    return sorted(paths, reverse=True)
+
+
+def _load_latest(backend, directory, version, max_age):
+    for built_at, path in _saved_indexes(backend, directory)[:1]:
+        if not path.endswith('-{}'.format(version)) and time.time() - built_at >= max_age:
+            return None
+        try:
+            with np.load(os.path.join(path, SNAPSHOT_FILENAME)) as stored:
+                matrix = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                           shape=tuple(stored['shape']))
+                recipe_ids = stored['recipe_ids']
+            index = backend.load(path, matrix)
+        except FileNotFoundError:
+            # pruned by another worker meanwhile
+            return None
+        rows = {int(recipe_id): row for row, recipe_id in enumerate(recipe_ids)}
+        return backend.name, int(path.rsplit('-', 1)[1]), built_at, index, (matrix, recipe_ids, rows)
+    return None
+
+
+def _save_index(index, snapshot, directory):
+    parent = os.path.dirname(directory)
+    tmp_directory = '{}.{}.tmp'.format(directory, os.getpid())
+    index.save(tmp_directory)
+    matrix, recipe_ids, _ = snapshot
+    np.savez(os.path.join(tmp_directory, SNAPSHOT_FILENAME), data=matrix.data, indices=matrix.indices,
+             indptr=matrix.indptr, shape=np.array(matrix.shape), recipe_ids=recipe_ids)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # another worker saved the same version first
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    for _, path in _saved_indexes(index, parent)[KEEP_INDEXES + 1:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def reset_index():
+    global _index
+    _index = None
@@ -0,0 +1,107 @@
+import multiprocessing
+
+from django.db import connections, transaction
+
+from Recipes import metrics
+from Recipes.models import User, UserRecommendation
+from Recipes.recommender import recommend_ids, recommend_for_user, fetch_recipes, default_engine
+from Recipes.recommender.features import current_version, get_store
+from Recipes.recommender.index import get_index
+
+
+def get_recommendations(user_id, fields=None, engine=None, blend=None):
+    """
+    Serves stored recommendations of the user, computes and stores them on a miss.
+
+    Stored lists are dropped when user's favourites change (see Recipes.signals). A list stored for
+    another catalog version than the current one is a miss and replaced, `precompute_recommendations`
+    refreshes them ahead of time. Only the content engine is stored, the collaborative and hybrid
+    ones (see Recipes.recommender) are cheap enough to compute every time.
+    """
+    if (engine or default_engine()) != 'content':
+        return fetch_recipes(recommend_for_user(user_id, engine or default_engine(), blend=blend), fields)
+    stored = UserRecommendation.objects.filter(user_id=user_id).first()
+    if stored is not None and stored.catalog_version == current_version():
+        metrics.RECOMMENDATION_CACHE.labels('hit').inc()
+        return fetch_recipes(stored.recipes, fields)
+    metrics.RECOMMENDATION_CACHE.labels('miss').inc()
+
+    favourites = User.favourite_recipes.through.objects.filter(user_id=user_id).order_by('id')
+    favourite_ids = favourites.values_list('recipe_id', flat=True)
+    recipe_ids = recommend_ids(favourite_ids)
+    fresh = _stored(user_id, recipe_ids, get_store().version)
+    if stored is None:
+        UserRecommendation.objects.bulk_create([fresh], ignore_conflicts=True)
+    else:
+        UserRecommendation.objects.filter(pk=stored.pk).update(recipe_ids=fresh.recipe_ids,
+                                                               catalog_version=fresh.catalog_version)
+    return fetch_recipes(recipe_ids, fields)
+
+
+def invalidate(user_ids):
+    """Drops stored lists of these users once the transaction commits."""
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: UserRecommendation.objects.filter(user_id__in=user_ids).delete())
+
+
+def _stored(user_id, recipe_ids, catalog_version):
+    return UserRecommendation(user_id=user_id, recipe_ids=','.join(map(str, recipe_ids)),
+                              catalog_version=catalog_version)
+
+
+# batch precompute
+
+_worker_index = None  # set before forking, workers inherit it and never touch the database
+
+
+def _recommend_batch(batch):
+    index, snapshot = _worker_index
+    return [(user_id, recommend_ids(favourite_ids, index, snapshot)) for user_id, favourite_ids in batch]
+
+
+def precompute(batch_size=500, processes=1, only_stale=True, stdout=None):
+    """
+    Computes recommendations of all users (or those without a current list) and stores them.
+
+    Batches of users are spread over a pool of forked processes, only the parent talks to the database.
+    Returns number of users whose recommendations were written.
+    """
+    index, snapshot = get_index()
+    version = get_store().version
+
+    users = User.objects.order_by('id')
+    if only_stale:
+        users = users.exclude(userrecommendation__catalog_version=version)
+    user_ids = list(users.values_list('id', flat=True))
+    batches = [user_ids[start:start + batch_size] for start in range(0, len(user_ids), batch_size)]
+
+    def favourites(batch):
+        by_user = {user_id: [] for user_id in batch}
+        links = User.favourite_recipes.through.objects.filter(user_id__in=batch).order_by('id')
+        for user_id, recipe_id in links.values_list('user_id', 'recipe_id'):
+            by_user[user_id].append(recipe_id)
+        return list(by_user.items())
+
+    def store(results):
+        UserRecommendation.objects.filter(user_id__in=[user_id for user_id, _ in results]).delete()
+        UserRecommendation.objects.bulk_create([_stored(user_id, ids, version) for user_id, ids in results])
+
+    written = 0
+    if processes > 1 and len(batches) > 1:
+        global _worker_index
+        _worker_index = (index, snapshot)
+        tasks = [favourites(batch) for batch in batches]
+        connections.close_all()  # forked children must not share the parent's connection
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            for results in pool.imap(_recommend_batch, tasks):
+                store(results)
+                written += len(results)
+                if stdout:
+                    stdout.write('{}/{} users'.format(written, len(user_ids)))
+    else:
+        for batch in map(favourites, batches):
+            store([(user_id, recommend_ids(favourite_ids, index, snapshot)) for user_id, favourite_ids in batch])
+            written += len(batch)
+            if stdout:
+                stdout.write('{}/{} users'.format(written, len(user_ids)))
+    return written
@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from Recipes import versions
+from Recipes.models import Ingredient
+
+VERSION_NAME = 'replacements'
+
+
+def max_depth():
+    return getattr(settings, 'REPLACEMENT_MAX_DEPTH', 3)
+
+
+class ReplacementGraph:
+    """
+    Transitive closure of ingredient replacements up to `max_depth()` hops, kept in memory.
+
+    For every ingredient the closure maps each reachable replacement to the number of hops needed,
+    so expanding a whole ingredient list is a few dictionary lookups. The graph is rebuilt when
+    the replacements change (see Recipes.signals).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.closure = {}
+
+    def build(self):
+        edges = {}
+        for source, target in Ingredient.replacements.through.objects.values_list('from_ingredient_id',
+                                                                                 'to_ingredient_id'):
+            edges.setdefault(source, []).append(target)
+        depth = max_depth()
+        closure = {}
+        for start in edges:
+            hops = {start: 0}
+            queue = deque([start])
+            while queue:
+                current = queue.popleft()
+                if hops[current] == depth:
+                    continue
+                for target in edges.get(current, ()):
+                    if target not in hops:
+                        hops[target] = hops[current] + 1
+                        queue.append(target)
+            del hops[start]
+            closure[start] = hops
+        self.closure = closure
+
+    def ensure_fresh(self):
+        with self._lock:
+            version = versions.current(VERSION_NAME)
+            if self.version != version:
+                self.build()
+                self.version = version
+
+    def group(self, ingredient_id, depth=1, penalty=0.0):
+        """The ingredient and its replacements reachable in `depth` hops, weighted (1 - penalty) ** hops."""
+        self.ensure_fresh()
+        group = {ingredient_id: 1.0}
+        for replacement_id, hops in self.closure.get(ingredient_id, {}).items():
+            if hops <= depth and replacement_id != ingredient_id:
+                group[replacement_id] = (1.0 - penalty) ** hops
+        return group
+
+    def expand(self, ingredient_ids, depth=1, penalty=0.0):
+        """All ingredients usable instead of the given ones, with the best weight of each."""
+        expanded = {}
+        for ingredient_id in ingredient_ids:
+            for member, weight in self.group(ingredient_id, depth, penalty).items():
+                expanded[member] = max(weight, expanded.get(member, 0.0))
+        return expanded
+
+
+_graph = ReplacementGraph()
+
+
+def get_replacement_graph():
+    _graph.ensure_fresh()
+    return _graph
+
+
+def reset_replacement_graph():
+    _graph.version = None
@@ -0,0 +1,205 @@
+"""
+Cache of rendered responses of read-heavy catalog views, see CachedResponseMixin.
+
+Entries live in a per-worker LRU and, when RESPONSE_CACHE_BACKEND names one of CACHES, in that
+shared cache too. Every entry depends on tags ('recipes', 'recipe:<pk>', 'ingredients',
+'categories') whose generation is part of its key. Signals (see Recipes.signals) bump the
+generations of changed tags, so old entries are never read again and age out of the LRU. With a
+shared backend generations are kept there, otherwise in version stamps of the machine.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.http import parse_etags
+from rest_framework import status
+
+from Recipes import metrics, versions
+
+RECIPES = 'recipes'
+INGREDIENTS = 'ingredients'
+CATEGORIES = 'categories'
+
+CACHED_HEADERS = ('Link',)
+# version stamps shared by recipe tags when there is no shared backend
+RECIPE_STAMPS = 256
+
+
+def recipe_tag(recipe_id):
+    return 'recipe:{}'.format(recipe_id)
+
+
+class LRUCache:
+    """Entries of this process, the least recently used one is dropped above `size` entries."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+_local_cache = None
+
+
+def local_cache():
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LRUCache(getattr(settings, 'RESPONSE_CACHE_SIZE', 1000))
+    return _local_cache
+
+
+def reset_response_cache():
+    global _local_cache
+    _local_cache = None
+
+
+def shared_cache():
+    alias = getattr(settings, 'RESPONSE_CACHE_BACKEND', None)
+    return caches[alias] if alias else None
+
+
+def _generation_key(tag):
+    return 'response-generation:' + tag
+
+
+def _stamp_name(tag):
+    # a stamp file per recipe would grow without bound, recipes share RECIPE_STAMPS of them
+    kind, _, pk = tag.partition(':')
+    return 'response-' + ('{}-{}'.format(kind, int(pk) % RECIPE_STAMPS) if pk else tag)
+
+
+def generations(tags):
+    shared = shared_cache()
+    if shared is None:
+        return [versions.current(_stamp_name(tag)) for tag in tags]
+    keys = [_generation_key(tag) for tag in tags]
+    stored = shared.get_many(keys)
+    for key in keys:
+        if key not in stored:
+            # an evicted generation starts from a value it never had, entries cached under old ones stay unreachable
+            shared.add(key, time.time_ns(), timeout=None)
+            stored[key] = shared.get(key)
+    return [stored[key] for key in keys]
+
+
+def _bump(tags):
+    shared = shared_cache()
+    for tag in tags:
+        if shared is None:
+            versions.bump(_stamp_name(tag))
+            continue
+        key = _generation_key(tag)
+        shared.add(key, time.time_ns(), timeout=None)
+        try:
+            shared.incr(key)
+        except ValueError:
+            # evicted between add and incr
+            shared.set(key, time.time_ns(), timeout=None)
+
+
+def invalidate(*tags):
+    """
+    Drops cached responses depending on any of the tags.
+
+    Bumped now and once more on commit: a response rendered from rows read before the commit
+    would otherwise be kept under the new generation.
+    """
+    _bump(tags)
+    transaction.on_commit(lambda: _bump(tags))
+
+
+def invalidate_catalog():
+    """Drops all cached responses, every recipe response depends on ingredients and categories."""
+    invalidate(RECIPES, INGREDIENTS, CATEGORIES)
+
+
+def etag(content):
+    return '"{}"'.format(hashlib.blake2b(content, digest_size=16).hexdigest())
+
+
+def not_modified(request, entry_etag):
+    return entry_etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+
+class CachedResponseMixin:
+    """
+    Serves GET responses of a DRF view from the response cache.
+
+    Authentication and permissions run as usual, only the view and rendering are skipped on a hit.
+    Responses are cached per host (links of pagination are absolute), route, url arguments, query parameters (`fields` among them) and
+    media type, and carry an ETag so clients revalidating with If-None-Match get a 304.
+    `response_cache_tags` lists the tags the response depends on, views depending on url arguments
+    override `cache_tags` instead.
+    """
+    response_cache_tags = (RECIPES, INGREDIENTS, CATEGORIES)
+
+    def cache_tags(self):
+        return self.response_cache_tags
+
+    def cache_key(self, request):
+        material = [request.get_host(), request.resolver_match.route, request.accepted_media_type]
+        material += ['{}={}'.format(name, value) for name, value in sorted(self.kwargs.items())]
+        material += ['{}={}'.format(name, value) for name, value in sorted(request.query_params.lists())]
+        tags = self.cache_tags()
+        material += ['{}@{}'.format(tag, generation) for tag, generation in zip(tags, generations(tags))]
+        return 'response:' + hashlib.blake2b('\n'.join(material).encode(), digest_size=20).hexdigest()
+
+    def get(self, request, *args, **kwargs):
+        self.response_cache_key = self.cache_key(request)
+        entry = local_cache().get(self.response_cache_key)
+        if entry is None:
+            shared = shared_cache()
+            entry = shared.get(self.response_cache_key) if shared is not None else None
+            if entry is not None:
+                local_cache().set(self.response_cache_key, entry)
+        metrics.RESPONSE_CACHE.labels(request.resolver_match.route, 'miss' if entry is None else 'hit').inc()
+        if entry is None:
+            return super().get(request, *args, **kwargs)
+
+        content, content_type, entry_etag, headers = entry
+        if not_modified(request, entry_etag):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = entry_etag
+        for name, value in headers:
+            response[name] = value
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(self, 'response_cache_key', None)
+        if key is None or response.status_code != status.HTTP_200_OK or response.has_header('ETag'):
+            return response
+
+        response.render()
+        entry = (response.content, response['Content-Type'], etag(response.content),
+                 [(name, response[name]) for name in CACHED_HEADERS if response.has_header(name)])
+        local_cache().set(key, entry)
+        shared = shared_cache()
+        if shared is not None:
+            shared.set(key, entry, timeout=getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 600))
+        response['ETag'] = entry[2]
+        if not_modified(request, entry[2]):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = entry[2]
+        return response
@@ -0,0 +1,51 @@
+import re
+from functools import reduce
+from operator import add, and_
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, Q, Case, When, Value, DecimalField, FloatField
+from django.db.models.functions import Cast
+
+# text search configuration used by the trigger filling Recipe.search_vector, see migration 0013
+SEARCH_CONFIG = 'english'
+RANK_FIELD = DecimalField(max_digits=12, decimal_places=8)
+
+
+def search_terms(text):
+    return re.findall(r'\w+', text)
+
+
+def prefix_query(term):
+    """
+    Words of the search vector starting with `term`. The configuration of the vector drops stopwords,
+    so the prefix is parsed by the 'simple' one too: 'on' still finds 'onion' while a word is typed.
+    """
+    # terms are plain words, so they are safe in a raw tsquery
+    return (SearchQuery(term + ':*', config=SEARCH_CONFIG, search_type='raw')
+            | SearchQuery(term + ':*', config='simple', search_type='raw'))
+
+
+def full_text_search(queryset, text):
+    """
+    Recipes matching every word of `text` in title or description, each word may be the prefix of a
+    longer one.
+
+    Adds a `rank` annotation, higher is better. PostgreSQL uses the GIN indexed `search_vector`,
+    other databases fall back to case insensitive substring matching.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return queryset.annotate(rank=Value(0.0, output_field=FloatField()))
+
+    if connection.vendor == 'postgresql':
+        query = reduce(and_, [prefix_query(term) for term in terms])
+        # ts_rank is a float4, which does not survive a round trip through a pagination cursor
+        rank = Cast(SearchRank(F('search_vector'), query), RANK_FIELD)
+        return queryset.filter(search_vector=query).annotate(rank=rank)
+
+    matches = [Q(title__icontains=term) | Q(description__icontains=term) for term in terms]
+    # titles weigh more, like weight A of the search vector
+    rank = reduce(add, [Case(When(title__icontains=term, then=Value(1.0)), default=Value(0.1),
+                             output_field=FloatField()) for term in terms])
+    return queryset.filter(reduce(and_, matches)).annotate(rank=rank)
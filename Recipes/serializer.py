@@ -1,7 +1,41 @@
+import math
+
+from django.db import transaction
+from django.db.models import Prefetch
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 from django.contrib.auth.models import User as BaseUser
 from Recipes.models import Recipe, Ingredient, Category, Comment, Rating, User
-from Recipes.recommender import propose_recipes
+from Recipes.recommender import ENGINES
+from Recipes.recommender.precomputed import get_recommendations
+
+
+def requested_fields(request):
+    """Fields listed in `fields` query parameter, None if all of them should be displayed."""
+    fields = request.query_params.get('fields', None) if request is not None else None
+    return set(fields.split(',')) if fields else None
+
+
+def requested_expansions(request):
+    """Optional sections named in `expand` or `fields` query parameters."""
+    expand = request.query_params.get('expand', None) if request is not None else None
+    return (set(expand.split(',')) if expand else set()) | (requested_fields(request) or set())
+
+
+def parse_share(value):
+    """A number clipped to [0, 1], None when missing, not a number or not finite."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(value, 0.0), 1.0) if math.isfinite(value) else None
+
+
+def recommendation_options(request):
+    """Engine (see Recipes.recommender.ENGINES) and blend of a hybrid asked for by `engine` and `blend`."""
+    params = request.query_params if request is not None else {}
+    engine = params.get('engine') if params.get('engine') in ENGINES else None
+    return engine, parse_share(params.get('blend'))
 
 
 class DynamicFieldsModelSerializer(serializers.ModelSerializer):
@@ -13,16 +47,15 @@ class DynamicFieldsModelSerializer(serializers.ModelSerializer):
     def __init__(self, *args, **kwargs):
 
         try:
-            fields = kwargs['context']['request'].query_params.get('fields', None)
+            fields = requested_fields(kwargs['context']['request'])
         except KeyError:
             fields = None
         # Instantiate the superclass normally
         super(DynamicFieldsModelSerializer, self).__init__(*args, **kwargs)
 
         if fields:
-            fields = fields.split(',')
             # Drop any fields that are not specified in the `fields` argument.
-            allowed = set(fields)
+            allowed = fields
             existing = set(self.fields.keys())
             for field_name in existing - allowed:
                 self.fields.pop(field_name)
@@ -61,63 +94,126 @@ class IngredientSerializer(serializers.ModelSerializer):
         return ingredient
 
 
+class ManyNamesRelatedField(serializers.ManyRelatedField):
+    """Looks up all given slugs in one query instead of one query per item."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        child = self.child_relation
+        try:
+            found = {getattr(instance, child.slug_field): instance
+                     for instance in child.get_queryset().filter(**{child.slug_field + '__in': list(data)})}
+            missing = [value for value in data if value not in found]
+        except (TypeError, ValueError):
+            child.fail('invalid')
+        if missing:
+            child.fail('does_not_exist', slug_name=child.slug_field, value=missing[0])
+        return list({value: found[value] for value in data}.values())
+
+
+class NamesRelatedField(serializers.SlugRelatedField):
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return ManyNamesRelatedField(**list_kwargs)
+
+
 class LimitedRecipeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Recipe
         fields = ['id', 'title', 'time']
 
 
+class ScoredRecipeSerializer(LimitedRecipeSerializer):
+    """A recommended recipe with the `score` the recommender gave it."""
+    score = serializers.FloatField(read_only=True)
+
+    class Meta(LimitedRecipeSerializer.Meta):
+        fields = LimitedRecipeSerializer.Meta.fields + ['score']
+
+
 class RecipeSerializer(DynamicFieldsModelSerializer, serializers.ModelSerializer):
-    categories = serializers.SlugRelatedField(many=True, slug_field='name', queryset=Category.objects.all())
+    categories = NamesRelatedField(many=True, slug_field='name', queryset=Category.objects.all())
     # ingredients = serializers.SlugRelatedField(many=True, slug_field='name', queryset=Ingredient.objects.all())
     ingredients = IngredientSerializer(many=True)
 
     class Meta:
         model = Recipe
-        fields = '__all__'
+        exclude = ['search_vector']
+        read_only_fields = ['rating_sum', 'rating_count', 'rating_average', 'comment_count']
+
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        """Prefetches relations of the requested fields, a page then costs the same number of queries."""
+        if fields is None or 'categories' in fields:
+            queryset = queryset.prefetch_related(Prefetch('categories', queryset=Category.objects.only('id', 'name')))
+        if fields is None or 'ingredients' in fields:
+            replacements = Prefetch('replacements', queryset=Ingredient.objects.only('id', 'name'))
+            queryset = queryset.prefetch_related(
+                Prefetch('ingredients', queryset=Ingredient.objects.prefetch_related(replacements)))
+        return queryset
+
+    def validate_ingredients(self, ingredients_data):
+        """Ids of the named ingredients, in one query before anything is written. Ingredients are not created here."""
+        names = {ingredient_data['name'] for ingredient_data in ingredients_data}
+        ids = dict(Ingredient.objects.filter(name__in=names).values_list('name', 'id'))
+        unknown = sorted(names - set(ids))
+        if unknown:
+            raise serializers.ValidationError('Unknown ingredients: {}.'.format(', '.join(unknown)))
+        return list(ids.values())
 
     def create(self, validated_data):
-        ingredients_data = validated_data.pop('ingredients')
-        categories_data = validated_data.pop('categories')
-        recipe = Recipe.objects.create(**validated_data)
-        for ingredient_data in ingredients_data:
-            try:
-                ingredient = Ingredient.objects.get(name=ingredient_data['name'])
-                recipe.ingredients.add(ingredient)
-            except KeyError:
-                continue
-        # for category_data in categories_data:
-        #     category = Category.objects.get(name=category_data['name'])
-        #     recipe.categories.add(category)
-        recipe.categories.add(*categories_data)  # slug related field stores list of objects
-        recipe.save()
+        ingredient_ids = validated_data.pop('ingredients')
+        categories = validated_data.pop('categories')
+        with transaction.atomic():
+            recipe = Recipe.objects.create(**validated_data)
+            recipe.ingredients.set(ingredient_ids)
+            recipe.categories.set(categories)  # slug related field stores list of objects
         return recipe
 
     def update(self, recipe, validated_data):
         logged_user = self.context['request'].user
-        form_user = validated_data.pop('user')
+        form_user = validated_data.pop('user', recipe.user)
 
         if logged_user.id == form_user.basic_info_id and logged_user.id == recipe.user.basic_info_id:
-            ingredients_data = validated_data.pop('ingredients')
-            categories_data = validated_data.pop('categories')
+            ingredient_ids = validated_data.pop('ingredients', None)
+            categories = validated_data.pop('categories', None)
+
+            with transaction.atomic():
+                for attr, value in validated_data.items():
+                    setattr(recipe, attr, value)
+                recipe.save()
+                # set() only inserts and deletes the links that differ
+                if ingredient_ids is not None:
+                    recipe.ingredients.set(ingredient_ids)
+                if categories is not None:
+                    recipe.categories.set(categories)
+        return recipe
 
-            for attr, value in validated_data.items():
-                setattr(recipe, attr, value)
 
-            recipe.ingredients.clear()
+class NameListField(serializers.ListField):
+    """Names given as strings or as objects with a name, the way RecipeSerializer renders ingredients."""
 
-            for ingredient_data in ingredients_data:
-                try:
-                    ingredient = Ingredient.objects.get(name=ingredient_data['name'])
-                    recipe.ingredients.add(ingredient)
-                except KeyError:
-                    continue
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            data = [item.get('name') if isinstance(item, dict) else item for item in data]
+        return super().to_internal_value(data)
 
-            recipe.categories.clear()
-            recipe.categories.add(*categories_data)
 
-            recipe.save()
-        return recipe
+class RecipeImportSerializer(serializers.Serializer):
+    """Validates records of a bulk import (see Recipes.importer) without touching the database."""
+    title = serializers.CharField(max_length=100)
+    description = serializers.CharField(max_length=1000, allow_blank=True, default='')
+    difficulty = serializers.IntegerField(min_value=1, max_value=5, default=3)
+    time = serializers.IntegerField(min_value=1, allow_null=True, default=None)
+    categories = NameListField(child=serializers.CharField(max_length=50), default=list)
+    ingredients = NameListField(child=serializers.CharField(max_length=100), allow_empty=False)
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -141,6 +237,30 @@ class RatingSerializer(serializers.ModelSerializer):
         model = Rating
         fields = '__all__'
 
+    def validate(self, attrs):
+        # creating upserts (see RatingsView.create), an update must not move a rating onto another one
+        if self.instance is not None:
+            user = attrs.get('user', self.instance.user)
+            recipe = attrs.get('recipe', self.instance.recipe)
+            if Rating.objects.filter(user=user, recipe=recipe).exclude(pk=self.instance.pk).exists():
+                raise serializers.ValidationError('{} already rated this recipe.'.format(user.nickname))
+        return attrs
+
+
+class RatingItemSerializer(serializers.Serializer):
+    recipe_id = serializers.IntegerField()
+    score = serializers.IntegerField(min_value=1, max_value=5)
+
+
+class RatingBatchSerializer(serializers.Serializer):
+    """Scores of the logged user, a recipe given more than once keeps its last score."""
+    ratings = RatingItemSerializer(many=True)
+
+
+class FavouriteBatchSerializer(serializers.Serializer):
+    add = serializers.ListField(child=serializers.IntegerField(), default=list)
+    remove = serializers.ListField(child=serializers.IntegerField(), default=list)
+
 
 class BaseUserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -149,7 +269,14 @@ class BaseUserSerializer(serializers.ModelSerializer):
         fields = ['username', 'password', 'email']
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsModelSerializer):
+    """
+    Compact profile by default. Sections in `expandable_fields` cost queries (recommendations run the
+    recommender) and are included only when named in `expand` or `fields`. A view may allow fewer of
+    them through its own `expandable_fields`.
+    """
+    expandable_fields = ('top_rated_recipes', 'recommended_recipes', 'my_recipes')
+
     basic_info = BaseUserSerializer()
     favourite_recipes = LimitedRecipeSerializer(many=True, read_only=True)
     top_rated_recipes = serializers.SerializerMethodField()
@@ -160,6 +287,30 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = '__all__'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = requested_expansions(self.context.get('request'))
+        allowed = getattr(self.context.get('view'), 'expandable_fields', self.expandable_fields)
+        for field_name in self.expandable_fields:
+            if field_name not in requested or field_name not in allowed:
+                self.fields.pop(field_name, None)
+
+    @staticmethod
+    def setup_eager_loading(queryset, sections=()):
+        """Loads the profile and the requested sections a list can have in a constant number of queries."""
+        queryset = queryset.select_related('basic_info').prefetch_related(
+            Prefetch('favourite_recipes', queryset=Recipe.objects.only(*LimitedRecipeSerializer.Meta.fields)))
+        if 'top_rated_recipes' in sections:
+            ratings = Rating.objects.select_related('recipe').only(
+                'user', 'score', *('recipe__' + field for field in LimitedRecipeSerializer.Meta.fields))
+            queryset = queryset.prefetch_related(
+                Prefetch('rating_set', queryset=ratings.order_by('-score', 'id'), to_attr='ratings_by_score'))
+        if 'my_recipes' in sections:
+            queryset = queryset.prefetch_related(
+                Prefetch('recipe_set', queryset=Recipe.objects.only('user', *LimitedRecipeSerializer.Meta.fields),
+                         to_attr='authored_recipes'))
+        return queryset
+
     def create(self, validated_data):
         basic_data = validated_data.pop('basic_info')
         favourite_recipes = validated_data.pop('favourite_recipes', [])
@@ -169,21 +320,23 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
     def get_top_rated_recipes(self, user):
-        ratings = Rating.objects.filter(user__pk=user.pk).order_by('-score')[:3]
-        recipes = [rating.recipe for rating in ratings]
+        ratings = getattr(user, 'ratings_by_score', None)
+        if ratings is None:
+            ratings = Rating.objects.filter(user__pk=user.pk).select_related('recipe').order_by('-score', 'id')
+        recipes = [rating.recipe for rating in ratings[:3]]
         serializer = LimitedRecipeSerializer(recipes, many=True)
         return serializer.data
 
     def get_recommended_recipes(self, user):
-        recipes = propose_recipes(
-            User.objects.prefetch_related('favourite_recipes').get(pk=user.pk).favourite_recipes.all(),
-            Recipe.objects.prefetch_related('categories', 'ingredients'),
-            list(Category.objects.all()), list(Ingredient.objects.all()))
+        engine, blend = recommendation_options(self.context.get('request'))
+        recipes = get_recommendations(user.pk, fields=LimitedRecipeSerializer.Meta.fields, engine=engine, blend=blend)
         serializer = LimitedRecipeSerializer(recipes, many=True)
         return serializer.data
 
     def get_my_recipes(self, user):
-        recipes = Recipe.objects.filter(user__pk=user.pk)
+        recipes = getattr(user, 'authored_recipes', None)
+        if recipes is None:
+            recipes = Recipe.objects.filter(user__pk=user.pk).only(*LimitedRecipeSerializer.Meta.fields)
         serializer = LimitedRecipeSerializer(recipes, many=True)
         return serializer.data
 
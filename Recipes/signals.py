@@ -0,0 +1,143 @@
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from Recipes import aggregates, versions
+from Recipes import autocomplete, replacements, response_cache
+from Recipes.models import Recipe, Category, Ingredient, User, Rating, Comment
+from Recipes.recommender import precomputed
+from Recipes.response_cache import recipe_tag, RECIPES, INGREDIENTS, CATEGORIES
+
+
+def catalog_changed(kind, *ids):
+    # every process reloads the rows once they are committed, see Recipes.versions
+    versions.record_catalog_on_commit(kind, ids)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, **kwargs):
+    catalog_changed('recipe', instance.pk)
+    response_cache.invalidate(RECIPES, recipe_tag(instance.pk))
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    catalog_changed('recipe', instance.pk)
+    response_cache.invalidate(RECIPES, recipe_tag(instance.pk))
+
+
+@receiver(m2m_changed, sender=Recipe.categories.through)
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def recipe_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        catalog_changed('recipe', instance.pk)
+        response_cache.invalidate(RECIPES, recipe_tag(instance.pk))
+    elif action == 'post_clear':
+        # the tag lost all of its recipes, readers compare them with the rows they hold
+        catalog_changed('category' if isinstance(instance, Category) else 'ingredient', instance.pk)
+        # recipes that lost the tag are unknown by now, all recipe responses depend on the tag kind
+        response_cache.invalidate(RECIPES, CATEGORIES if isinstance(instance, Category) else INGREDIENTS)
+    else:
+        catalog_changed('recipe', *pk_set)
+        response_cache.invalidate(RECIPES, *map(recipe_tag, pk_set))
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Ingredient)
+def tag_saving(sender, instance, **kwargs):
+    # autocomplete only depends on names
+    instance._stored_name = None
+    if instance.pk is not None:
+        instance._stored_name = sender.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+
+def tag_saved(instance, created):
+    if created or instance.name != instance._stored_name:
+        versions.bump_on_commit(autocomplete.VERSION_NAME)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    catalog_changed('category', instance.pk)
+    response_cache.invalidate(CATEGORIES)
+    tag_saved(instance, created)
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    catalog_changed('category', instance.pk)
+    response_cache.invalidate(CATEGORIES)
+    versions.bump_on_commit(autocomplete.VERSION_NAME)
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, created, **kwargs):
+    catalog_changed('ingredient', instance.pk)
+    response_cache.invalidate(INGREDIENTS)
+    tag_saved(instance, created)
+
+
+@receiver(post_delete, sender=Ingredient)
+def ingredient_deleted(sender, instance, **kwargs):
+    catalog_changed('ingredient', instance.pk)
+    # replacement rows of the ingredient were removed without m2m signals
+    versions.bump_on_commit(replacements.VERSION_NAME)
+    response_cache.invalidate(INGREDIENTS)
+    versions.bump_on_commit(autocomplete.VERSION_NAME)
+
+
+@receiver(m2m_changed, sender=Ingredient.replacements.through)
+def replacements_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        versions.bump_on_commit(replacements.VERSION_NAME)
+        response_cache.invalidate(INGREDIENTS)
+
+
+@receiver(m2m_changed, sender=User.favourite_recipes.through)
+def favourites_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            precomputed.invalidate([instance.pk])
+    elif action == 'pre_clear':
+        # reverse side: instance is a recipe, the accessor returns users having it as favourite
+        precomputed.invalidate(instance.favourite_recipes.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        precomputed.invalidate(pk_set)
+
+
+@receiver(pre_save, sender=Rating)
+def rating_saving(sender, instance, **kwargs):
+    # an edited rating may move to another recipe, both have to be recounted
+    instance._stored_recipe_id = None
+    if instance.pk is not None:
+        instance._stored_recipe_id = Rating.objects.filter(pk=instance.pk).values_list('recipe_id', flat=True).first()
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, **kwargs):
+    recipe_ids = {instance.recipe_id, instance._stored_recipe_id} - {None}
+    if created:
+        aggregates.rating_added(instance.recipe_id, instance.score)
+    else:
+        aggregates.reconcile(recipe_ids)
+    response_cache.invalidate(RECIPES, *map(recipe_tag, recipe_ids))
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    aggregates.rating_removed(instance.recipe_id, instance.score)
+    response_cache.invalidate(RECIPES, recipe_tag(instance.recipe_id))
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    if created:
+        aggregates.comment_added(instance.recipe_id)
+        response_cache.invalidate(RECIPES, recipe_tag(instance.recipe_id))
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    aggregates.comment_removed(instance.recipe_id)
+    response_cache.invalidate(RECIPES, recipe_tag(instance.recipe_id))
@@ -1,3 +1,836 @@
-from django.test import TestCase
+import io
+import json
+import logging
+import os
+import tempfile
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User as BaseUser
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from scipy import sparse
+
+from Recipes import aggregates, autocomplete, response_cache, versions
+from Recipes.autocomplete import reset_name_indexes
+from Recipes.importer import read_records
+from Recipes.inverted_index import TagIndex, reset_tag_index
+from Recipes.management.commands import benchmark
+from Recipes.management.commands.evaluate_recommender import split_by_user
+from Recipes.middleware import route_histograms
+from Recipes.models import Recipe, Ingredient, Category, Comment, Rating, User, UserRecommendation
+from Recipes.recommender import recommend_ids
+from Recipes.recommender.collaborative import CollaborativeModel, fit_model, get_collaborative_model, \
+    reset_collaborative_model
+from Recipes.recommender.features import FeatureStore, get_store, reset_store
+from Recipes.recommender.index import BruteForceIndex, LSHIndex, KEEP_INDEXES, build_index, get_index, reset_index
+from Recipes.recommender.precomputed import precompute
+from Recipes.replacements import reset_replacement_graph
+from Recipes.response_cache import recipe_tag, reset_response_cache
+from Recipes.serializer import UserSerializer, parse_share
+
+
+def clustered_recipes(n_recipes=2000, n_features=500, n_clusters=40, seed=0):
+    """Sparse binary recipes drawn around a few "cuisines", so neighbours actually exist."""
+    random = np.random.RandomState(seed)
+    centers = [random.choice(n_features, 15, replace=False) for _ in range(n_clusters)]
+    rows, columns = [], []
+    for row in range(n_recipes):
+        center = centers[random.randint(n_clusters)]
+        tags = np.union1d(center[random.rand(len(center)) < 0.8], random.choice(n_features, 3))
+        rows.extend([row] * len(tags))
+        columns.extend(tags)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(n_recipes, n_features))
+
+
+class LSHIndexTest(SimpleTestCase):
+    k = 10
+
+    def setUp(self):
+        self.matrix = clustered_recipes()
+        self.queries = self.matrix[np.arange(0, self.matrix.shape[0], 20)]
+
+    def recall(self, index):
+        exact_distances, _ = BruteForceIndex.build(self.matrix).query(self.queries, self.k)
+        distances, _ = index.query(self.queries, self.k)
+        # ties make neighbour ids ambiguous, count neighbours no further than the true k-th one
+        hits = (distances <= exact_distances[:, -1:] + 1e-9).sum(axis=1)
+        return hits.mean() / self.k
+
+    def test_recall_at_k(self):
+        self.assertGreaterEqual(self.recall(LSHIndex.build(self.matrix)), 0.9)
+
+    def test_memory_mapped_index_answers_like_built_one(self):
+        index = LSHIndex.build(self.matrix)
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(directory)
+            loaded = LSHIndex.load(directory, self.matrix)
+            self.assertIsInstance(loaded.codes, np.memmap)
+            np.testing.assert_array_equal(loaded.query(self.queries, self.k)[1], index.query(self.queries, self.k)[1])
+
+
+class CollaborativeModelTest(SimpleTestCase):
+
+    def test_recommends_what_similar_users_liked(self):
+        # two groups of users, each interacting with its own half of the recipes
+        random = np.random.RandomState(0)
+        interactions = random.rand(200, 40) < 0.3
+        interactions[:100, 20:] = interactions[100:, :20] = False
+        recipe_ids = np.arange(1000, 1040)
+        model = CollaborativeModel.fit(sparse.csr_matrix(interactions.astype(np.float32)), recipe_ids, 4)
+        self.assertEqual(model.recipe_factors.dtype, np.float32)
+
+        recommended = model.recommend({1000: 1.0, 1001: 0.8, 1002: 1.0}, 5)
+        self.assertEqual(len(recommended), 5)
+        self.assertTrue(all(1003 <= recipe_id < 1020 for recipe_id in recommended))
+        self.assertEqual(model.recommend({1: 1.0}, 5), [])
+
+    def test_evaluation_holds_out_latest_interactions_of_every_user(self):
+        # (user, recipe) rows in id order
+        rows = np.array([[1, 10], [2, 20], [1, 11], [1, 12], [3, 30], [2, 21], [1, 13], [1, 14]])
+        train, test = split_by_user(rows, 0.2)
+        self.assertEqual(train.tolist(), [[1, 10], [1, 11], [1, 12], [1, 13], [2, 20], [3, 30]])
+        self.assertEqual(test.tolist(), [[1, 14], [2, 21]])
+
+
+@override_settings(RECOMMENDER_DIR=None, RECOMMENDER_INDEX='brute', CATALOG_VERSIONS_DIR=None)
+class CatalogTestCase(TransactionTestCase):
+    """
+    Starts every test with empty in-memory catalog structures, rolled back rows must not leak.
+    Rows are committed, so structures follow them as in production (see Recipes.versions).
+    """
+
+    def setUp(self):
+        for reset in (reset_store, reset_index, reset_tag_index, reset_replacement_graph, reset_response_cache,
+                      reset_name_indexes, reset_collaborative_model):
+            reset()
+            self.addCleanup(reset)
+        # no line per request in test output
+        timing_logger = logging.getLogger('Recipes.middleware')
+        self.addCleanup(timing_logger.setLevel, timing_logger.level)
+        timing_logger.setLevel(logging.WARNING)
+
+    def create_catalog(self, n_recipes=30):
+        categories = [Category.objects.create(name='category {}'.format(i)) for i in range(4)]
+        ingredients = [Ingredient.objects.create(name='ingredient {}'.format(i)) for i in range(20)]
+        self.user = User.objects.create(basic_info=BaseUser.objects.create(username='cook'), nickname='cook')
+        self.recipes = []
+        for i in range(n_recipes):
+            recipe = Recipe.objects.create(title='recipe {}'.format(i), time=10 + i, difficulty=1 + i % 5)
+            recipe.categories.set(categories[i % 4:i % 4 + 1])
+            recipe.ingredients.set(ingredients[i % 20:i % 20 + 5])
+            self.recipes.append(recipe)
+        for ingredient, replacement in zip(ingredients, ingredients[1:]):
+            ingredient.replacements.add(replacement)
+
+    def authenticate(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user.basic_info)
+
+
+class RecommendedRecipesTest(CatalogTestCase):
+
+    def test_number_of_queries_does_not_depend_on_favourites(self):
+        self.create_catalog()
+        get_store().snapshot()
+        for favourites in (1, 10):
+            self.user.favourite_recipes.set(self.recipes[:favourites])
+            # stored list lookup, favourite ids, one bulk fetch of neighbours, storing the list
+            with transaction.atomic(), self.assertNumQueries(4):
+                recommended = UserSerializer().get_recommended_recipes(self.user)
+            # stored list lookup and the bulk fetch
+            with self.assertNumQueries(2):
+                self.assertEqual(UserSerializer().get_recommended_recipes(self.user), recommended)
+            self.assertTrue(recommended)
+            self.assertEqual(set(recommended[0]), {'id', 'title', 'time'})
+
+    @override_settings(RECOMMENDER_CF_FACTORS=2)
+    def test_engine_is_chosen_per_request(self):
+        self.create_catalog()
+        self.authenticate()
+        for i in range(6):
+            user = User.objects.create(basic_info=BaseUser.objects.create(username=str(i)), nickname=str(i))
+            user.favourite_recipes.set(self.recipes[i % 2::2][:5])
+        Rating.objects.create(user=self.user, recipe=self.recipes[0], score=5)
+        self.user.favourite_recipes.set(self.recipes[2:3])
+        url = '/users/{}'.format(self.user.pk)
+        # nothing is fitted within a request, content recommendations are served meanwhile
+        recipes = self.client.get(url, {'expand': 'recommended_recipes', 'engine': 'collaborative',
+                                        'blend': 'nan'}).json()['recommended_recipes']
+        self.assertTrue(recipes)
+        self.assertFalse(get_collaborative_model().fitted)
+        self.assertIsNone(parse_share('nan'))
+
+        fit_model()
+        for engine in ('collaborative', 'hybrid'):
+            recipes = self.client.get(url, {'expand': 'recommended_recipes', 'engine': engine,
+                                            'blend': 0.7}).json()['recommended_recipes']
+            recipe_ids = [recipe['id'] for recipe in recipes]
+            self.assertTrue(recipe_ids)
+            self.assertFalse({self.recipes[0].pk, self.recipes[2].pk} & set(recipe_ids))
+            if engine == 'collaborative':
+                # users liking recipes 0 and 2 liked the other even ones
+                self.assertTrue(all(recipe_id in [recipe.pk for recipe in self.recipes[::2]]
+                                    for recipe_id in recipe_ids))
+        self.assertFalse(UserRecommendation.objects.exists())
+
+    def test_precomputed_recommendations_are_served_until_favourites_change(self):
+        self.create_catalog()
+        self.user.favourite_recipes.set(self.recipes[:3])
+        self.assertEqual(precompute(), 1)
+        stored = UserRecommendation.objects.get(user=self.user)
+        self.assertCountEqual(stored.recipes, recommend_ids([recipe.id for recipe in self.recipes[:3]]))
+        self.assertEqual(precompute(), 0)
+
+        with transaction.atomic():
+            self.user.favourite_recipes.add(self.recipes[10])
+            # dropped on commit only
+            self.assertTrue(UserRecommendation.objects.filter(user=self.user).exists())
+        self.assertFalse(UserRecommendation.objects.filter(user=self.user).exists())
+
+    def test_lists_of_an_older_catalog_are_replaced(self):
+        self.create_catalog()
+        self.user.favourite_recipes.set(self.recipes[:3])
+        precompute()
+        removed = UserRecommendation.objects.get(user=self.user).recipes[0]
+        Recipe.objects.get(pk=removed).delete()
+        recommended = [recipe['id'] for recipe in UserSerializer().get_recommended_recipes(self.user)]
+        self.assertTrue(recommended)
+        self.assertNotIn(removed, recommended)
+        stored = UserRecommendation.objects.get(user=self.user)
+        self.assertEqual((stored.recipes, stored.catalog_version), (recommended, get_store().version))
+
+
+class RecommendationsEndpointTest(CatalogTestCase):
+
+    def test_top_k_excludes_known_recipes_and_diversifies(self):
+        self.create_catalog()
+        self.authenticate()
+        self.recipes[5].user = self.user
+        self.recipes[5].save()
+        self.user.favourite_recipes.add(self.recipes[0])
+        Rating.objects.create(user=self.user, recipe=self.recipes[1], score=4)
+        url = '/users/{}/recommendations'.format(self.user.pk)
+        known = {recipe.pk for recipe in self.recipes[:2] + self.recipes[5:6]}
+        get_store().snapshot()
+
+        # user, ratings, favourites, authored recipes, the recommended ones
+        with self.assertNumQueries(5):
+            ranked = self.client.get(url, {'k': 4, 'engine': 'content', 'diversity': 0}).json()
+        self.assertEqual(len(ranked), 4)
+        self.assertFalse(known & {recipe['id'] for recipe in ranked})
+        scores = [recipe['score'] for recipe in ranked]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+        diverse = self.client.get(url, {'k': 4, 'engine': 'content', 'diversity': 0.9}).json()
+        self.assertEqual(len(diverse), 4)
+        self.assertFalse(known & {recipe['id'] for recipe in diverse})
+        self.assertEqual(diverse[0], ranked[0])
+        self.assertNotEqual([recipe['id'] for recipe in diverse], [recipe['id'] for recipe in ranked])
+
+        self.assertEqual(self.client.get('/users/0/recommendations').status_code, 404)
+
+
+class FeatureStoreTest(CatalogTestCase):
+
+    def test_scaling_is_fitted_on_the_catalog_and_persisted(self):
+        self.create_catalog(n_recipes=5)
+        with tempfile.TemporaryDirectory() as directory, override_settings(RECOMMENDER_DIR=directory):
+            reset_store()
+            get_store().build()
+            matrix, recipe_ids, _ = get_store().snapshot()
+            # difficulty, time, 4 categories and 20 ingredients, the author is not a feature
+            self.assertEqual(matrix.shape, (5, 26))
+            np.testing.assert_allclose(matrix[:, 1].toarray().ravel(), np.arange(10, 15) / 14)
+
+            # a later recipe is scaled like the catalog it was fitted on
+            recipe = Recipe.objects.create(title='long', time=28, difficulty=1)
+            matrix, recipe_ids, recipe_rows = get_store().snapshot()
+            self.assertEqual(matrix[recipe_rows[recipe.pk], 1], 2.0)
+
+            reset_store()
+            loaded, _, _ = get_store().snapshot()
+            self.assertEqual((loaded != matrix).nnz, 0)
+
+            with override_settings(RECOMMENDER_FEATURE_WEIGHTS={'ingredients': 0.5}):
+                reset_store()
+                weighted, _, _ = get_store().snapshot()
+            self.assertEqual(weighted[:, 6:].max(), 0.5)
+            self.assertEqual((weighted[:, :6] != matrix[:, :6]).nnz, 0)
+            reset_store()
+
+    def test_signals_maintain_committed_recipes(self):
+        self.create_catalog(n_recipes=5)
+        store = get_store()
+        store.snapshot()
+        salt = Ingredient.objects.create(name='salt')
+        recipe = Recipe.objects.create(title='salted', time=20, difficulty=2)
+        recipe.ingredients.set([salt])
+        self.recipes[0].delete()
+        with self.assertRaises(ValueError), transaction.atomic():
+            Recipe.objects.create(title='rolled back', time=20, difficulty=2)
+            raise ValueError
+
+        matrix, recipe_ids, rows = store.snapshot()
+        self.assertCountEqual(recipe_ids, [recipe.pk for recipe in self.recipes[1:]] + [recipe.pk])
+        self.assertCountEqual(matrix[rows[recipe.pk]].nonzero()[1].tolist(),
+                         [0, 1, store.ingredient_columns[salt.pk]])
+
+        salt.delete()
+        self.recipes[1].categories.clear()
+        matrix, _, rows = store.snapshot()
+        self.assertEqual(matrix[rows[recipe.pk]].nnz, 2)
+        self.assertEqual(matrix[rows[self.recipes[1].pk]].nnz, 7)
+
+    def test_processes_share_the_file_and_follow_the_journal(self):
+        self.create_catalog(n_recipes=5)
+        with tempfile.TemporaryDirectory() as directory, override_settings(CATALOG_VERSIONS_DIR=directory):
+            path = directory + '/features.npz'
+            first, second = FeatureStore(path), FeatureStore(path)
+            first.build()
+            with self.assertNumQueries(0):
+                self.assertEqual((second.snapshot()[0] != first.snapshot()[0]).nnz, 0)
+
+            recipe = Recipe.objects.create(title='new', time=20, difficulty=2)
+            recipe.ingredients.set(Ingredient.objects.all()[:2])
+            self.recipes[0].delete()
+            saved = os.stat(path).st_mtime_ns
+            for store in (first, second):
+                matrix, recipe_ids, rows = store.snapshot()
+                self.assertIn(recipe.pk, rows)
+                self.assertNotIn(self.recipes[0].pk, rows)
+                self.assertEqual(store.version, first.version)
+            # a few changes are not worth rewriting the file
+            self.assertEqual(os.stat(path).st_mtime_ns, saved)
+
+            first.save()
+            third = FeatureStore(path)
+            with self.assertNumQueries(0):
+                loaded, _, loaded_rows = third.snapshot()
+            self.assertEqual(loaded_rows, rows)
+            self.assertEqual((loaded != matrix).nnz, 0)
+
+
+@override_settings(RECOMMENDER_INDEX='lsh')
+class PersistedIndexTest(CatalogTestCase):
+
+    def test_index_serves_until_too_old_and_keeps_recent_directories(self):
+        self.create_catalog(n_recipes=5)
+        with tempfile.TemporaryDirectory() as directory, override_settings(RECOMMENDER_DIR=directory):
+            reset_store()
+            built, snapshot = build_index()
+            recipe = Recipe.objects.create(title='new', time=20, difficulty=2)
+            # the catalog changed, but the index is young enough
+            self.assertIs(get_index()[0], built)
+            self.assertNotIn(recipe.pk, get_index()[1][2])
+
+            # another worker loads what the first one wrote
+            reset_index()
+            loaded, loaded_snapshot = get_index()
+            self.assertIsNot(loaded, built)
+            np.testing.assert_array_equal(loaded_snapshot[1], snapshot[1])
+
+            with override_settings(RECOMMENDER_INDEX_MAX_AGE=0):
+                for _ in range(KEEP_INDEXES + 2):
+                    Recipe.objects.create(title='newer', time=20, difficulty=2)
+                    index, snapshot = get_index()
+                    self.assertIn(recipe.pk, snapshot[2])
+            saved = [name for name in os.listdir(directory) if name.startswith('index-lsh-')]
+            self.assertEqual(len(saved), KEEP_INDEXES + 1)
+            reset_store()
+
+
+class RecipeListQueriesTest(CatalogTestCase):
+
+    def assertConstantQueries(self, url, queries, **params):
+        for n_recipes in (5, 30):
+            with self.assertNumQueries(queries):
+                response = self.client.get(url, dict(params, amount=n_recipes))
+            self.assertEqual(len(response.json()), n_recipes)
+        return response.json()
+
+    def setUp(self):
+        super().setUp()
+        self.create_catalog()
+        self.authenticate()
+
+    def test_recipes_with_all_fields(self):
+        # recipes, categories, ingredients, replacements
+        recipe = self.assertConstantQueries('/recipes', 4)[0]
+        self.assertTrue(recipe['ingredients'][0]['replacements'])
+
+    def test_unrequested_relations_are_not_loaded(self):
+        recipe = self.assertConstantQueries('/recipes', 2, fields='id,title,categories')[0]
+        self.assertEqual(set(recipe), {'id', 'title', 'categories'})
+        self.assertConstantQueries('/recipes', 1, fields='id,title')
+
+    def test_ingredients_with_replacements(self):
+        # ingredients, replacements
+        with self.assertNumQueries(2):
+            ingredients = self.client.get('/ingredients').json()
+        self.assertEqual(len(ingredients), 20)
+        self.assertEqual(ingredients[0]['replacements'], [{'name': 'ingredient 1'}])
+
+    def test_search(self):
+        self.assertConstantQueries('/search', 4, time=100)
+        self.assertConstantQueries('/search', 3, fields='id,ingredients')
+
+
+class KeysetPaginationTest(CatalogTestCase):
+
+    def test_pages_cover_all_recipes_once(self):
+        self.create_catalog()
+        self.authenticate()
+        seen, url = [], '/recipes?fields=id&page_size=7'
+        while url:
+            response = self.client.get(url)
+            seen.extend(recipe['id'] for recipe in response.json())
+            url = response.get('Link', '').partition('>')[0].lstrip('<')
+        self.assertEqual(seen, sorted((recipe.id for recipe in self.recipes), reverse=True))
+        with override_settings(RECIPES_MAX_PAGE_SIZE=5):
+            self.assertEqual(len(self.client.get('/recipes?fields=id&page_size=10').json()), 5)
+
+    def test_cursor_is_a_range_of_the_index(self):
+        self.create_catalog(n_recipes=3)
+        self.authenticate()
+        url = self.client.get('/recipes?fields=id&page_size=1')['Link'].partition('>')[0].lstrip('<')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        sql = queries[0]['sql']
+        self.assertRegex(sql, r'"creation_date" <= \S+ AND \(')
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                cursor.execute('RESET enable_seqscan')
+            self.assertRegex(plan, r'Index Cond: .*creation_date <=')
+
+
+class FullTextSearchTest(CatalogTestCase):
+
+    def test_prefixes_of_title_and_description_words_ranked_by_title(self):
+        self.create_catalog(n_recipes=3)
+        self.authenticate()
+        Recipe.objects.filter(pk=self.recipes[0].pk).update(description='Grilled tomatoes with basil.')
+        Recipe.objects.filter(pk=self.recipes[1].pk).update(title='Tomato soup')
+        response = self.client.get('/search', {'q': 'tomat', 'fields': 'id'})
+        self.assertEqual([recipe['id'] for recipe in response.json()], [self.recipes[1].id, self.recipes[0].id])
+        self.assertEqual(self.client.get('/search', {'q': 'tomato basil', 'fields': 'id'}).json(),
+                         [{'id': self.recipes[0].id}])
+        # the first letters of a word may be a stopword
+        Recipe.objects.filter(pk=self.recipes[2].pk).update(title='Onion rings')
+        self.assertEqual(self.client.get('/search', {'q': 'on', 'fields': 'id'}).json(),
+                         [{'id': self.recipes[2].id}])
+
+        # ranks survive the round trip through the cursor
+        for recipe, title in zip(self.recipes, ('Tomato tart', 'Tomato soup', 'Tomatoes on toast')):
+            Recipe.objects.filter(pk=recipe.pk).update(title=title, description='Tomato ' * len(title))
+        ranked = [recipe['id'] for recipe in self.client.get('/search', {'q': 'tomato', 'fields': 'id'}).json()]
+        seen, url = [], '/search?q=tomato&fields=id&page_size=1'
+        # a cursor not matching its own row would return the same page forever
+        while url and len(seen) < 5:
+            response = self.client.get(url)
+            seen.extend(recipe['id'] for recipe in response.json())
+            url = response.get('Link', '').partition('>')[0].lstrip('<')
+        self.assertEqual(seen, ranked)
+        self.assertEqual(len(seen), 3)
+
+
+class PantrySearchTest(CatalogTestCase):
+
+    def search(self, **params):
+        response = self.client.get('/search', dict(params, fields='id'))
+        return [recipe['id'] for recipe in response.json()]
+
+    def setUp(self):
+        super().setUp()
+        self.create_catalog(n_recipes=10)
+        self.authenticate()
+        # recipe i has ingredients i..i+4
+        self.pantry = '[ingredient 2,ingredient 3,ingredient 4,ingredient 5]'
+
+    def test_recipes_with_all_ingredients(self):
+        self.assertEqual(self.search(ingredients='[ingredient 3,ingredient 4]', match='all'),
+                         [self.recipes[i].id for i in (3, 2, 1, 0)])
+        self.assertEqual(self.search(ingredients='[ingredient 3,unknown]', match='all'), [])
+
+    def test_ranked_by_coverage(self):
+        # recipes 1 and 2 have 4 of their 5 ingredients, recipes 0 and 3 have 3
+        self.assertEqual(self.search(ingredients=self.pantry, min_matches=3),
+                         [self.recipes[i].id for i in (2, 1, 3, 0)])
+        self.assertEqual(self.search(ingredients=self.pantry, max_missing=1),
+                         [self.recipes[i].id for i in (2, 1)])
+
+    def test_follows_catalog_changes_and_pages(self):
+        self.recipes[2].ingredients.remove(Ingredient.objects.get(name='ingredient 6'))
+        self.assertEqual(self.search(ingredients=self.pantry, max_missing=0), [self.recipes[2].id])
+        response = self.client.get('/search', {'ingredients': self.pantry, 'match': 'any', 'page_size': 4})
+        next_page = self.client.get(response['Link'].partition('>')[0].lstrip('<'))
+        ids = [recipe['id'] for recipe in response.json() + next_page.json()]
+        self.assertEqual(sorted(ids), sorted(recipe.id for recipe in self.recipes[:6]))
+
+    def test_more_matches_than_known_ingredients(self):
+        self.assertEqual(self.search(ingredients='[ingredient 3,ingredient 4,unknown]', min_matches=3), [])
+
+    def test_index_follows_committed_changes_of_every_process(self):
+        ingredient = Ingredient.objects.get(name='ingredient 9')
+        with tempfile.TemporaryDirectory() as directory, override_settings(CATALOG_VERSIONS_DIR=directory):
+            index = TagIndex()
+            index.build()
+            with self.assertRaises(ValueError), transaction.atomic():
+                self.recipes[0].ingredients.add(ingredient)
+                raise ValueError
+            self.recipes[1].ingredients.add(ingredient)
+            # the changed recipe and its relations are read, nothing else
+            with self.assertNumQueries(3):
+                index.ensure_fresh()
+        self.assertEqual(index.ingredients[ingredient.pk].tolist(), [self.recipes[i].id for i in (1, 5, 6, 7, 8, 9)])
+        self.assertEqual(index.sizes[self.recipes[1].id], 6)
+
+    def test_transitive_replacements(self):
+        # ingredient j is replaced by ingredient j+1
+        self.assertEqual(self.search(ingredients='[ingredient 0,unknown]', replacements='true'),
+                         [self.recipes[i].id for i in (1, 0)])
+        self.assertEqual(self.search(ingredients='[ingredient 0]', replacements='true', replacement_depth=2),
+                         [self.recipes[i].id for i in (2, 1, 0)])
+        self.assertEqual(self.search(ingredients='[ingredient 0]', replacements='true', replacement_depth=0),
+                         [self.recipes[0].id])
+        # recipe 1 only has the replacement of ingredient 0, it loses to recipe 0 with a penalty
+        self.assertEqual(self.search(ingredients='[ingredient 0,ingredient 2]', match='all', replacements='true',
+                                     replacement_penalty='0.5'),
+                         [self.recipes[i].id for i in (0, 1)])
+
+
+class RecipeImportTest(CatalogTestCase):
+
+    def test_ndjson_import_reports_invalid_records(self):
+        self.create_catalog(n_recipes=2)
+        self.authenticate()
+        body = '\n'.join([
+            json.dumps({'title': 'Pancakes', 'categories': ['category 0'], 'ingredients': ['ingredient 0', 'flour']}),
+            '{"title": broken',
+            json.dumps({'title': 'No ingredients', 'ingredients': []}),
+            json.dumps({'title': 'Toast', 'ingredients': [{'name': 'flour'}], 'time': 5}),
+        ])
+        response = self.client.post('/recipes/import', body, content_type='application/x-ndjson')
+        report = response.json()
+        self.assertEqual((report['created'], report['failed']), (2, 2))
+        self.assertEqual([error['record'] for error in report['errors']], [2, 3])
+
+        toast = Recipe.objects.get(title='Toast')
+        self.assertEqual((toast.time, toast.user), (5, self.user))
+        self.assertEqual(self.client.get('/search', {'ingredients': '[flour]', 'match': 'all', 'fields': 'id'}).json(),
+                         [{'id': toast.id}, {'id': Recipe.objects.get(title='Pancakes').id}])
+
+    def test_json_array_is_read_in_chunks(self):
+        records = [{'title': 'recipe {}'.format(i), 'ingredients': ['é {}'.format(i)]} for i in range(5)]
+        stream = io.BytesIO(json.dumps(records, ensure_ascii=False).encode())
+        self.assertEqual([record for _, record in read_records(stream, read_size=3)], records)
+        self.assertIsInstance(list(read_records(io.BytesIO(b'[{"title": 1}, {'), read_size=3))[-1][1], ValueError)
+
+        # a malformed element is skipped, numbers cut by a chunk are read whole
+        stream = io.BytesIO(b'[{"title": "a"}, {"title": x, "tags": ["]", {}]}, 12345, {"title": "\\"}"}]')
+        records = list(read_records(stream, read_size=4))
+        self.assertEqual([number for number, _ in records], [1, 2, 3, 4])
+        self.assertIsInstance(records[1][1], ValueError)
+        self.assertEqual([records[2][1], records[3][1]], [12345, {'title': '"}'}])
+
+
+class ResponseCacheTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_catalog(n_recipes=3)
+        self.authenticate()
+
+    def test_recipe_is_served_from_cache_until_changed(self):
+        recipe = self.recipes[0]
+        url = '/recipes/{}'.format(recipe.pk)
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(cached.content, first.content)
+        self.assertEqual(not_modified.status_code, 304)
+
+        recipe.title = 'renamed'
+        recipe.save()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.json()['title'], 'renamed')
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    def test_lists_are_invalidated_by_their_rows(self):
+        self.assertEqual(len(self.client.get('/categories').json()), 4)
+        self.assertEqual(len(self.client.get('/recipes?fields=id').json()), 3)
+        Category.objects.create(name='new')
+        self.recipes[0].delete()
+        self.assertEqual(len(self.client.get('/categories').json()), 5)
+        self.assertEqual(len(self.client.get('/recipes?fields=id').json()), 2)
+        self.recipes[1].ingredients.clear()
+        self.assertEqual(self.client.get('/recipes/{}'.format(self.recipes[1].pk)).json()['ingredients'], [])
+
+    @override_settings(RESPONSE_CACHE_BACKEND='default')
+    def test_evicted_generations_never_repeat(self):
+        recipe = self.recipes[0]
+        url = '/recipes/{}'.format(recipe.pk)
+        self.client.get(url)
+        # generations are evicted from the shared cache while this worker keeps its entries
+        response_cache.shared_cache().clear()
+        self.addCleanup(response_cache.shared_cache().clear)
+        Recipe.objects.filter(pk=recipe.pk).update(title='renamed')
+        self.assertEqual(self.client.get(url).json()['title'], 'renamed')
+
+    def test_recipes_share_a_bounded_number_of_stamps(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(CATALOG_VERSIONS_DIR=directory):
+            response_cache.invalidate(*map(recipe_tag, range(1000)))
+            stamps = [name for name in os.listdir(directory) if name.startswith('response-recipe')]
+            self.assertEqual(len(stamps), response_cache.RECIPE_STAMPS)
+
+
+class AutocompleteTest(CatalogTestCase):
+
+    def complete(self, url, **params):
+        return [item['name'] for item in self.client.get(url, params).json()]
+
+    def test_prefixes_then_typos(self):
+        self.create_catalog(n_recipes=1)
+        self.authenticate()
+        Ingredient.objects.create(name='Black Pepper')
+        self.assertEqual(self.complete('/ingredients/autocomplete', q='ingredient 1', limit=3),
+                         ['ingredient 1', 'ingredient 10', 'ingredient 11'])
+        self.assertEqual(self.complete('/ingredients/autocomplete', q='pep'), ['Black Pepper'])
+        self.assertEqual(self.complete('/ingredients/autocomplete', q='peper'), ['Black Pepper'])
+        self.assertEqual(self.complete('/ingredients/autocomplete', q='peper', fuzzy='false'), [])
+        self.assertEqual(self.complete('/ingredients/autocomplete', q='ingrdient 3')[0], 'ingredient 3')
+        Category.objects.filter(name='category 2').get().delete()
+        self.assertEqual(self.complete('/categories/autocomplete', q='Category'),
+                         ['category 0', 'category 1', 'category 3'])
+
+    def test_only_committed_renames_rebuild_the_index(self):
+        self.create_catalog(n_recipes=1)
+        self.authenticate()
+        category = Category.objects.get(name='category 0')
+        version = versions.current(autocomplete.VERSION_NAME)
+        category.save()
+        with self.assertRaises(ValueError), transaction.atomic():
+            category.name = 'soups'
+            category.save()
+            raise ValueError
+        self.assertEqual(versions.current(autocomplete.VERSION_NAME), version)
+        category.save()
+        self.assertEqual(self.complete('/categories/autocomplete', q='soup'), ['soups'])
+
+
+class UserProfileTest(CatalogTestCase):
+
+    def test_sections_are_opt_in_and_lists_never_recommend(self):
+        self.create_catalog(n_recipes=5)
+        self.authenticate()
+        for i, recipe in enumerate(self.recipes):
+            recipe.user = self.user
+            recipe.save()
+            Rating.objects.create(user=self.user, recipe=recipe, score=1 + i)
+        self.user.favourite_recipes.set(self.recipes[:2])
+        url = '/users/{}'.format(self.user.pk)
+        self.assertEqual(set(self.client.get(url).json()),
+                         {'id', 'basic_info', 'nickname', 'bio', 'favourite_recipes'})
+        expanded = self.client.get(url, {'expand': 'top_rated_recipes,recommended_recipes'}).json()
+        self.assertEqual([recipe['id'] for recipe in expanded['top_rated_recipes']],
+                         [recipe.id for recipe in self.recipes[:-4:-1]])
+        self.assertIn('recommended_recipes', expanded)
+        UserRecommendation.objects.all().delete()
+
+        expand = {'expand': 'top_rated_recipes,recommended_recipes,my_recipes'}
+        for n_users in range(3):
+            User.objects.create(basic_info=BaseUser.objects.create(username='user {}'.format(n_users)),
+                                nickname='user {}'.format(n_users))
+            # users with their accounts, favourites, ratings, recipes
+            with self.assertNumQueries(4):
+                users = self.client.get('/users', expand).json()
+        self.assertEqual(len(users), 4)
+        self.assertEqual(len(users[0]['my_recipes']), 5)
+        self.assertNotIn('recommended_recipes', users[0])
+        self.assertFalse(UserRecommendation.objects.exists())
+
+
+class BatchWriteTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_catalog(n_recipes=3)
+        self.authenticate()
+
+    def test_ratings_are_upserted(self):
+        first, second, _ = self.recipes
+        ratings = {'ratings': [{'recipe_id': first.pk, 'score': 2}, {'recipe_id': second.pk, 'score': 3},
+                               {'recipe_id': first.pk, 'score': 4}, {'recipe_id': 0, 'score': 5}]}
+        for _ in range(2):
+            response = self.client.post('/ratings/batch', ratings, format='json')
+        self.assertEqual(response.json(), {'rated': [first.pk, second.pk], 'missing': [0]})
+        rating = {'user': 'cook', 'recipe': second.pk, 'score': 5}
+        self.client.post('/ratings', rating, format='json')
+        self.assertEqual(self.client.post('/ratings', rating, format='json').json()['score'], 5)
+
+        self.assertEqual(sorted(Rating.objects.values_list('recipe_id', 'score')), [(first.pk, 4), (second.pk, 5)])
+        second.refresh_from_db()
+        self.assertEqual((second.rating_count, second.rating_sum), (1, 5))
+        self.assertEqual(self.client.post('/ratings/batch', {'ratings': [{'recipe_id': first.pk, 'score': 6}]},
+                                          format='json').status_code, 400)
+
+        # the user already rated the first recipe
+        moved = Rating.objects.get(recipe=second)
+        response = self.client.patch('/ratings/{}'.format(moved.pk), {'recipe': first.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.patch('/ratings/{}'.format(moved.pk), {'score': 1}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_favourites_in_one_request(self):
+        self.user.favourite_recipes.set(self.recipes[:1])
+        self.client.get('/users/{}'.format(self.user.pk), {'expand': 'recommended_recipes'})
+        changes = {'add': [self.recipes[1].pk, self.recipes[2].pk, 0], 'remove': [self.recipes[0].pk, -1]}
+        response = self.client.post('/favourite_recipes', changes, format='json')
+        self.assertEqual(response.json()['removed'], [self.recipes[0].pk])
+        response = self.client.post('/favourite_recipes', changes, format='json')
+        self.assertEqual(response.json()['removed'], [])
+        self.assertEqual(response.json()['missing'], [-1, 0])
+        self.assertCountEqual(self.user.favourite_recipes.all(), self.recipes[1:])
+        self.assertFalse(UserRecommendation.objects.exists())
+
+
+class AggregatesTest(CatalogTestCase):
+
+    def counters(self, recipe):
+        recipe.refresh_from_db()
+        return recipe.rating_count, recipe.rating_sum, recipe.rating_average, recipe.comment_count
+
+    def test_counters_follow_ratings_and_comments(self):
+        self.create_catalog(n_recipes=2)
+        first, second = self.recipes
+        loaded = Recipe.objects.get(pk=first.pk)
+        rating = Rating.objects.create(user=self.user, recipe=first, score=4)
+        Comment.objects.create(user=self.user, recipe=first, text='tasty')
+        Comment.objects.create(user=self.user, recipe=first, text='salty').delete()
+        # saving a recipe loaded before keeps the counters
+        loaded.title = 'renamed'
+        loaded.save()
+        self.assertEqual(self.counters(first), (1, 4, 4.0, 1))
+
+        rating.score, rating.recipe = 2, second
+        rating.save()
+        self.assertEqual(self.counters(first), (0, 0, None, 1))
+        self.assertEqual(self.counters(second), (1, 2, 2.0, 0))
+        rating.delete()
+        self.assertEqual(self.counters(second), (0, 0, None, 0))
+
+        Recipe.objects.update(rating_count=7, comment_count=7)
+        aggregates.reconcile([first.pk])
+        self.assertEqual(self.counters(first), (0, 0, None, 1))
+        self.assertEqual(self.counters(second)[0], 7)
+        aggregates.reconcile()
+        self.assertEqual(self.counters(second), (0, 0, None, 0))
+
+
+class GenerateTestDataTest(CatalogTestCase):
+
+    def test_small_dataset_is_consistent(self):
+        call_command('generate_test_data', users=6, recipes=20, stdout=io.StringIO())
+        self.assertEqual(User.objects.exclude(nickname='developer').count(), 6)
+        self.assertEqual(Recipe.objects.count(), 20)
+        self.assertFalse(Recipe.objects.filter(ingredients=None).exists())
+        self.assertEqual(Recipe.categories.through.objects.values('recipe').distinct().count(), 20)
+        self.assertTrue(Rating.objects.exists())
+
+        # aggregates of the bulk inserted ratings and comments were reconciled
+        scores, comments = {}, {}
+        for recipe_id, score in Rating.objects.values_list('recipe_id', 'score'):
+            scores.setdefault(recipe_id, []).append(score)
+        for recipe_id in Comment.objects.values_list('recipe_id', flat=True):
+            comments[recipe_id] = comments.get(recipe_id, 0) + 1
+        for recipe in Recipe.objects.all():
+            recipe_scores = scores.get(recipe.id, [])
+            self.assertEqual((recipe.rating_count, recipe.rating_sum, recipe.comment_count),
+                             (len(recipe_scores), sum(recipe_scores), comments.get(recipe.id, 0)))
+        # structures derived from the catalog follow the recorded rebuild
+        self.assertCountEqual(get_store().snapshot()[1], Recipe.objects.values_list('id', flat=True))
+
+        # the next run removes the old dataset, rows of other apps pointing to its users too
+        Token.objects.create(user=User.objects.exclude(nickname='developer').first().basic_info)
+        call_command('generate_test_data', users=2, recipes=3, stdout=io.StringIO())
+        self.assertEqual((User.objects.count(), BaseUser.objects.count(), Recipe.objects.count()), (3, 3, 3))
+        self.assertFalse(Token.objects.exists())
+
+
+class BenchmarkTest(CatalogTestCase):
+
+    def test_small_run(self):
+        command = benchmark.Command(stdout=io.StringIO(), stderr=io.StringIO())
+        results = command.run({'keepdb': False, 'scale': 0.1, 'seed': 1, 'requests': 3, 'warmup': 1,
+                               'only': ['ingredients', 'search_categories+ingredients']})
+        self.assertEqual(set(results['scenarios']),
+                         {'ingredients', 'ingredients_warm', 'search_categories+ingredients'})
+        for result in results['scenarios'].values():
+            self.assertEqual(result['statuses'], {'200': 3})
+        # cold requests are answered by the view, warm ones by the response cache
+        self.assertLess(results['scenarios']['ingredients_warm']['queries']['max'],
+                        results['scenarios']['ingredients']['queries']['mean'])
+
+
+class RecipeWriteTest(CatalogTestCase):
+
+    def test_update_changes_only_differing_links(self):
+        self.create_catalog(n_recipes=1)
+        self.authenticate()
+        recipe = self.recipes[0]
+        recipe.user = self.user
+        recipe.save()
+        links = dict(Recipe.ingredients.through.objects.filter(recipe=recipe).values_list('ingredient_id', 'id'))
+        names = ['ingredient 1', 'ingredient 2', 'ingredient 7']
+        data = {'ingredients': [{'name': name, 'replacements': []} for name in names],
+                'categories': ['category 0', 'category 3']}
+        response = self.client.patch('/recipes/{}'.format(recipe.pk), data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertCountEqual(recipe.ingredients.values_list('name', flat=True), names)
+        self.assertCountEqual(recipe.categories.values_list('name', flat=True), ['category 0', 'category 3'])
+        # links of ingredients the recipe keeps are the same rows
+        kept = dict(Recipe.ingredients.through.objects.filter(recipe=recipe).values_list('ingredient_id', 'id'))
+        for ingredient in Ingredient.objects.filter(name__in=names[:2]):
+            self.assertEqual(kept[ingredient.pk], links[ingredient.pk])
+
+        data['ingredients'].append({'name': 'unknown', 'replacements': []})
+        response = self.client.patch('/recipes/{}'.format(recipe.pk), data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(recipe.ingredients.count(), 3)
+        # unknown names are rejected before anything is written
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/recipes', dict(data, title='new', difficulty=1, time=5), format='json')
+        self.assertEqual(response.json(), {'ingredients': ['Unknown ingredients: unknown.']})
+        self.assertFalse([query for query in queries if query['sql'].startswith(('INSERT', 'UPDATE'))])
+
+
+class TimingMiddlewareTest(CatalogTestCase):
+
+    def test_timings_and_repeated_queries(self):
+        self.create_catalog(n_recipes=1)
+        self.authenticate()
+        for i in range(4):
+            Comment.objects.create(text='comment {}'.format(i), user=self.user, recipe=self.recipes[0])
+        # the author of every comment is loaded on its own
+        with override_settings(TIMING_N_PLUS_ONE_THRESHOLD=3), self.assertLogs('Recipes.middleware', 'WARNING') as logs:
+            response = self.client.get('/comments')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", view;dur=[\d.]+, '
+                                                     r'render;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertIn('N+1 queries on comments: 4 times', logs.output[0])
+        self.assertGreaterEqual(sum(route_histograms()['comments'].snapshot()[0]), 1)
+
+    def test_metrics_export_requests_by_route(self):
+        self.create_catalog(n_recipes=1)
+        self.authenticate()
+        self.client.get('/categories')
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            body = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        self.assertIn('recipes_request_duration_seconds_count{method="GET",route="categories"}', body)
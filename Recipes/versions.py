@@ -0,0 +1,176 @@
+"""
+Version stamps and change journals shared by all worker processes of a machine.
+
+In-memory structures remember the version they were built for and rebuild when another process
+bumped it. Stamps are files in settings.CATALOG_VERSIONS_DIR, reading one is a single stat call.
+Structures that are cheaper to update than to rebuild follow a journal instead: committed changes
+are appended to it as lines, and every process applies the lines it has not seen yet. Without the
+directory versions and journals only live in this process.
+
+Callers bump and record on commit (see `bump_on_commit`), a process must never read rows of a
+change before they are visible to it.
+"""
+import fcntl
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+# journal of recipes, categories and ingredients whose rows changed
+CATALOG = 'catalog'
+# a journal longer than this is started over, readers then rebuild
+MAX_JOURNAL_BYTES = 1024 * 1024
+MAX_LOCAL_ENTRIES = 50000
+
+_local_versions = {}
+_local_journals = {}  # name -> [identity, entries]
+
+
+def _path(name, extension='.version'):
+    directory = getattr(settings, 'CATALOG_VERSIONS_DIR', None)
+    return os.path.join(directory, name + extension) if directory else None
+
+
+def current(name):
+    path = _path(name)
+    if path is None:
+        return _local_versions.get(name, 0)
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def bump(name):
+    path = _path(name)
+    if path is None:
+        # like file stamps, a version never goes back to a value it had in an earlier process
+        _local_versions[name] = max(time.time_ns(), current(name) + 1)
+        return _local_versions[name]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a'):
+        pass
+    # mtime resolution of some filesystems is coarse, make sure the stamp always moves forward
+    now = max(time.time_ns(), current(name) + 1)
+    os.utime(path, ns=(now, now))
+    return current(name)
+
+
+def bump_on_commit(*names):
+    transaction.on_commit(lambda: [bump(name) for name in names])
+
+
+# journals
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock of the file at `path` across processes, a no-op for None. Not reentrant."""
+    if path is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def locked(name):
+    """Exclusive lock of `name` across the processes of the machine, a no-op without the directory."""
+    return file_lock(_path(name, '.lock'))
+
+
+def _start_journal(path):
+    """Replaces the journal by an empty one whose first line tells it apart from all earlier ones."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as journal:
+        journal.write(uuid.uuid4().hex + '\n')
+    os.replace(tmp_path, path)
+
+
+def _local_journal(name):
+    if name not in _local_journals:
+        _local_journals[name] = [uuid.uuid4().hex, []]
+    return _local_journals[name]
+
+
+def record(name, *entries):
+    """Appends entries (strings without newlines) to the journal of `name`."""
+    if not entries:
+        return
+    path = _path(name, '.journal')
+    if path is None:
+        journal = _local_journal(name)
+        if len(journal[1]) + len(entries) > MAX_LOCAL_ENTRIES:
+            journal[0], journal[1] = uuid.uuid4().hex, []
+        journal[1].extend(entries)
+        return
+    with locked(name):
+        try:
+            if os.path.getsize(path) > MAX_JOURNAL_BYTES:
+                _start_journal(path)
+        except FileNotFoundError:
+            _start_journal(path)
+        with open(path, 'a') as journal:
+            journal.write(''.join(entry + '\n' for entry in entries))
+
+
+def record_on_commit(name, *entries):
+    transaction.on_commit(lambda: record(name, *entries))
+
+
+def changes(name, position):
+    """
+    Entries recorded since `position`, with the position after them.
+
+    Entries are None when the reader has to start from scratch: for the position None and when the
+    journal was started over since. A reader takes the position before it reads any rows.
+    """
+    path = _path(name, '.journal')
+    if path is None:
+        generation, entries = _local_journal(name)
+        end = (generation, len(entries))
+        if position is None or position[0] != generation:
+            return end, None
+        return end, entries[position[1]:]
+
+    try:
+        journal = open(path, 'rb')
+    except FileNotFoundError:
+        with locked(name):
+            if not os.path.exists(path):
+                _start_journal(path)
+        journal = open(path, 'rb')
+    with journal:
+        identity = journal.readline().decode().strip()
+        if position is None or position[0] != identity:
+            return (identity, journal.seek(0, os.SEEK_END)), None
+        journal.seek(position[1])
+        data = journal.read()
+    # a line being appended right now is read next time
+    data = data[:data.rfind(b'\n') + 1]
+    return (identity, position[1] + len(data)), data.decode().splitlines()
+
+
+def record_catalog_on_commit(kind, ids):
+    """Records that rows of recipes, categories or ingredients (`kind`) with these ids changed."""
+    record_on_commit(CATALOG, *('{} {}'.format(kind, pk) for pk in ids))
+
+
+def record_rebuild_on_commit():
+    """
+    Records that the catalog changed without signals. The entry holds its commit time, structures
+    whose rows were read later than that can keep them.
+    """
+    transaction.on_commit(lambda: record(CATALOG, 'rebuild {}'.format(time.time_ns())))
+
+
+def catalog_changes(entries):
+    """Kind ('recipe', 'category', 'ingredient' or 'rebuild') -> ids named by catalog journal entries."""
+    changed = {'recipe': set(), 'category': set(), 'ingredient': set(), 'rebuild': set()}
+    for entry in entries:
+        kind, _, pk = entry.partition(' ')
+        changed[kind].add(int(pk))
+    return changed
@@ -1,3 +1,11 @@
+import io
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Prefetch
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from prometheus_client import CONTENT_TYPE_LATEST
 from rest_framework import status, filters
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
@@ -7,9 +15,29 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
+from Recipes import metrics
+from Recipes.autocomplete import DEFAULT_LIMIT, MAX_LIMIT, get_name_index
 from Recipes.models import Recipe, Ingredient, Category, Comment, Rating, User
+from Recipes.importer import BATCH_SIZE, import_recipes, read_records
+from Recipes.interactions import existing_recipes, update_favourites, upsert_ratings
+from Recipes.inverted_index import get_tag_index
+from Recipes.pagination import KeysetPagination, RankedResults
+from Recipes.recommender import RECOMMENDATIONS, MAX_RECOMMENDATIONS, fetch_recipes, top_recommendations
+from Recipes.replacements import get_replacement_graph, max_depth as replacements_max_depth
+from Recipes.response_cache import CachedResponseMixin, recipe_tag, RECIPES, INGREDIENTS, CATEGORIES
+from Recipes.search import full_text_search
 from Recipes.serializer import RecipeSerializer, IngredientSerializer, CategorySerializer, CommentSerializer, \
-    RatingSerializer, UserSerializer, DynamicRegistrationSerializer
+    RatingSerializer, UserSerializer, DynamicRegistrationSerializer, requested_fields, requested_expansions, \
+    RatingBatchSerializer, FavouriteBatchSerializer, LimitedRecipeSerializer, ScoredRecipeSerializer, \
+    recommendation_options, parse_share
+
+
+def metrics_view(request):
+    """Prometheus scrape target, protected by a bearer token when METRICS_TOKEN is set."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.export(), content_type=CONTENT_TYPE_LATEST)
 
 
 class IndexView(APIView):
@@ -34,6 +62,21 @@ class FavouriteRecipe(APIView):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+class FavouriteBatchView(APIView):
+    """Adds and removes favourites of the logged user in one request, repeating it changes nothing."""
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        user = get_object_or_404(User, basic_info=request.user)
+        serializer = FavouriteBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        add, remove = set(serializer.validated_data['add']), set(serializer.validated_data['remove'])
+        existing = existing_recipes(add | remove)
+        removed = update_favourites(user.pk, add & existing, remove)
+        return Response({'added': sorted(add & existing), 'removed': sorted(removed),
+                         'missing': sorted((add | remove) - existing)}, status=status.HTTP_200_OK)
+
+
 class AuthTokenView(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data,
@@ -44,23 +87,16 @@ class AuthTokenView(ObtainAuthToken):
         return Response({'id': user.id, 'token': token.key})
 
 
-class AllRecipes(ListAPIView):
+class AllRecipes(CachedResponseMixin, ListAPIView):
     permission_classes = (IsAuthenticated,)
 
     # queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
+    pagination_class = KeysetPagination
+    response_cache_tags = (RECIPES, INGREDIENTS, CATEGORIES)
 
     def get_queryset(self):
-        queryset = Recipe.objects.all()
-        amount = self.request.query_params.get('amount', None)
-        if amount is None:
-            return queryset.order_by('-creation_date')
-        else:
-            try:
-                amount = int(amount)
-            except ValueError:
-                return queryset.order_by('-creation_date')
-            return queryset.order_by('-creation_date')[:amount]
+        return RecipeSerializer.setup_eager_loading(Recipe.objects.all(), requested_fields(self.request))
 
     def post(self, request, format=None):
         serializer = RecipeSerializer(data=request.data)
@@ -70,27 +106,71 @@ class AllRecipes(ListAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class RecipeView(RetrieveUpdateDestroyAPIView):
+class RecipeImportView(APIView):
+    """
+    Creates recipes from NDJSON or a JSON array in the request body, which is read as a stream.
+
+    Ingredients and categories are given by name and created when missing. Invalid records are
+    reported by their number in the body and do not stop the import.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        user = User.objects.filter(basic_info=request.user).first()
+        batch_size = parse_count(request.query_params.get('batch_size')) or BATCH_SIZE
+        report = import_recipes(read_records(request.stream or io.BytesIO()), user=user, batch_size=batch_size)
+        return Response(report, status=status.HTTP_200_OK)
+
+
+class RecipeView(CachedResponseMixin, RetrieveUpdateDestroyAPIView):
     permission_classes = (IsAuthenticated,)
-    queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
 
+    def get_queryset(self):
+        return RecipeSerializer.setup_eager_loading(Recipe.objects.all(), requested_fields(self.request))
+
+    def cache_tags(self):
+        return [recipe_tag(self.kwargs['pk']), INGREDIENTS, CATEGORIES]
+
+
+def parse_list(value):
+    """Names sent as `[a,b]` or `a,b`."""
+    return set(name for name in value.strip('[]').split(',') if name)
+
+
+def parse_count(value):
+    return int(value) if value and value.isnumeric() else None
+
 
 class RecipeSearchView(ListAPIView):
+    """
+    Filters recipes by text, difficulty, time, categories and ingredients.
+
+    With `match` (all/any), `min_matches` or `max_missing` ingredients are matched by the in-memory
+    tag index instead of the database and recipes come ranked by the share of their ingredients
+    that were asked for. `replacements=true` lets replacements up to `replacement_depth` hops away
+    stand in for an ingredient, each hop costing `replacement_penalty` of its weight in ranking.
+    """
     permission_classes = (IsAuthenticated,)
     serializer_class = RecipeSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         params = self.request.query_params
-        query = Recipe.objects.all()
+        query = RecipeSerializer.setup_eager_loading(Recipe.objects.all(), requested_fields(self.request))
 
+        text = params.get('q', None)
         title = params.get('title', None)
         difficulty = params.get('difficulty', None)
         time = params.get('time', None)
         categories = params.get('categories', None)
         ingredients = params.get('ingredients', None)
-        amount = params.get('amount', None)
         replacements = params.get('replacements', None)
+        pantry = ingredients and any(params.get(name) for name in ('match', 'min_matches', 'max_missing'))
+
+        if text:
+            query = full_text_search(query, text)
+            self.keyset_ordering = ('-rank', '-id')
 
         if title:
             query = query.filter(title__icontains=title)
@@ -101,35 +181,78 @@ class RecipeSearchView(ListAPIView):
         if time and time.isnumeric():
             query = query.filter(time__lte=time)
 
+        if pantry:
+            narrowed = bool(text or title or difficulty or time)
+            return self.pantry_search(query, parse_list(ingredients), parse_list(categories or ''), narrowed)
+
         if categories:
-            cat_list = categories.strip('[]')
-            cat_list = set(cat_list.split(','))
+            cat_list = parse_list(categories)
             query = query.filter(categories__name__in=cat_list).distinct()
 
         if ingredients:
-            ing_list = ingredients.strip('[]')
-            ing_list = set(ing_list.split(','))
+            ing_list = parse_list(ingredients)
             if replacements == 'true':
-                for ing_name in list(ing_list):
-                    ing = Ingredient.objects.get(name=ing_name)
-                    for replacement in ing.replacements.all():
-                        ing_list.add(replacement.name)
-            query = query.filter(ingredients__name__in=ing_list).distinct()
-
-        if amount and amount.isnumeric():
-            query = query[:int(amount)]
+                ingredient_ids = get_tag_index().ingredient_ids(ing_list)
+                expanded = get_replacement_graph().expand(ingredient_ids, self.replacement_depth())
+                query = query.filter(ingredients__in=list(expanded)).distinct()
+            else:
+                query = query.filter(ingredients__name__in=ing_list).distinct()
 
         return query
 
+    def replacement_depth(self):
+        # 0 hops leaves every ingredient alone, a missing depth means 1
+        depth = parse_count(self.request.query_params.get('replacement_depth'))
+        return min(1 if depth is None else depth, replacements_max_depth())
+
+    def replacement_penalty(self):
+        return parse_share(self.request.query_params.get('replacement_penalty')) or 0.0
 
-class IngredientsView(ListAPIView):
+    def pantry_search(self, query, ingredient_names, category_names, narrowed):
+        params = self.request.query_params
+        index = get_tag_index()
+        ingredient_ids = index.ingredient_ids(ingredient_names)
+        if params.get('match') == 'all':
+            if len(ingredient_ids) < len(ingredient_names):
+                # an unknown ingredient is in no recipe
+                return RankedResults(query, [], [])
+            min_matches = len(ingredient_ids)
+        else:
+            min_matches = max(parse_count(params.get('min_matches')) or 1, 1)
+
+        if params.get('replacements') == 'true':
+            graph = get_replacement_graph()
+            groups = [graph.group(ingredient_id, self.replacement_depth(), self.replacement_penalty())
+                      for ingredient_id in ingredient_ids]
+        else:
+            groups = [{ingredient_id: 1.0} for ingredient_id in ingredient_ids]
+
+        recipe_ids, score, missing, coverage = index.match(groups, min_matches,
+                                                           parse_count(params.get('max_missing')))
+        keep = np.ones(len(recipe_ids), dtype=bool)
+        if category_names:
+            keep &= np.isin(recipe_ids, index.with_any_category(index.category_ids(category_names)))
+        if narrowed:
+            # other filters still run in the database, restricted to the matching recipes
+            allowed = query.filter(pk__in=recipe_ids[keep].tolist()).values_list('id', flat=True)
+            keep &= np.isin(recipe_ids, list(allowed))
+        recipe_ids, score, coverage = recipe_ids[keep], score[keep], coverage[keep]
+
+        keys = list(zip((-coverage).tolist(), (-score).tolist(), (-recipe_ids).tolist()))
+        return RankedResults(query, recipe_ids, keys)
+
+
+class IngredientsView(CachedResponseMixin, ListAPIView):
     permission_classes = (IsAuthenticated,)
 
-    queryset = Ingredient.objects.all()
+    queryset = Ingredient.objects.prefetch_related(
+        Prefetch('replacements', queryset=Ingredient.objects.only('id', 'name')))
     serializer_class = IngredientSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ['^name']
 
+    response_cache_tags = (INGREDIENTS,)
+
     def post(self, request):
         serializer = IngredientSerializer(data=request.data)
         if serializer.is_valid():
@@ -138,6 +261,24 @@ class IngredientsView(ListAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AutocompleteView(APIView):
+    """
+    Type-ahead for names of `model`: `q` is matched as a prefix of the name or of any word of it,
+    then with typos. Returns at most `limit` ids and names, straight from an in-memory index.
+    """
+    permission_classes = (IsAuthenticated,)
+    model = None
+
+    def get(self, request):
+        limit = min(parse_count(request.query_params.get('limit')) or DEFAULT_LIMIT, MAX_LIMIT)
+        fuzzy = request.query_params.get('fuzzy') != 'false'
+        names = get_name_index(self.model).complete(request.query_params.get('q', ''), limit, fuzzy)
+        response = Response([{'id': tag_id, 'name': name} for tag_id, name in names], status=status.HTTP_200_OK)
+        # keystrokes repeat while typing and deleting, browsers may answer them for a while
+        response['Cache-Control'] = 'private, max-age=60'
+        return response
+
+
 class IngredientView(RetrieveUpdateDestroyAPIView):
     permission_classes = (IsAuthenticated,)
 
@@ -145,7 +286,7 @@ class IngredientView(RetrieveUpdateDestroyAPIView):
     serializer_class = IngredientSerializer
 
 
-class CategoriesView(ListAPIView):
+class CategoriesView(CachedResponseMixin, ListAPIView):
     permission_classes = (IsAuthenticated,)
 
     queryset = Category.objects.all()
@@ -154,6 +295,8 @@ class CategoriesView(ListAPIView):
     filter_backends = [filters.SearchFilter]
     search_fields = ['^name']
 
+    response_cache_tags = (CATEGORIES,)
+
     def post(self, request):
         serializer = CategorySerializer(data=request.data)
         if serializer.is_valid():
@@ -174,6 +317,7 @@ class CommentsView(ListAPIView):
 
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
+    pagination_class = KeysetPagination
 
     def post(self, request):
         serializer = CommentSerializer(data=request.data)
@@ -188,14 +332,26 @@ class RatingsView(ModelViewSet):
 
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-id',)
 
     def create(self, request, *args, **kwargs):
         serializer = RatingSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-        Rating.objects.filter(user__nickname=data['user'], recipe=data['recipe']).delete()
-        serializer.save()
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        upsert_ratings(data['user'].pk, {data['recipe'].pk: data['score']})
+        rating = Rating.objects.get(user=data['user'], recipe=data['recipe'])
+        return Response(RatingSerializer(rating).data, status=status.HTTP_200_OK)
+
+    def batch(self, request):
+        """Scores of many recipes by the logged user, ratings that exist are updated."""
+        user = get_object_or_404(User, basic_info=request.user)
+        serializer = RatingBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        scores = {item['recipe_id']: item['score'] for item in serializer.validated_data['ratings']}
+        existing = existing_recipes(scores)
+        rated = upsert_ratings(user.pk, {recipe_id: scores[recipe_id] for recipe_id in existing})
+        return Response({'rated': rated, 'missing': sorted(set(scores) - existing)}, status=status.HTTP_200_OK)
 
     def get_queryset(self):
         queryset = Rating.objects.all()
@@ -212,8 +368,14 @@ class RatingsView(ModelViewSet):
 
 
 class UsersView(ListAPIView):
-    queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('id',)
+    # recommendations are computed one user at a time, a list never runs them
+    expandable_fields = ('top_rated_recipes', 'my_recipes')
+
+    def get_queryset(self):
+        return UserSerializer.setup_eager_loading(User.objects.all(), requested_expansions(self.request))
 
     def post(self, request):
         serializer = UserSerializer(data=request.data)
@@ -225,10 +387,32 @@ class UsersView(ListAPIView):
 
 class UserView(RetrieveUpdateDestroyAPIView):
     permission_classes = (IsAuthenticated,)
-
-    queryset = User.objects.all()
     serializer_class = UserSerializer
 
+    def get_queryset(self):
+        return UserSerializer.setup_eager_loading(User.objects.all(), requested_expansions(self.request))
+
+
+class UserRecommendationsView(APIView):
+    """
+    `k` recipes recommended to the user, best first and with their scores, never ones the user
+    favourited, rated or wrote. `engine` and `blend` choose the model as for the recommended recipes
+    of the profile, `diversity` (0 to 1) trades relevance for variety.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, pk):
+        user = get_object_or_404(User.objects.only('id'), pk=pk)
+        k = min(parse_count(request.query_params.get('k')) or RECOMMENDATIONS, MAX_RECOMMENDATIONS)
+        engine, blend = recommendation_options(request)
+        recipe_ids, scores = top_recommendations(user.pk, k, engine, blend,
+                                                 parse_share(request.query_params.get('diversity')))
+        recipes = fetch_recipes(recipe_ids, LimitedRecipeSerializer.Meta.fields)
+        scores = dict(zip(recipe_ids, scores))
+        for recipe in recipes:
+            recipe.score = scores[recipe.id]
+        return Response(ScoredRecipeSerializer(recipes, many=True).data, status=status.HTTP_200_OK)
+
 
 class RegistrationValidationView(APIView):
     def get(self, request):
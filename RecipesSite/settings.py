@@ -34,6 +34,8 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSchema',
     'DEFAULT_AUTHENTICATION_CLASSES': ['rest_framework.authentication.TokenAuthentication'],
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': ['Recipes.middleware.TimedJSONRenderer',
+                                 'rest_framework.renderers.BrowsableAPIRenderer'],
 }
 
 SWAGGER_SETTINGS = {
@@ -66,6 +68,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'Recipes.middleware.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -160,3 +163,58 @@ STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'RecipesSite/static')]
 
+# Request timing, see Recipes.middleware
+# A request running the same SQL more times than this is logged as N+1 queries.
+TIMING_N_PLUS_ONE_THRESHOLD = 10
+
+# Bearer token required by /metrics, open when not set.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # one JSON line per request
+        'Recipes.middleware': {'handlers': ['console'], 'level': os.environ.get('TIMING_LOG_LEVEL', 'INFO')},
+    },
+}
+
+# Version stamps of in-memory catalog structures (search indexes), shared by all workers.
+CATALOG_VERSIONS_DIR = os.environ.get('CATALOG_VERSIONS_DIR', os.path.join(BASE_DIR, 'var', 'versions'))
+
+# Largest page of recipes a client can ask for with page_size, see Recipes.pagination.
+RECIPES_MAX_PAGE_SIZE = 500
+
+# Longest chain of ingredient replacements /search follows.
+REPLACEMENT_MAX_DEPTH = 3
+
+# Cached responses of catalog views, see Recipes.response_cache
+# Entries kept by each worker.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1000))
+# Alias in CACHES shared by all workers (e.g. memcached or redis), only the per-worker cache when not set.
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND')
+# Seconds an entry is kept by the shared cache, invalidation by signals does not wait for it.
+RESPONSE_CACHE_TIMEOUT = 600
+
+# Recommender
+# Feature matrix is persisted here and shared by all workers of the machine.
+RECOMMENDER_DIR = os.environ.get('RECOMMENDER_DIR', os.path.join(BASE_DIR, 'var', 'recommender'))
+# Nearest neighbours backend: 'brute' (exact) or 'lsh' (approximate, memory-mapped by workers).
+RECOMMENDER_INDEX = os.environ.get('RECOMMENDER_INDEX', 'brute')
+# Seconds an approximate index may lag behind the catalog before a request rebuilds it,
+# build_recommender rebuilds it offline.
+RECOMMENDER_INDEX_MAX_AGE = 300
+# Weights of the feature blocks in recipe distances, applied on top of scaling fitted on the catalog.
+RECOMMENDER_FEATURE_WEIGHTS = {'numeric': 1.0, 'categories': 1.0, 'ingredients': 1.0}
+# Engine used when a request does not choose one: 'content', 'collaborative' or 'hybrid'.
+RECOMMENDER_ENGINE = os.environ.get('RECOMMENDER_ENGINE', 'content')
+# Share of the collaborative score in hybrid recommendations.
+RECOMMENDER_BLEND = 0.5
+# Weight of variety against relevance in /users/<pk>/recommendations, 0 orders by score only.
+RECOMMENDER_DIVERSITY = 0.3
+# Latent factors of the collaborative model, refitted by build_recommender.
+RECOMMENDER_CF_FACTORS = 64
+
@@ -19,6 +19,7 @@ from rest_framework_swagger.views import get_swagger_view
 from rest_framework.authtoken.views import obtain_auth_token
 
 import Recipes.views as recipe_views
+from Recipes.models import Ingredient, Category
 
 schema_view = get_swagger_view(title='Pastebin API')
 
@@ -27,15 +28,19 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('recipes', recipe_views.AllRecipes.as_view()),
     path('recipes/<int:pk>', recipe_views.RecipeView.as_view()),
+    path('recipes/import', recipe_views.RecipeImportView.as_view()),
     path('search', recipe_views.RecipeSearchView.as_view()),
     path('ingredients', recipe_views.IngredientsView.as_view()),
     path('ingredients/<int:pk>', recipe_views.IngredientView.as_view()),
+    path('ingredients/autocomplete', recipe_views.AutocompleteView.as_view(model=Ingredient)),
     path('categories', recipe_views.CategoriesView.as_view()),
     path('categories/<int:pk>', recipe_views.CategoryView.as_view()),
+    path('categories/autocomplete', recipe_views.AutocompleteView.as_view(model=Category)),
     path('ratings', recipe_views.RatingsView.as_view(actions={
         'get': 'list',
         'post': 'create'
     })),
+    path('ratings/batch', recipe_views.RatingsView.as_view(actions={'post': 'batch'})),
     path('ratings/<int:pk>', recipe_views.RatingsView.as_view(actions={
         'get': 'retrieve',
         'patch': 'partial_update',
@@ -44,7 +49,10 @@ urlpatterns = [
     path('comments', recipe_views.CommentsView.as_view()),
     path('users', recipe_views.UsersView.as_view()),
     path('users/<int:pk>', recipe_views.UserView.as_view()),
+    path('users/<int:pk>/recommendations', recipe_views.UserRecommendationsView.as_view()),
     path('auth', recipe_views.AuthTokenView.as_view()),
     path('registration', recipe_views.RegistrationValidationView.as_view()),
     path('favourite_recipe', recipe_views.FavouriteRecipe.as_view()),
+    path('favourite_recipes', recipe_views.FavouriteBatchView.as_view()),
+    path('metrics', recipe_views.metrics_view),
 ]
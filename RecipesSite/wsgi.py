@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RecipesSite.settings')
 
 application = get_wsgi_application()
+
+# build in-memory search structures before the worker takes its first request
+from Recipes.inverted_index import get_tag_index  # noqa: E402
+
+get_tag_index()
@@ -0,0 +1,33 @@
+# Loaded by gunicorn from the working directory, see Recipes.metrics for the metrics it sets up.
+import os
+import shutil
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# workers write metrics here, /metrics of any worker merges them
+os.environ.setdefault('prometheus_multiproc_dir', os.path.join(BASE_DIR, 'var', 'prometheus'))
+
+
+def on_starting(server):
+    # samples of workers of the previous run would be summed with the new ones
+    directory = os.environ['prometheus_multiproc_dir']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def post_fork(server, worker):
+    from Recipes import metrics
+    metrics.WORKERS_STARTED.inc()
+    metrics.WORKERS.set(1)
+
+
+def worker_abort(worker):
+    from Recipes import metrics
+    metrics.WORKER_TIMEOUTS.inc()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    from Recipes import metrics
+    multiprocess.mark_process_dead(worker.pid)
+    metrics.WORKER_EXITS.inc()